@@ -1,23 +1,56 @@
-from fastapi import FastAPI, HTTPException, Depends, status, Header
+import time
+_IMPORT_STARTED = time.perf_counter()
+
+from fastapi import FastAPI, HTTPException, Depends, status, Header, Request, Response
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.routing import APIRoute
+from fastapi.params import Depends as DependsParam
+from starlette.routing import compile_path
 import os
 from dotenv import load_dotenv
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument, UpdateOne, monitoring, timeout as mongo_timeout
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
 import uuid
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from pydantic import BaseModel
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Union, get_args, get_origin
+from urllib.parse import urlsplit, parse_qsl
+import inspect
+import base64
+import hashlib
+import contextvars
+import random
+import sys
+import copy
 import json
 import asyncio
-import httpx
-from emergentintegrations.llm.chat import LlmChat, UserMessage
+import re
+import threading
+import fcntl
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+import zlib
+from contextlib import asynccontextmanager, contextmanager
+from collections import OrderedDict, deque
+import numpy as np
 
 # Load environment variables
 load_dotenv()
 
-app = FastAPI(title="Character VR RP API", version="2.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Connect after the worker has started rather than at import time
+    init_db()
+    await start_background_tasks()
+    app.state.ready_seconds = time.perf_counter() - _IMPORT_STARTED
+    yield
+    await stop_background_tasks()
+    close_db()
+    span_exporter.close()
+
+app = FastAPI(title="Character VR RP API", version="2.0.0", lifespan=lifespan)
 
 # CORS middleware
 app.add_middleware(
@@ -26,21 +59,65 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID", "Idempotent-Replayed"],
 )
 
-# MongoDB connection
+# MongoDB connection (opened by init_db when the app starts)
 MONGO_URL = os.environ.get('MONGO_URL', 'mongodb://localhost:27017/character_vr_rp')
-client = MongoClient(MONGO_URL)
-db = client.get_default_database()
+client = None
+db = None
 
 # Collections
-users_collection = db.users
-characters_collection = db.characters
-conversations_collection = db.conversations
-messages_collection = db.messages
-sessions_collection = db.sessions
-multiplayer_rooms_collection = db.multiplayer_rooms
-personas_collection = db.personas
+users_collection = None
+characters_collection = None
+conversations_collection = None
+messages_collection = None
+message_buckets_collection = None
+message_archives_collection = None
+message_tombstones_collection = None
+chat_jobs_collection = None
+room_turns_collection = None
+idempotency_keys_collection = None
+usage_rollups_collection = None
+sessions_collection = None
+multiplayer_rooms_collection = None
+personas_collection = None
+
+def init_db():
+    """Open the MongoDB client and bind the collection handles"""
+    global client, db, session_store, message_store
+    global users_collection, characters_collection, conversations_collection, messages_collection, message_buckets_collection
+    global message_archives_collection, message_tombstones_collection, chat_jobs_collection, room_turns_collection
+    global idempotency_keys_collection, usage_rollups_collection, room_presence_collection
+    global sessions_collection, multiplayer_rooms_collection, personas_collection
+    
+    if client is not None:
+        return
+    client = MongoClient(MONGO_URL, event_listeners=[mongo_trace_listener, slow_query_log])
+    db = client.get_default_database()
+    users_collection = db.users
+    characters_collection = db.characters
+    conversations_collection = db.conversations
+    messages_collection = db.messages
+    message_buckets_collection = db.message_buckets
+    message_archives_collection = db.message_archives
+    message_tombstones_collection = db.message_tombstones
+    chat_jobs_collection = db.chat_jobs
+    room_turns_collection = db.room_turns
+    idempotency_keys_collection = db.idempotency_keys
+    usage_rollups_collection = db.usage_rollups
+    sessions_collection = db.sessions
+    multiplayer_rooms_collection = db.multiplayer_rooms
+    room_presence_collection = db.room_presence
+    personas_collection = db.personas
+    session_store = create_session_store(SESSION_STORE_BACKEND)
+    message_store = create_message_store(MESSAGE_STORAGE_LAYOUT)
+
+def close_db():
+    global client
+    if client is not None:
+        client.close()
+        client = None
 
 # Security
 security = HTTPBearer()
@@ -65,6 +142,142 @@ AVAILABLE_MODELS = {
     }
 }
 
+# Seconds to wait for one reply; models not listed get LLM_TIMEOUT_SECONDS. Reasoning models think before answering
+LLM_TIMEOUT_SECONDS = float(os.environ.get('LLM_TIMEOUT_SECONDS', '60'))
+MODEL_TIMEOUTS = {
+    "openai": {
+        "o4-mini": 120, "o3-mini": 120, "o3": 120, "o1-mini": 120, "o1": 120, "o1-pro": 120, "gpt-4.5-preview": 90
+    },
+    "anthropic": {
+        "claude-opus-4-20250514": 90
+    },
+    "gemini": {
+        "gemini-2.5-pro-preview-05-06": 90
+    }
+}
+
+# Estimated list prices in USD per million (prompt, completion) tokens, used for cost metering
+MODEL_PRICING = {
+    "openai": {
+        "gpt-4.1": (2.00, 8.00), "gpt-4.1-mini": (0.40, 1.60), "gpt-4.1-nano": (0.10, 0.40),
+        "o4-mini": (1.10, 4.40), "o3-mini": (1.10, 4.40), "o3": (2.00, 8.00), "o1-mini": (1.10, 4.40),
+        "gpt-4o-mini": (0.15, 0.60), "gpt-4.5-preview": (75.00, 150.00), "gpt-4o": (2.50, 10.00),
+        "o1": (15.00, 60.00), "o1-pro": (150.00, 600.00)
+    },
+    "anthropic": {
+        "claude-sonnet-4-20250514": (3.00, 15.00), "claude-opus-4-20250514": (15.00, 75.00),
+        "claude-3-7-sonnet-20250219": (3.00, 15.00), "claude-3-5-haiku-20241022": (0.80, 4.00),
+        "claude-3-5-sonnet-20241022": (3.00, 15.00)
+    },
+    "gemini": {
+        "gemini-2.5-flash-preview-04-17": (0.15, 0.60), "gemini-2.5-pro-preview-05-06": (1.25, 10.00),
+        "gemini-2.0-flash": (0.10, 0.40), "gemini-2.0-flash-preview-image-generation": (0.10, 0.40),
+        "gemini-2.0-flash-lite": (0.075, 0.30), "gemini-1.5-flash": (0.075, 0.30),
+        "gemini-1.5-flash-8b": (0.0375, 0.15), "gemini-1.5-pro": (1.25, 5.00)
+    }
+}
+
+# Batch API configuration
+BATCH_MAX_REQUESTS = int(os.environ.get('BATCH_MAX_REQUESTS', '20'))
+
+# Cache configuration
+PERSONA_CACHE_TTL_SECONDS = float(os.environ.get('PERSONA_CACHE_TTL_SECONDS', '300'))
+
+# Session configuration
+SESSION_STORE_BACKEND = os.environ.get('SESSION_STORE_BACKEND', 'mongo')  # mongo, memory
+SESSION_TTL_SECONDS = float(os.environ.get('SESSION_TTL_SECONDS', str(7 * 24 * 3600)))
+SESSION_RENEW_INTERVAL_SECONDS = float(os.environ.get('SESSION_RENEW_INTERVAL_SECONDS', '3600'))
+SESSION_SWEEP_SECONDS = float(os.environ.get('SESSION_SWEEP_SECONDS', '3600'))
+
+# Room presence configuration
+PRESENCE_TTL_SECONDS = float(os.environ.get('PRESENCE_TTL_SECONDS', '60'))
+PRESENCE_RECONCILE_SECONDS = float(os.environ.get('PRESENCE_RECONCILE_SECONDS', '30'))
+
+# Room message buffer configuration
+ROOM_BUFFER_MESSAGES = int(os.environ.get('ROOM_BUFFER_MESSAGES', '200'))  # per room
+ROOM_BUFFER_MAX_BYTES = int(os.environ.get('ROOM_BUFFER_MAX_BYTES', str(64 * 1024 * 1024)))  # across rooms, per process
+ROOM_BUFFER_IDLE_SECONDS = float(os.environ.get('ROOM_BUFFER_IDLE_SECONDS', '600'))
+ROOM_BUFFER_REFRESH_SECONDS = float(os.environ.get('ROOM_BUFFER_REFRESH_SECONDS', '2'))
+
+# Health probe configuration
+HEALTH_PING_SECONDS = float(os.environ.get('HEALTH_PING_SECONDS', '5'))
+HEALTH_MAX_LOOP_LAG_SECONDS = float(os.environ.get('HEALTH_MAX_LOOP_LAG_SECONDS', '0.5'))
+READINESS_REQUIRE_PROVIDER = os.environ.get('READINESS_REQUIRE_PROVIDER', 'true').lower() == 'true'
+PROVIDER_CIRCUIT_FAILURES = int(os.environ.get('PROVIDER_CIRCUIT_FAILURES', '5'))
+PROVIDER_CIRCUIT_COOLDOWN_SECONDS = float(os.environ.get('PROVIDER_CIRCUIT_COOLDOWN_SECONDS', '30'))
+
+# Export/import configuration
+EXPORT_CHUNK_BYTES = int(os.environ.get('EXPORT_CHUNK_BYTES', str(64 * 1024)))
+EXPORT_CURSOR_BATCH_SIZE = int(os.environ.get('EXPORT_CURSOR_BATCH_SIZE', '1000'))
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', '1000'))
+
+# Cold storage archival configuration
+ARCHIVE_IDLE_DAYS = float(os.environ.get('ARCHIVE_IDLE_DAYS', '90'))  # 0 disables the archiver
+ARCHIVE_INTERVAL_SECONDS = float(os.environ.get('ARCHIVE_INTERVAL_SECONDS', '3600'))
+ARCHIVE_BATCH_CONVERSATIONS = int(os.environ.get('ARCHIVE_BATCH_CONVERSATIONS', '50'))
+ARCHIVE_CHUNK_MESSAGES = int(os.environ.get('ARCHIVE_CHUNK_MESSAGES', '1000'))
+ARCHIVE_ZSTD_LEVEL = int(os.environ.get('ARCHIVE_ZSTD_LEVEL', '10'))
+
+# Chat job configuration
+CHAT_JOB_WORKERS = int(os.environ.get('CHAT_JOB_WORKERS', '4'))  # per process; 0 leaves jobs to other workers
+CHAT_JOB_LEASE_SECONDS = float(os.environ.get('CHAT_JOB_LEASE_SECONDS', '120'))
+CHAT_JOB_MAX_ATTEMPTS = int(os.environ.get('CHAT_JOB_MAX_ATTEMPTS', '3'))
+CHAT_JOB_POLL_SECONDS = float(os.environ.get('CHAT_JOB_POLL_SECONDS', '1'))
+CHAT_JOB_MAX_WAIT_SECONDS = float(os.environ.get('CHAT_JOB_MAX_WAIT_SECONDS', '30'))
+CHAT_JOB_TTL_SECONDS = float(os.environ.get('CHAT_JOB_TTL_SECONDS', str(24 * 3600)))
+
+# Tracing configuration
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0'))  # fraction of requests traced; X-Trace-Sampled overrides
+TRACE_EXPORTER = os.environ.get('TRACE_EXPORTER', 'stdout')  # stdout, none, or a file path for JSON lines
+
+# Slow query log configuration
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '100'))  # 0 disables the log
+SLOW_QUERY_EXPLAIN = os.environ.get('SLOW_QUERY_EXPLAIN', 'true').lower() == 'true'
+SLOW_QUERY_MAX_SHAPES = int(os.environ.get('SLOW_QUERY_MAX_SHAPES', '500'))
+
+# Admin configuration
+ADMIN_USER_IDS = {user_id.strip() for user_id in os.environ.get('ADMIN_USER_IDS', '').split(',') if user_id.strip()}
+
+# Room turn configuration
+ROOM_TURN_WINDOW_SECONDS = float(os.environ.get('ROOM_TURN_WINDOW_SECONDS', '1.0'))  # 0 answers every room message separately
+ROOM_TURN_TIMEOUT_SECONDS = float(os.environ.get('ROOM_TURN_TIMEOUT_SECONDS', '120'))
+ROOM_TURN_POLL_SECONDS = float(os.environ.get('ROOM_TURN_POLL_SECONDS', '0.25'))
+
+# Idempotency configuration
+IDEMPOTENCY_TTL_SECONDS = float(os.environ.get('IDEMPOTENCY_TTL_SECONDS', str(24 * 3600)))  # how long a key's result is replayed
+IDEMPOTENCY_LEASE_SECONDS = float(os.environ.get('IDEMPOTENCY_LEASE_SECONDS', '300'))  # after this a crashed attempt can be taken over
+IDEMPOTENCY_WAIT_SECONDS = float(os.environ.get('IDEMPOTENCY_WAIT_SECONDS', '120'))
+IDEMPOTENCY_POLL_SECONDS = float(os.environ.get('IDEMPOTENCY_POLL_SECONDS', '0.25'))
+
+# Client disconnect configuration
+CHAT_CANCEL_ON_DISCONNECT = os.environ.get('CHAT_CANCEL_ON_DISCONNECT', 'true').lower() == 'true'
+
+# Request deadline configuration
+REQUEST_DEADLINE_SECONDS = float(os.environ.get('REQUEST_DEADLINE_SECONDS', '30'))  # routes without their own default; 0 for none
+CHAT_DEADLINE_SECONDS = float(os.environ.get('CHAT_DEADLINE_SECONDS', '150'))
+REQUEST_DEADLINE_MAX_SECONDS = float(os.environ.get('REQUEST_DEADLINE_MAX_SECONDS', '300'))  # cap on X-Request-Timeout
+
+# Usage metering configuration
+USAGE_FLUSH_SECONDS = float(os.environ.get('USAGE_FLUSH_SECONDS', '10'))
+
+# Prewarm configuration
+PREWARM_TTL_SECONDS = float(os.environ.get('PREWARM_TTL_SECONDS', '600'))
+
+# Delta sync configuration
+SYNC_OVERLAP_SECONDS = float(os.environ.get('SYNC_OVERLAP_SECONDS', '5'))
+SYNC_TOMBSTONE_DAYS = float(os.environ.get('SYNC_TOMBSTONE_DAYS', '30'))
+
+# Message storage configuration
+MESSAGE_STORAGE_LAYOUT = os.environ.get('MESSAGE_STORAGE_LAYOUT', 'documents')  # documents, migrating, buckets
+MESSAGE_BUCKET_SIZE = int(os.environ.get('MESSAGE_BUCKET_SIZE', '100'))
+
+# Long-term memory configuration
+MEMORY_DIR = os.environ.get('MEMORY_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'memory_store'))
+MEMORY_EMBEDDING_DIM = int(os.environ.get('MEMORY_EMBEDDING_DIM', '256'))
+MEMORY_TOP_K = int(os.environ.get('MEMORY_TOP_K', '5'))
+MEMORY_MIN_SCORE = float(os.environ.get('MEMORY_MIN_SCORE', '0.2'))
+MEMORY_MAX_OPEN_INDEXES = int(os.environ.get('MEMORY_MAX_OPEN_INDEXES', '64'))
+
 # Pydantic models
 class User(BaseModel):
     user_id: str
@@ -83,6 +296,7 @@ class Session(BaseModel):
     session_token: str
     expires_at: datetime
     created_at: datetime
+    renewed_at: Optional[datetime] = None
 
 class Character(BaseModel):
     character_id: str
@@ -136,6 +350,14 @@ class Message(BaseModel):
     timestamp: datetime
     ai_provider: Optional[str] = None
     ai_model: Optional[str] = None
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    cost_usd: Optional[float] = None
+    edited_at: Optional[datetime] = None
+    reply_status: Optional[str] = None  # "cancelled" on a user message whose sender left before the reply
+
+class UpdateMessageRequest(BaseModel):
+    content: str
 
 class ChatRequest(BaseModel):
     conversation_id: str
@@ -204,6 +426,15 @@ class UpdatePersonaRequest(BaseModel):
     preferences: Optional[Dict[str, Any]] = None
     is_default: Optional[bool] = None
 
+class BatchSubRequest(BaseModel):
+    id: Optional[str] = None
+    method: str = "GET"
+    path: str
+    params: Dict[str, Any] = {}
+
+class BatchRequest(BaseModel):
+    requests: List[BatchSubRequest]
+
 # Helper functions
 def get_api_key(provider: str) -> str:
     """Get API key for the specified provider"""
@@ -216,7 +447,811 @@ def get_api_key(provider: str) -> str:
         return key if key and key != "demo_key_placeholder" else None
     return None
 
-def create_character_system_prompt(character: dict, mode: str = "casual", persona: Optional[dict] = None) -> str:
+def list_ai_providers() -> List[dict]:
+    """List configured AI providers with their models and availability"""
+    providers = []
+    
+    for provider, config in AVAILABLE_MODELS.items():
+        api_key = get_api_key(provider)
+        providers.append({
+            "id": provider,
+            "name": provider.title(),
+            "available": api_key is not None,
+            "models": config["models"],
+            "default_model": config["default"]
+        })
+    
+    return providers
+
+async def run_db(func, *args, **kwargs):
+    """Run a blocking PyMongo call in a worker thread so independent queries can be awaited concurrently"""
+    remaining = deadline_remaining()
+    if remaining is not None and remaining <= 0:
+        raise deadline_exceeded()
+    return await asyncio.to_thread(func, *args, **kwargs)
+
+async def run_db_unbounded(func, *args, **kwargs):
+    """run_db outside the request's deadline, for writes recording how a request ended after its budget ran out"""
+    return await asyncio.to_thread(contextvars.Context().run, func, *args, **kwargs)
+
+# Message storage
+def merge_messages(*groups: List[dict], newest_first: bool = False) -> List[dict]:
+    """Combine message lists, dropping repeated message_ids, in timestamp order"""
+    merged: Dict[str, dict] = {}
+    for group in groups:
+        for message in group:
+            merged.setdefault(message["message_id"], message)
+    return sorted(merged.values(), key=lambda message: message["timestamp"], reverse=newest_first)
+
+class MessageStore(ABC):
+    """Storage layout for chat messages; reads return plain message documents"""
+    
+    def ensure_indexes(self):
+        pass
+    
+    @abstractmethod
+    def insert(self, message: dict):
+        ...
+    
+    @abstractmethod
+    def insert_many(self, messages: List[dict]) -> int:
+        """Insert messages unordered, returning how many were stored"""
+    
+    @abstractmethod
+    def conversation_messages(self, conversation_id: str) -> List[dict]:
+        ...
+    
+    @abstractmethod
+    def iter_conversation_messages(self, conversation_id: str, batch_size: int = 1000):
+        ...
+    
+    @abstractmethod
+    def latest_conversation_messages(self, conversation_id: str, limit: int, before: Optional[datetime] = None) -> List[dict]:
+        """Return up to limit of the conversation's newest messages sent before before, newest first"""
+    
+    @abstractmethod
+    def room_messages(self, room_id: str) -> List[dict]:
+        ...
+    
+    @abstractmethod
+    def latest_room_messages(self, room_id: str, limit: int, before: Optional[datetime] = None) -> List[dict]:
+        """Return up to limit of the room's newest messages sent before before, newest first"""
+    
+    @abstractmethod
+    def find_by_ids(self, context_id: str, message_ids: List[str]) -> List[dict]:
+        """Fetch messages by id from one conversation or room"""
+    
+    @abstractmethod
+    def changed_conversation_messages(self, conversation_id: str, since: datetime) -> List[dict]:
+        """Messages sent or edited after since, oldest first"""
+    
+    @abstractmethod
+    def update_message(self, context_id: str, message_id: str, fields: dict) -> Optional[dict]:
+        """Set fields on one message, returning it as updated, or None if it doesn't exist"""
+    
+    @abstractmethod
+    def delete_message(self, context_id: str, message_id: str) -> bool:
+        ...
+    
+    @abstractmethod
+    def delete_conversation_messages(self, conversation_id: str, until: datetime):
+        """Remove the conversation's non-room messages sent at or before until"""
+
+class DocumentMessageStore(MessageStore):
+    """One document per message"""
+    
+    def __init__(self, collection):
+        self.collection = collection
+    
+    def ensure_indexes(self):
+        self.collection.create_index([("conversation_id", 1), ("timestamp", 1)])
+        self.collection.create_index([("room_id", 1), ("timestamp", 1)])
+        self.collection.create_index("message_id")
+        # Only edited messages are indexed; sync finds new ones through the timestamp index
+        self.collection.create_index(
+            [("conversation_id", 1), ("edited_at", 1)], partialFilterExpression={"edited_at": {"$gt": datetime(1970, 1, 1)}}
+        )
+    
+    def insert(self, message: dict):
+        self.collection.insert_one(dict(message))
+    
+    def insert_many(self, messages: List[dict]) -> int:
+        if not messages:
+            return 0
+        return len(self.collection.insert_many(messages, ordered=False).inserted_ids)
+    
+    def conversation_messages(self, conversation_id: str) -> List[dict]:
+        return list(self.collection.find({"conversation_id": conversation_id}, {"_id": 0}).sort("timestamp", 1))
+    
+    def iter_conversation_messages(self, conversation_id: str, batch_size: int = 1000):
+        yield from self.collection.find(
+            {"conversation_id": conversation_id}, {"_id": 0}
+        ).sort("timestamp", 1).batch_size(batch_size)
+    
+    def latest_conversation_messages(self, conversation_id: str, limit: int, before: Optional[datetime] = None) -> List[dict]:
+        query: Dict[str, Any] = {"conversation_id": conversation_id}
+        if before is not None:
+            query["timestamp"] = {"$lt": before}
+        return list(self.collection.find(query, {"_id": 0}).sort("timestamp", -1).limit(limit))
+    
+    def room_messages(self, room_id: str) -> List[dict]:
+        return list(self.collection.find({"room_id": room_id}, {"_id": 0}).sort("timestamp", 1))
+    
+    def latest_room_messages(self, room_id: str, limit: int, before: Optional[datetime] = None) -> List[dict]:
+        query: Dict[str, Any] = {"room_id": room_id}
+        if before is not None:
+            query["timestamp"] = {"$lt": before}
+        return list(self.collection.find(query, {"_id": 0}).sort("timestamp", -1).limit(limit))
+    
+    def find_by_ids(self, context_id: str, message_ids: List[str]) -> List[dict]:
+        return list(self.collection.find(
+            {"message_id": {"$in": message_ids}, "$or": [{"conversation_id": context_id}, {"room_id": context_id}]}, {"_id": 0}
+        ))
+    
+    def changed_conversation_messages(self, conversation_id: str, since: datetime) -> List[dict]:
+        return list(self.collection.find(
+            {"conversation_id": conversation_id, "$or": [{"timestamp": {"$gt": since}}, {"edited_at": {"$gt": since}}]}, {"_id": 0}
+        ).sort("timestamp", 1))
+    
+    def update_message(self, context_id: str, message_id: str, fields: dict) -> Optional[dict]:
+        return self.collection.find_one_and_update(
+            {"message_id": message_id, "$or": [{"conversation_id": context_id}, {"room_id": context_id}]},
+            {"$set": fields},
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+    
+    def delete_message(self, context_id: str, message_id: str) -> bool:
+        result = self.collection.delete_one({"message_id": message_id, "$or": [{"conversation_id": context_id}, {"room_id": context_id}]})
+        return result.deleted_count > 0
+    
+    def delete_conversation_messages(self, conversation_id: str, until: datetime):
+        self.collection.delete_many({"conversation_id": conversation_id, "room_id": None, "timestamp": {"$lte": until}})
+
+class BucketedMessageStore(MessageStore):
+    """Up to bucket_size messages per document, grouped by conversation and room.
+    
+    A bucket is ``{bucket_id, conversation_id, room_id, count, start, end,
+    messages}`` where start/end bound the timestamps inside it. New messages are
+    pushed onto any bucket of their conversation that still has room, so buckets
+    may overlap in time; reads sort the messages they unpack. bucket_id is the
+    id of the bucket's first message, which makes re-running a migration of the
+    same messages a no-op instead of a duplicate. Editing or deleting a message
+    stamps the bucket's updated_at so delta sync can find it.
+    """
+    
+    def __init__(self, collection, bucket_size: int):
+        self.collection = collection
+        self.bucket_size = bucket_size
+    
+    def ensure_indexes(self):
+        self.collection.create_index("bucket_id", unique=True)
+        self.collection.create_index([("conversation_id", 1), ("end", 1)])
+        self.collection.create_index([("room_id", 1), ("end", 1)])
+        self.collection.create_index([("conversation_id", 1), ("updated_at", 1)], sparse=True)
+    
+    def insert(self, message: dict):
+        message = {key: value for key, value in message.items() if key != "_id"}
+        self.collection.update_one(
+            {"conversation_id": message["conversation_id"], "room_id": message.get("room_id"), "count": {"$lt": self.bucket_size}},
+            {
+                "$push": {"messages": message},
+                "$inc": {"count": 1},
+                "$min": {"start": message["timestamp"]},
+                "$max": {"end": message["timestamp"]},
+                "$setOnInsert": {"bucket_id": message["message_id"]}
+            },
+            upsert=True
+        )
+    
+    def build_buckets(self, messages: List[dict]) -> List[dict]:
+        """Pack messages into full bucket documents, oldest first within each conversation"""
+        groups: Dict[tuple, List[dict]] = {}
+        for message in messages:
+            message = {key: value for key, value in message.items() if key != "_id"}
+            groups.setdefault((message["conversation_id"], message.get("room_id")), []).append(message)
+        buckets = []
+        for (conversation_id, room_id), group in groups.items():
+            group.sort(key=lambda message: message["timestamp"])
+            for offset in range(0, len(group), self.bucket_size):
+                chunk = group[offset:offset + self.bucket_size]
+                buckets.append({
+                    "bucket_id": chunk[0]["message_id"],
+                    "conversation_id": conversation_id,
+                    "room_id": room_id,
+                    "count": len(chunk),
+                    "start": chunk[0]["timestamp"],
+                    "end": chunk[-1]["timestamp"],
+                    "messages": chunk
+                })
+        return buckets
+    
+    def insert_many(self, messages: List[dict]) -> int:
+        buckets = self.build_buckets(messages)
+        if not buckets:
+            return 0
+        self.collection.insert_many(buckets, ordered=False)
+        return len(messages)
+    
+    def _unpack(self, query: dict) -> List[dict]:
+        messages = []
+        for bucket in self.collection.find(query, {"_id": 0, "messages": 1}).sort("end", 1):
+            messages.extend(bucket["messages"])
+        return sorted(messages, key=lambda message: message["timestamp"])
+    
+    def conversation_messages(self, conversation_id: str) -> List[dict]:
+        return self._unpack({"conversation_id": conversation_id})
+    
+    def iter_conversation_messages(self, conversation_id: str, batch_size: int = 1000):
+        buckets = self.collection.find(
+            {"conversation_id": conversation_id}, {"_id": 0, "messages": 1}
+        ).sort("end", 1).batch_size(max(1, batch_size // self.bucket_size))
+        for bucket in buckets:
+            yield from sorted(bucket["messages"], key=lambda message: message["timestamp"])
+    
+    def _latest(self, query: dict, limit: int, before: Optional[datetime] = None) -> List[dict]:
+        if before is not None:
+            query = {**query, "start": {"$lt": before}}
+        newest: List[dict] = []
+        cursor = self.collection.find(query, {"_id": 0, "end": 1, "messages": 1}).sort("end", -1)
+        for bucket in cursor:
+            # Once limit messages are in hand, a bucket that ends before the oldest
+            # of them cannot hold anything newer
+            if len(newest) >= limit and bucket["end"] < newest[limit - 1]["timestamp"]:
+                break
+            messages = bucket["messages"]
+            if before is not None:
+                messages = [message for message in messages if message["timestamp"] < before]
+            newest = sorted(newest + messages, key=lambda message: message["timestamp"], reverse=True)[:limit]
+        return newest
+    
+    def latest_conversation_messages(self, conversation_id: str, limit: int, before: Optional[datetime] = None) -> List[dict]:
+        return self._latest({"conversation_id": conversation_id}, limit, before)
+    
+    def room_messages(self, room_id: str) -> List[dict]:
+        return self._unpack({"room_id": room_id})
+    
+    def latest_room_messages(self, room_id: str, limit: int, before: Optional[datetime] = None) -> List[dict]:
+        return self._latest({"room_id": room_id}, limit, before)
+    
+    def find_by_ids(self, context_id: str, message_ids: List[str]) -> List[dict]:
+        wanted = set(message_ids)
+        buckets = self.collection.find(
+            {"$or": [{"conversation_id": context_id}, {"room_id": context_id}], "messages.message_id": {"$in": message_ids}},
+            {"_id": 0, "messages": 1}
+        )
+        return [message for bucket in buckets for message in bucket["messages"] if message["message_id"] in wanted]
+    
+    def changed_conversation_messages(self, conversation_id: str, since: datetime) -> List[dict]:
+        buckets = self.collection.find(
+            {"conversation_id": conversation_id, "$or": [{"end": {"$gt": since}}, {"updated_at": {"$gt": since}}]},
+            {"_id": 0, "messages": 1}
+        )
+        changed = [
+            message for bucket in buckets for message in bucket["messages"]
+            if message["timestamp"] > since or (message.get("edited_at") and message["edited_at"] > since)
+        ]
+        return sorted(changed, key=lambda message: message["timestamp"])
+    
+    def update_message(self, context_id: str, message_id: str, fields: dict) -> Optional[dict]:
+        bucket = self.collection.find_one_and_update(
+            {"$or": [{"conversation_id": context_id}, {"room_id": context_id}], "messages.message_id": message_id},
+            {"$set": {**{f"messages.$.{key}": value for key, value in fields.items()}, "updated_at": datetime.utcnow()}},
+            projection={"_id": 0, "messages": {"$elemMatch": {"message_id": message_id}}},
+            return_document=ReturnDocument.AFTER
+        )
+        return bucket["messages"][0] if bucket and bucket.get("messages") else None
+    
+    def delete_message(self, context_id: str, message_id: str) -> bool:
+        result = self.collection.update_one(
+            {"$or": [{"conversation_id": context_id}, {"room_id": context_id}], "messages.message_id": message_id},
+            {"$pull": {"messages": {"message_id": message_id}}, "$inc": {"count": -1}, "$set": {"updated_at": datetime.utcnow()}}
+        )
+        return result.modified_count > 0
+    
+    def delete_conversation_messages(self, conversation_id: str, until: datetime):
+        # A bucket still receiving newer messages is kept whole; readers merge away the overlap
+        self.collection.delete_many({"conversation_id": conversation_id, "room_id": None, "end": {"$lte": until}})
+
+class MigratingMessageStore(MessageStore):
+    """Writes to buckets and reads both layouts while migrate_messages_to_buckets runs"""
+    
+    def __init__(self, documents: DocumentMessageStore, buckets: BucketedMessageStore):
+        self.documents = documents
+        self.buckets = buckets
+    
+    def ensure_indexes(self):
+        self.documents.ensure_indexes()
+        self.buckets.ensure_indexes()
+    
+    def insert(self, message: dict):
+        self.buckets.insert(message)
+    
+    def insert_many(self, messages: List[dict]) -> int:
+        return self.buckets.insert_many(messages)
+    
+    def conversation_messages(self, conversation_id: str) -> List[dict]:
+        # A conversation caught mid-move can briefly be in both; merging drops the copies
+        return merge_messages(self.documents.conversation_messages(conversation_id), self.buckets.conversation_messages(conversation_id))
+    
+    def iter_conversation_messages(self, conversation_id: str, batch_size: int = 1000):
+        yield from self.conversation_messages(conversation_id)
+    
+    def latest_conversation_messages(self, conversation_id: str, limit: int, before: Optional[datetime] = None) -> List[dict]:
+        return merge_messages(
+            self.documents.latest_conversation_messages(conversation_id, limit, before),
+            self.buckets.latest_conversation_messages(conversation_id, limit, before),
+            newest_first=True
+        )[:limit]
+    
+    def room_messages(self, room_id: str) -> List[dict]:
+        return merge_messages(self.documents.room_messages(room_id), self.buckets.room_messages(room_id))
+    
+    def latest_room_messages(self, room_id: str, limit: int, before: Optional[datetime] = None) -> List[dict]:
+        return merge_messages(
+            self.documents.latest_room_messages(room_id, limit, before),
+            self.buckets.latest_room_messages(room_id, limit, before),
+            newest_first=True
+        )[:limit]
+    
+    def find_by_ids(self, context_id: str, message_ids: List[str]) -> List[dict]:
+        return merge_messages(self.documents.find_by_ids(context_id, message_ids), self.buckets.find_by_ids(context_id, message_ids))
+    
+    def changed_conversation_messages(self, conversation_id: str, since: datetime) -> List[dict]:
+        return merge_messages(
+            self.documents.changed_conversation_messages(conversation_id, since),
+            self.buckets.changed_conversation_messages(conversation_id, since)
+        )
+    
+    def update_message(self, context_id: str, message_id: str, fields: dict) -> Optional[dict]:
+        # Whichever layout holds it; mid-move it may briefly be in both
+        updated = self.buckets.update_message(context_id, message_id, fields)
+        return self.documents.update_message(context_id, message_id, fields) or updated
+    
+    def delete_message(self, context_id: str, message_id: str) -> bool:
+        deleted = self.buckets.delete_message(context_id, message_id)
+        return self.documents.delete_message(context_id, message_id) or deleted
+    
+    def delete_conversation_messages(self, conversation_id: str, until: datetime):
+        self.documents.delete_conversation_messages(conversation_id, until)
+        self.buckets.delete_conversation_messages(conversation_id, until)
+
+def create_message_store(layout: str) -> MessageStore:
+    if layout == "documents":
+        return DocumentMessageStore(messages_collection)
+    if layout == "buckets":
+        return BucketedMessageStore(message_buckets_collection, MESSAGE_BUCKET_SIZE)
+    if layout == "migrating":
+        return MigratingMessageStore(
+            DocumentMessageStore(messages_collection),
+            BucketedMessageStore(message_buckets_collection, MESSAGE_BUCKET_SIZE)
+        )
+    raise ValueError(f"Unknown message storage layout: {layout}")
+
+message_store: Optional[MessageStore] = None
+
+def migrate_messages_to_buckets(documents: DocumentMessageStore, buckets: BucketedMessageStore,
+                                pause: float = 0.0, progress=None) -> dict:
+    """Move per-message documents into buckets one conversation at a time.
+    
+    Safe to run against a live deployment once every worker uses the migrating
+    layout: new messages already go to buckets and reads merge both layouts.
+    A conversation is copied before its documents are deleted, and bucket ids
+    are deterministic, so an interrupted run can simply be started again.
+    """
+    buckets.ensure_indexes()
+    stats = {"conversations": 0, "messages": 0}
+    while True:
+        sample = documents.collection.find_one({}, {"conversation_id": 1, "room_id": 1})
+        if not sample:
+            return stats
+        key = {"conversation_id": sample.get("conversation_id"), "room_id": sample.get("room_id")}
+        messages = list(documents.collection.find(key).sort("timestamp", 1))
+        try:
+            buckets.insert_many(messages)
+        except BulkWriteError as e:
+            # Buckets left by an interrupted run; anything else is a real failure
+            if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                raise
+        documents.collection.delete_many({"_id": {"$in": [message["_id"] for message in messages]}})
+        stats["conversations"] += 1
+        stats["messages"] += len(messages)
+        if progress:
+            progress(stats)
+        if pause:
+            time.sleep(pause)
+
+# Cold storage archival
+ARCHIVE_LOCK_SECONDS = 300
+
+def ensure_archive_indexes():
+    message_archives_collection.create_index([("conversation_id", 1), ("chunk", 1)], unique=True)
+    conversations_collection.create_index([("archived_at", 1), ("updated_at", 1)])
+
+def claim_conversation_archive(conversation_id: str, query: dict) -> Optional[dict]:
+    """Take the short lease that keeps archiving and rehydration of one conversation from overlapping"""
+    now = datetime.utcnow()
+    return conversations_collection.find_one_and_update(
+        {
+            "conversation_id": conversation_id,
+            "$or": [{"archive_lock_until": {"$exists": False}}, {"archive_lock_until": {"$lt": now}}],
+            **query
+        },
+        {"$set": {"archive_lock_until": now + timedelta(seconds=ARCHIVE_LOCK_SECONDS)}},
+        projection={"_id": 0}
+    )
+
+def archive_conversation(conversation_id: str, cutoff: datetime) -> Optional[dict]:
+    """Compress an idle conversation's messages into archive chunks and drop them from hot storage.
+    
+    Chunks are zstd-compressed runs of BSON documents, so messages come back with
+    their original types. Returns the archive stats, or None if the conversation
+    turned out to be active or is being handled by another worker.
+    """
+    import zstandard
+    import bson
+    
+    if not claim_conversation_archive(conversation_id, {"archived_at": None}):
+        return None
+    try:
+        messages = [message for message in message_store.conversation_messages(conversation_id) if not message.get("room_id")]
+        if not messages or messages[-1]["timestamp"] >= cutoff:
+            if messages:
+                # Chat doesn't touch updated_at; record the activity so this conversation isn't picked again
+                conversations_collection.update_one({"conversation_id": conversation_id}, {"$max": {"updated_at": messages[-1]["timestamp"]}})
+            return None
+        
+        compressor = zstandard.ZstdCompressor(level=ARCHIVE_ZSTD_LEVEL)
+        now = datetime.utcnow()
+        chunks = []
+        for offset in range(0, len(messages), ARCHIVE_CHUNK_MESSAGES):
+            batch = messages[offset:offset + ARCHIVE_CHUNK_MESSAGES]
+            raw = b"".join(bson.encode(message) for message in batch)
+            data = compressor.compress(raw)
+            chunks.append({
+                "conversation_id": conversation_id,
+                "chunk": len(chunks),
+                "codec": "zstd",
+                "count": len(batch),
+                "start": batch[0]["timestamp"],
+                "end": batch[-1]["timestamp"],
+                "raw_bytes": len(raw),
+                "stored_bytes": len(data),
+                "data": data,
+                "archived_at": now
+            })
+        stats = {
+            "messages": len(messages),
+            "chunks": len(chunks),
+            "raw_bytes": sum(chunk["raw_bytes"] for chunk in chunks),
+            "stored_bytes": sum(chunk["stored_bytes"] for chunk in chunks)
+        }
+        
+        # Chunks first, then the flag, then the hot copies: a reader that finds the
+        # hot messages gone will always find the flag and the chunks in place
+        message_archives_collection.delete_many({"conversation_id": conversation_id})
+        message_archives_collection.insert_many(chunks)
+        conversations_collection.update_one({"conversation_id": conversation_id}, {"$set": {"archived_at": now, "archive": stats}})
+        conversation_context_cache.invalidate(conversation_id)
+        message_store.delete_conversation_messages(conversation_id, messages[-1]["timestamp"])
+        return stats
+    finally:
+        conversations_collection.update_one({"conversation_id": conversation_id}, {"$unset": {"archive_lock_until": ""}})
+
+def load_archived_messages(conversation_id: str) -> List[dict]:
+    import zstandard
+    import bson
+    
+    decompressor = zstandard.ZstdDecompressor()
+    messages = []
+    for chunk in message_archives_collection.find({"conversation_id": conversation_id}, {"_id": 0, "data": 1}).sort("chunk", 1):
+        messages.extend(bson.decode_all(decompressor.decompress(chunk["data"])))
+    for message in messages:
+        message.pop("_id", None)
+    return messages
+
+def rehydrate_conversation(conversation_id: str) -> bool:
+    """Move an archived conversation back into hot storage, returning False if another worker holds it"""
+    if not claim_conversation_archive(conversation_id, {"archived_at": {"$ne": None}}):
+        return False
+    try:
+        # Skip anything already restored by a rehydration that was interrupted part way
+        hot_ids = {message["message_id"] for message in message_store.conversation_messages(conversation_id)}
+        missing = [message for message in load_archived_messages(conversation_id) if message["message_id"] not in hot_ids]
+        if missing:
+            message_store.insert_many(missing)
+        # Reopening counts as activity, so the archiver leaves it alone for another idle period
+        conversations_collection.update_one(
+            {"conversation_id": conversation_id},
+            {"$unset": {"archived_at": "", "archive": ""}, "$set": {"updated_at": datetime.utcnow()}}
+        )
+        conversation_context_cache.invalidate(conversation_id)
+        message_archives_collection.delete_many({"conversation_id": conversation_id})
+        return True
+    finally:
+        conversations_collection.update_one({"conversation_id": conversation_id}, {"$unset": {"archive_lock_until": ""}})
+
+def load_conversation_messages(conversation_id: str) -> List[dict]:
+    """Read a conversation's history, rehydrating it first if it was archived"""
+    # Hot read before the flag check: if the archiver removes the hot copies in
+    # between, the flag it set beforehand sends us to the chunks
+    messages = message_store.conversation_messages(conversation_id)
+    conversation = conversations_collection.find_one({"conversation_id": conversation_id}, {"_id": 0, "archived_at": 1})
+    if not conversation or not conversation.get("archived_at"):
+        return messages
+    rehydrate_conversation(conversation_id)
+    # Chunks are deleted only after their messages are hot again, so reading them first misses nothing
+    archived = load_archived_messages(conversation_id)
+    return merge_messages(archived, message_store.conversation_messages(conversation_id))
+
+def latest_conversation_page(conversation_id: str, limit: int, before: Optional[datetime] = None) -> List[dict]:
+    """Up to limit of the conversation's newest messages sent before before, newest first, archived ones included"""
+    messages = message_store.latest_conversation_messages(conversation_id, limit, before)
+    conversation = conversations_collection.find_one({"conversation_id": conversation_id}, {"_id": 0, "archived_at": 1})
+    if not conversation or not conversation.get("archived_at"):
+        return messages
+    history = load_conversation_messages(conversation_id)
+    return [message for message in reversed(history) if before is None or message["timestamp"] < before][:limit]
+
+# Delta sync
+def encode_sync_token(position: datetime) -> str:
+    millis = int((position - datetime(1970, 1, 1)).total_seconds() * 1000)
+    return base64.urlsafe_b64encode(json.dumps({"v": 1, "t": millis}).encode()).decode().rstrip("=")
+
+def decode_sync_token(token: str) -> datetime:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        return datetime(1970, 1, 1) + timedelta(milliseconds=int(payload["t"]))
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid sync token")
+
+def ensure_sync_indexes():
+    message_tombstones_collection.create_index([("conversation_id", 1), ("deleted_at", 1)])
+    message_tombstones_collection.create_index("expires_at", expireAfterSeconds=0)
+
+def record_message_tombstone(message: dict, deleted_at: datetime):
+    message_tombstones_collection.insert_one({
+        "message_id": message["message_id"],
+        "conversation_id": message["conversation_id"],
+        "room_id": message.get("room_id"),
+        "deleted_at": deleted_at,
+        "expires_at": deleted_at + timedelta(days=SYNC_TOMBSTONE_DAYS)
+    })
+
+def sync_conversation_messages(conversation_id: str, token: Optional[str]) -> dict:
+    """Changes to a conversation's messages since token, or its whole history when a full resync is needed.
+    
+    The new token trails the server clock by SYNC_OVERLAP_SECONDS so a message
+    timestamped just before the read but stored just after it, or written by a
+    worker with a slightly slow clock, is still picked up next time. Clients
+    therefore see some changes twice and should apply them by message_id.
+    """
+    now = datetime.utcnow()
+    next_token = encode_sync_token(now - timedelta(seconds=SYNC_OVERLAP_SECONDS))
+    since = decode_sync_token(token) if token else None
+    if since is None or since < now - timedelta(days=SYNC_TOMBSTONE_DAYS):
+        # No token, or older than the tombstones that would tell it about deletions
+        return {"reset": True, "messages": load_conversation_messages(conversation_id), "deleted": [], "sync_token": next_token}
+    
+    # Archiving moves messages without changing them, so hot storage holds every change
+    messages = message_store.changed_conversation_messages(conversation_id, since)
+    deleted = list(message_tombstones_collection.find(
+        {"conversation_id": conversation_id, "deleted_at": {"$gt": since}}, {"_id": 0, "message_id": 1, "deleted_at": 1}
+    ).sort("deleted_at", 1))
+    return {"reset": False, "messages": messages, "deleted": deleted, "sync_token": next_token}
+
+def archive_idle_conversations(limit: int = None) -> dict:
+    """Archive up to limit conversations with no activity for ARCHIVE_IDLE_DAYS"""
+    cutoff = datetime.utcnow() - timedelta(days=ARCHIVE_IDLE_DAYS)
+    candidates = conversations_collection.find(
+        {"archived_at": None, "updated_at": {"$lt": cutoff}}, {"_id": 0, "conversation_id": 1}
+    ).sort("updated_at", 1).limit(limit or ARCHIVE_BATCH_CONVERSATIONS)
+    totals = {"conversations": 0, "messages": 0, "raw_bytes": 0, "stored_bytes": 0}
+    for candidate in list(candidates):
+        stats = archive_conversation(candidate["conversation_id"], cutoff)
+        if stats:
+            totals["conversations"] += 1
+            for key in ("messages", "raw_bytes", "stored_bytes"):
+                totals[key] += stats[key]
+    return totals
+
+def archive_storage_stats() -> dict:
+    """Totals across all archive chunks, including bytes saved versus hot storage"""
+    totals = next(message_archives_collection.aggregate([
+        {"$group": {
+            "_id": None,
+            "conversations": {"$addToSet": "$conversation_id"},
+            "chunks": {"$sum": 1},
+            "messages": {"$sum": "$count"},
+            "raw_bytes": {"$sum": "$raw_bytes"},
+            "stored_bytes": {"$sum": "$stored_bytes"}
+        }}
+    ]), None)
+    if not totals:
+        return {"conversations": 0, "chunks": 0, "messages": 0, "raw_bytes": 0, "stored_bytes": 0, "saved_bytes": 0, "compression_ratio": None}
+    return {
+        "conversations": len(totals["conversations"]),
+        "chunks": totals["chunks"],
+        "messages": totals["messages"],
+        "raw_bytes": totals["raw_bytes"],
+        "stored_bytes": totals["stored_bytes"],
+        "saved_bytes": totals["raw_bytes"] - totals["stored_bytes"],
+        "compression_ratio": round(totals["raw_bytes"] / totals["stored_bytes"], 2) if totals["stored_bytes"] else None
+    }
+
+async def archive_loop():
+    while True:
+        await asyncio.sleep(ARCHIVE_INTERVAL_SECONDS)
+        try:
+            totals = await run_db(archive_idle_conversations)
+            if totals["conversations"]:
+                print(f"Archived {totals['messages']} messages from {totals['conversations']} conversations, "
+                      f"saving {totals['raw_bytes'] - totals['stored_bytes']} bytes")
+        except Exception as e:
+            print(f"Archive error: {e}")
+
+# Long-term memory
+_TOKEN_PATTERN = re.compile(r"[a-z0-9']+")
+
+def embed_text(text: str, dim: int = MEMORY_EMBEDDING_DIM) -> np.ndarray:
+    """Embed text as an L2-normalised signed feature-hashing vector of its words and word bigrams"""
+    vector = np.zeros(dim, dtype=np.float32)
+    tokens = _TOKEN_PATTERN.findall(text.lower())
+    features = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+    for feature in features:
+        digest = zlib.crc32(feature.encode("utf-8"))
+        vector[digest % dim] += 1.0 if digest & 0x80000000 else -1.0
+    norm = np.linalg.norm(vector)
+    if norm > 0:
+        vector /= norm
+    return vector
+
+class ConversationMemoryIndex:
+    """Append-only vector index for one conversation, memory-mapped from disk.
+    
+    Vectors live in ``<id>.f32`` as a float32 matrix whose capacity doubles as it
+    fills; ``<id>.ids`` holds the matching message ids, one per line, and is the
+    source of truth for how many rows are in use.
+    
+    Several worker processes may open the same index. Writers take an exclusive
+    flock on ``<id>.lock`` and first catch up on rows other processes appended,
+    so each row number is handed out once. A vector is written before its id, so
+    readers can pick up new complete id lines without taking the lock.
+    """
+    
+    def __init__(self, directory: str, context_id: str, dim: int = MEMORY_EMBEDDING_DIM):
+        self.dim = dim
+        self.vectors_path = os.path.join(directory, f"{context_id}.f32")
+        self.ids_path = os.path.join(directory, f"{context_id}.ids")
+        self.lock_path = os.path.join(directory, f"{context_id}.lock")
+        self.lock = threading.Lock()
+        self.message_ids: List[str] = []
+        self.vectors: Optional[np.memmap] = None
+        self._ids_offset = 0  # bytes of the ids file already read into message_ids
+        
+        with self._exclusive():
+            self._refresh()
+            # A crash between the vector and id writes can leave ids the matrix cannot back
+            if len(self.message_ids) > self.capacity:
+                self.message_ids = self.message_ids[:self.capacity]
+                with open(self.ids_path, "w", encoding="utf-8") as ids_file:
+                    ids_file.write("".join(f"{message_id}\n" for message_id in self.message_ids))
+                self._ids_offset = os.path.getsize(self.ids_path)
+    
+    @property
+    def capacity(self) -> int:
+        return 0 if self.vectors is None else self.vectors.shape[0]
+    
+    def __len__(self) -> int:
+        return len(self.message_ids)
+    
+    def _map(self, rows: int):
+        self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r+", shape=(rows, self.dim))
+    
+    @contextmanager
+    def _exclusive(self):
+        """Hold this index's thread lock and its cross-process file lock"""
+        with self.lock, open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+    
+    def _refresh(self):
+        """Pick up rows other processes appended since this one last looked"""
+        size = os.path.getsize(self.ids_path) if os.path.exists(self.ids_path) else 0
+        if size > self._ids_offset:
+            with open(self.ids_path, "rb") as ids_file:
+                ids_file.seek(self._ids_offset)
+                data = ids_file.read(size - self._ids_offset)
+            # A line still being written is left for the next look
+            complete = data[:data.rfind(b"\n") + 1]
+            self._ids_offset += len(complete)
+            self.message_ids.extend(line.decode("utf-8") for line in complete.split(b"\n") if line.strip())
+        rows = os.path.getsize(self.vectors_path) // (4 * self.dim) if os.path.exists(self.vectors_path) else 0
+        if rows > self.capacity:
+            self._map(rows)
+    
+    def _reserve(self, rows: int):
+        if rows <= self.capacity:
+            return
+        new_capacity = max(rows, self.capacity * 2, 1024)
+        if self.vectors is not None:
+            self.vectors.flush()
+            self.vectors = None
+        with open(self.vectors_path, "ab") as vectors_file:
+            vectors_file.truncate(new_capacity * self.dim * 4)
+        self._map(new_capacity)
+    
+    def add_many(self, message_ids: List[str], vectors: np.ndarray):
+        """Append embeddings for the given message ids"""
+        if not message_ids:
+            return
+        with self._exclusive():
+            self._refresh()
+            start = len(self.message_ids)
+            self._reserve(start + len(message_ids))
+            self.vectors[start:start + len(message_ids)] = vectors
+            self.vectors.flush()
+            with open(self.ids_path, "a", encoding="utf-8") as ids_file:
+                ids_file.write("".join(f"{message_id}\n" for message_id in message_ids))
+            self._ids_offset = os.path.getsize(self.ids_path)
+            self.message_ids.extend(message_ids)
+    
+    def warm(self):
+        """Fault the rows in use into the page cache ahead of the first search"""
+        with self.lock:
+            self._refresh()
+            if self.message_ids:
+                np.asarray(self.vectors[:len(self.message_ids)]).sum()
+    
+    def search(self, query: np.ndarray, k: int = MEMORY_TOP_K, min_score: float = MEMORY_MIN_SCORE) -> List[tuple]:
+        """Return up to k (message_id, score) pairs ordered by cosine similarity"""
+        with self.lock:
+            self._refresh()
+            count = len(self.message_ids)
+            if count == 0 or k <= 0:
+                return []
+            scores = np.asarray(self.vectors[:count] @ query)
+            wanted = min(count, k)
+            top = np.argpartition(-scores, wanted - 1)[:wanted]
+            top = top[np.argsort(-scores[top])]
+            return [(self.message_ids[row], float(scores[row])) for row in top if scores[row] >= min_score]
+
+_memory_indexes: "OrderedDict[str, ConversationMemoryIndex]" = OrderedDict()
+_memory_indexes_lock = threading.Lock()
+
+def get_memory_index(context_id: str) -> ConversationMemoryIndex:
+    """Open (or reuse) the memory index for a conversation or room"""
+    with _memory_indexes_lock:
+        index = _memory_indexes.get(context_id)
+        if index is not None:
+            _memory_indexes.move_to_end(context_id)
+            return index
+        os.makedirs(MEMORY_DIR, exist_ok=True)
+        index = ConversationMemoryIndex(MEMORY_DIR, context_id)
+        _memory_indexes[context_id] = index
+        while len(_memory_indexes) > MEMORY_MAX_OPEN_INDEXES:
+            _memory_indexes.popitem(last=False)
+        return index
+
+def remember_messages(context_id: str, messages: List[dict]):
+    """Embed stored messages into the conversation's long-term memory"""
+    if not messages:
+        return
+    vectors = np.stack([embed_text(message["content"]) for message in messages])
+    get_memory_index(context_id).add_many([message["message_id"] for message in messages], vectors)
+
+def recall_memories(context_id: str, text: str, k: int = MEMORY_TOP_K) -> List[dict]:
+    """Fetch the k stored messages most relevant to text, most relevant first"""
+    matches = get_memory_index(context_id).search(embed_text(text), k=k)
+    if not matches:
+        return []
+    found = {
+        message["message_id"]: message
+        for message in message_store.find_by_ids(context_id, [message_id for message_id, _ in matches])
+    }
+    return [found[message_id] for message_id, _ in matches if message_id in found]
+
+def create_character_system_prompt(character: dict, mode: str = "casual", persona: Optional[dict] = None, memories: Optional[List[dict]] = None) -> str:
     """Create a system prompt for the character based on mode and user persona"""
     base_prompt = f"""You are {character['name']}, a character in Character VR RP with the following traits:
 
@@ -251,10 +1286,1391 @@ You are chatting with {persona['name']}:
 
 Please keep this persona in mind when responding, but respond naturally as your character {character['name']}."""
     
+    # Add long-term memories recalled from earlier in the conversation
+    if memories:
+        base_prompt += "\n\nRELEVANT MEMORIES FROM EARLIER IN THIS CONVERSATION:"
+        for memory in memories:
+            speaker = character['name'] if memory.get('sender') == "character" else "User"
+            base_prompt += f"\n- {speaker}: {memory['content']}"
+        base_prompt += "\n\nUse these memories for continuity when they are relevant."
+    
     return base_prompt
 
+class TTLCache:
+    """Small thread-safe LRU cache whose entries expire ttl seconds after being set"""
+    
+    def __init__(self, ttl: float, max_entries: int = 10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Any, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+    
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+# Single-flight reads
+class SingleFlight:
+    """Lets concurrent identical reads share one in-flight call.
+    
+    The first caller for a key starts the call as its own task; callers that
+    arrive before it finishes await the same task. Shielding means a caller that
+    gives up doesn't cancel the read for the others, and when a result was shared
+    every caller gets its own copy, since handlers decorate what they return.
+    The task runs in a fresh context so it isn't bound by the first caller's
+    request deadline; each caller instead waits only as long as its own allows.
+    """
+    
+    def __init__(self):
+        self._inflight: Dict[tuple, list] = {}
+        self.stats: Dict[str, Dict[str, int]] = {}
+    
+    async def do(self, key: tuple, func, *args, **kwargs):
+        counters = self.stats.setdefault(key[0], {"calls": 0, "executed": 0, "coalesced": 0})
+        counters["calls"] += 1
+        entry = self._inflight.get(key)
+        if entry is None:
+            task = asyncio.get_running_loop().create_task(func(*args, **kwargs), context=contextvars.Context())
+            entry = self._inflight[key] = [task, 0]
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+            counters["executed"] += 1
+        else:
+            entry[1] += 1
+            counters["coalesced"] += 1
+        try:
+            result = await asyncio.wait_for(asyncio.shield(entry[0]), deadline_remaining())
+        except asyncio.TimeoutError:
+            raise deadline_exceeded()
+        return copy.deepcopy(result) if entry[1] else result
+    
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        return {kind: dict(counters) for kind, counters in self.stats.items()}
+
+single_flight = SingleFlight()
+
+async def load_character(character_id: str) -> Optional[dict]:
+    return await single_flight.do(("character", character_id), run_db, characters_collection.find_one, {"character_id": character_id}, {"_id": 0})
+
+async def load_room(room_id: str) -> Optional[dict]:
+    return await single_flight.do(("room", room_id), run_db, multiplayer_rooms_collection.find_one, {"room_id": room_id}, {"_id": 0})
+
+async def load_persona(persona_id: str, user_id: str) -> Optional[dict]:
+    return await single_flight.do(
+        ("persona", persona_id, user_id), run_db, personas_collection.find_one, {"persona_id": persona_id, "user_id": user_id}, {"_id": 0}
+    )
+
+async def load_default_persona(user: dict) -> Optional[dict]:
+    # Only callers holding the same user document share a result; a newer pointer or version resolves separately
+    key = ("default_persona", user["user_id"], user.get("default_persona_id"), user.get("persona_version", 0))
+    return await single_flight.do(key, run_db, resolve_default_persona, user)
+
+# Default persona resolution
+_NOT_CACHED = object()
+default_persona_cache = TTLCache(PERSONA_CACHE_TTL_SECONDS)
+
+def set_default_persona_pointer(user_id: str, persona_id: str):
+    """Point the user at their new default persona in a single write"""
+    users_collection.update_one({"user_id": user_id}, {"$set": {"default_persona_id": persona_id}})
+    default_persona_cache.invalidate(user_id)
+
+def touch_personas(user_id: str):
+    """Call after any other write to the user's personas so every worker's cached default goes stale"""
+    users_collection.update_one({"user_id": user_id}, {"$inc": {"persona_version": 1}})
+    default_persona_cache.invalidate(user_id)
+
+def resolve_default_persona(user: dict) -> Optional[dict]:
+    """Resolve the user's default persona, served from cache after the first lookup"""
+    user_id = user["user_id"]
+    pointer = user.get("default_persona_id")
+    version = user.get("persona_version", 0)
+    cached = default_persona_cache.get(user_id, _NOT_CACHED)
+    # The user document is read fresh per request, so a pointer moved or a persona
+    # written by another worker shows up here, cached "no persona" included
+    if cached is not _NOT_CACHED and cached[0] == (pointer, version):
+        return dict(cached[1]) if cached[1] else None
+    
+    persona = None
+    if pointer:
+        persona = personas_collection.find_one({"persona_id": pointer, "user_id": user_id}, {"_id": 0})
+    if not persona:
+        # Users from before the pointer existed: adopt the flagged (or first) persona
+        persona = personas_collection.find_one({"user_id": user_id, "is_default": True}, {"_id": 0}) \
+            or personas_collection.find_one({"user_id": user_id}, {"_id": 0})
+        if persona:
+            users_collection.update_one({"user_id": user_id}, {"$set": {"default_persona_id": persona["persona_id"]}})
+            pointer = persona["persona_id"]
+    
+    if persona:
+        persona["is_default"] = True
+    default_persona_cache.set(user_id, ((pointer, version), persona))
+    return dict(persona) if persona else None
+
+def mark_default_persona(personas: List[dict], default_persona: Optional[dict]) -> List[dict]:
+    """Set is_default on persona documents from the user's default pointer"""
+    default_id = default_persona["persona_id"] if default_persona else None
+    for persona in personas:
+        persona["is_default"] = persona["persona_id"] == default_id
+    return personas
+
+# Conversation prewarming
+conversation_context_cache = TTLCache(PREWARM_TTL_SECONDS)
+recent_chat_contexts = TTLCache(PREWARM_TTL_SECONDS)
+_prewarm_tasks: set = set()
+
+class LatencyRecorder:
+    """Recent latency samples per label, summarised as percentiles"""
+    
+    def __init__(self, max_samples: int = 1000):
+        self.max_samples = max_samples
+        self._samples: Dict[str, deque] = {}
+        self._counts: Dict[str, int] = {}
+    
+    def record(self, label: str, seconds: float):
+        self._samples.setdefault(label, deque(maxlen=self.max_samples)).append(seconds * 1000)
+        self._counts[label] = self._counts.get(label, 0) + 1
+    
+    def snapshot(self) -> Dict[str, dict]:
+        summary = {}
+        for label, samples in self._samples.items():
+            ordered = sorted(samples)
+            summary[label] = {
+                "count": self._counts[label],
+                "p50_ms": round(ordered[len(ordered) // 2], 1),
+                "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 1),
+                "mean_ms": round(sum(ordered) / len(ordered), 1)
+            }
+        return summary
+
+chat_latency = LatencyRecorder()
+
+def chat_latency_label(context_id: str) -> str:
+    """Classify a chat turn as the first in its context (prewarmed or cold) or a later one"""
+    if recent_chat_contexts.get(context_id):
+        label = "later_messages"
+    elif conversation_context_cache.get(context_id) is not None:
+        label = "first_message_prewarmed"
+    else:
+        label = "first_message_cold"
+    recent_chat_contexts.set(context_id, True)
+    return label
+
+class CancellationStats:
+    """Chat turns whose provider call was cancelled because the client disconnected.
+    
+    The LLM integration doesn't report usage, so the completion a cancelled call
+    would have produced is estimated as the mean completion of the same model's
+    finished turns in this process.
+    """
+    
+    def __init__(self):
+        self.cancelled = 0
+        self.tokens_saved = 0
+        self.cost_saved_usd = 0.0
+        self._completions: Dict[tuple, List[int]] = {}  # (provider, model) -> [turns, completion tokens]
+    
+    def observe(self, provider: str, model: str, completion_tokens: int):
+        totals = self._completions.setdefault((provider, model), [0, 0])
+        totals[0] += 1
+        totals[1] += completion_tokens
+    
+    def record_cancelled(self, provider: str, model: str) -> int:
+        turns, tokens = self._completions.get((provider, model), (0, 0))
+        saved = round(tokens / turns) if turns else 0
+        self.cancelled += 1
+        self.tokens_saved += saved
+        self.cost_saved_usd += estimate_cost(provider, model, 0, saved) or 0.0
+        return saved
+    
+    def snapshot(self) -> dict:
+        return {
+            "cancelled": self.cancelled,
+            "estimated_completion_tokens_saved": self.tokens_saved,
+            "estimated_cost_saved_usd": round(self.cost_saved_usd, 6)
+        }
+
+chat_cancellations = CancellationStats()
+
+async def load_conversation_context(conversation_id: str) -> tuple:
+    """Conversation and character for a chat turn, from the prewarm cache when possible"""
+    cached = conversation_context_cache.get(conversation_id)
+    if cached is not None:
+        return copy.deepcopy(cached)
+    conversation = await run_db(conversations_collection.find_one, {"conversation_id": conversation_id}, {"_id": 0})
+    character = await load_character(conversation["character_id"]) if conversation else None
+    if conversation and character:
+        conversation_context_cache.set(conversation_id, (conversation, character))
+    return conversation, character
+
+async def prewarm_conversation(conversation_id: str, user: Optional[dict], conversation: Optional[dict] = None,
+                               character: Optional[dict] = None):
+    """Load what the first chat turn would otherwise fetch or initialise itself"""
+    try:
+        if conversation and character:
+            conversation_context_cache.set(conversation_id, copy.deepcopy((conversation, character)))
+        else:
+            conversation, character = await load_conversation_context(conversation_id)
+            if not conversation:
+                return
+        if user:
+            await load_default_persona(user)
+        await asyncio.to_thread(lambda: get_memory_index(conversation_id).warm())
+        if get_api_key(conversation.get("ai_provider") or "openai"):
+            await asyncio.to_thread(load_llm_integration)
+    except Exception as e:
+        print(f"Prewarm error for {conversation_id}: {e}")
+
+def schedule_prewarm(conversation_id: str, user: Optional[dict], conversation: Optional[dict] = None,
+                     character: Optional[dict] = None):
+    # Fire and forget; the set keeps a reference until the task finishes. A fresh
+    # context keeps the scheduling request's deadline from cutting the prewarm short
+    task = asyncio.get_running_loop().create_task(
+        prewarm_conversation(conversation_id, user, conversation, character), context=contextvars.Context()
+    )
+    _prewarm_tasks.add(task)
+    task.add_done_callback(_prewarm_tasks.discard)
+
+# Session store
+class SessionStore(ABC):
+    """Storage backend for login sessions keyed by session_id"""
+    
+    def ensure_indexes(self):
+        pass
+    
+    @abstractmethod
+    def get(self, session_id: str) -> Optional[dict]:
+        ...
+    
+    @abstractmethod
+    def put(self, session: dict):
+        """Insert or replace the session with the same session_id"""
+    
+    @abstractmethod
+    def renew(self, session_id: str, expires_at: datetime, renewed_at: datetime):
+        ...
+    
+    @abstractmethod
+    def delete(self, session_id: str):
+        ...
+    
+    @abstractmethod
+    def sweep_expired(self, now: datetime) -> int:
+        """Remove sessions that expired before now, returning how many were removed"""
+
+class MongoSessionStore(SessionStore):
+    def __init__(self, collection):
+        self.collection = collection
+    
+    def ensure_indexes(self):
+        # The index used to be non-unique, so racing upserts may have left duplicate
+        # rows; collapse them once before the unique build, which would fail on them
+        index = self.collection.index_information().get("session_id_1")
+        if index is not None and not index.get("unique"):
+            self.dedupe()
+            self.collection.drop_index("session_id_1")
+        self.collection.create_index("session_id", unique=True)
+        # Mongo's TTL monitor also removes expired sessions between our sweeps
+        self.collection.create_index("expires_at", expireAfterSeconds=0)
+    
+    def get(self, session_id: str) -> Optional[dict]:
+        return self.collection.find_one({"session_id": session_id}, {"_id": 0})
+    
+    def put(self, session: dict):
+        self.collection.replace_one({"session_id": session["session_id"]}, session, upsert=True)
+    
+    def renew(self, session_id: str, expires_at: datetime, renewed_at: datetime):
+        self.collection.update_one({"session_id": session_id}, {"$set": {"expires_at": expires_at, "renewed_at": renewed_at}})
+    
+    def delete(self, session_id: str):
+        self.collection.delete_one({"session_id": session_id})
+    
+    def sweep_expired(self, now: datetime) -> int:
+        return self.collection.delete_many({"expires_at": {"$lt": now}}).deleted_count
+    
+    def dedupe(self) -> int:
+        """Keep the longest-lived row of each session_id, returning how many duplicates were removed"""
+        duplicates = self.collection.aggregate([
+            {"$sort": {"expires_at": -1}},
+            {"$group": {"_id": "$session_id", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+            {"$match": {"count": {"$gt": 1}}}
+        ], allowDiskUse=True)
+        removed = 0
+        for group in duplicates:
+            removed += self.collection.delete_many({"_id": {"$in": group["ids"][1:]}}).deleted_count
+        return removed
+
+class InMemorySessionStore(SessionStore):
+    """Process-local sessions for single-node deployments"""
+    
+    def __init__(self):
+        self._sessions: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+    
+    def get(self, session_id: str) -> Optional[dict]:
+        with self._lock:
+            session = self._sessions.get(session_id)
+            return dict(session) if session else None
+    
+    def put(self, session: dict):
+        with self._lock:
+            self._sessions[session["session_id"]] = dict(session)
+    
+    def renew(self, session_id: str, expires_at: datetime, renewed_at: datetime):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session:
+                session["expires_at"] = expires_at
+                session["renewed_at"] = renewed_at
+    
+    def delete(self, session_id: str):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+    
+    def sweep_expired(self, now: datetime) -> int:
+        with self._lock:
+            expired = [session_id for session_id, session in self._sessions.items() if session["expires_at"] < now]
+            for session_id in expired:
+                del self._sessions[session_id]
+            return len(expired)
+
+def create_session_store(backend: str) -> SessionStore:
+    if backend == "memory":
+        return InMemorySessionStore()
+    if backend == "mongo":
+        return MongoSessionStore(sessions_collection)
+    raise ValueError(f"Unknown session store backend: {backend}")
+
+session_store: Optional[SessionStore] = None
+
+async def session_sweep_loop():
+    # Runs in the background so an unreachable database can't hold up startup
+    try:
+        await run_db(session_store.ensure_indexes)
+    except Exception as e:
+        print(f"Session index setup error: {e}")
+    while True:
+        try:
+            removed = await run_db(session_store.sweep_expired, datetime.utcnow())
+            if removed:
+                print(f"Removed {removed} expired sessions")
+        except Exception as e:
+            print(f"Session sweep error: {e}")
+        await asyncio.sleep(SESSION_SWEEP_SECONDS)
+
+# Room presence
+class PresenceRegistry:
+    """In-memory record of who is online in each room on this worker.
+    
+    Heartbeats only touch memory; share_presence() publishes them to
+    room_presence, and reconcile_presence() pulls participants that no worker
+    has published within the TTL.
+    """
+    
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._rooms: Dict[str, Dict[str, float]] = {}
+    
+    def heartbeat(self, room_id: str, user_id: str):
+        self._rooms.setdefault(room_id, {})[user_id] = time.monotonic()
+    
+    def is_tracked(self, room_id: str, user_id: str) -> bool:
+        return user_id in self._rooms.get(room_id, {})
+    
+    def leave(self, room_id: str, user_id: str):
+        members = self._rooms.get(room_id)
+        if members is not None:
+            members.pop(user_id, None)
+            if not members:
+                del self._rooms[room_id]
+    
+    def _expire(self, room_id: str):
+        members = self._rooms.get(room_id)
+        if not members:
+            return
+        cutoff = time.monotonic() - self.ttl
+        for user_id in [user_id for user_id, last_seen in members.items() if last_seen < cutoff]:
+            del members[user_id]
+        if not members:
+            del self._rooms[room_id]
+    
+    def online(self, room_id: str) -> List[str]:
+        self._expire(room_id)
+        return sorted(self._rooms.get(room_id, {}))
+    
+    def sweep(self):
+        for room_id in list(self._rooms):
+            self._expire(room_id)
+    
+    def snapshot(self) -> List[tuple]:
+        """(room_id, user_id, last seen as UTC) for everyone online on this worker"""
+        self.sweep()
+        now, wall_now = time.monotonic(), datetime.utcnow()
+        return [
+            (room_id, user_id, wall_now - timedelta(seconds=now - last_seen))
+            for room_id, members in self._rooms.items()
+            for user_id, last_seen in members.items()
+        ]
+
+presence_registry = PresenceRegistry(PRESENCE_TTL_SECONDS)
+
+def ensure_presence_indexes():
+    room_presence_collection.create_index([("room_id", 1), ("user_id", 1)], unique=True)
+    room_presence_collection.create_index("expires_at", expireAfterSeconds=0)
+
+def record_presence(room_id: str, user_id: str):
+    """Publish one user as seen now, so other workers count them before this worker next shares"""
+    now = datetime.utcnow()
+    room_presence_collection.update_one(
+        {"room_id": room_id, "user_id": user_id},
+        {"$max": {"last_seen": now, "expires_at": now + timedelta(seconds=PRESENCE_TTL_SECONDS * 10)}},
+        upsert=True
+    )
+
+async def share_presence():
+    """Publish who is online on this worker to room_presence in one bulk write"""
+    online = presence_registry.snapshot()
+    if not online:
+        return
+    operations = [
+        UpdateOne(
+            {"room_id": room_id, "user_id": user_id},
+            {"$max": {"last_seen": last_seen, "expires_at": last_seen + timedelta(seconds=PRESENCE_TTL_SECONDS * 10)}},
+            upsert=True
+        )
+        for room_id, user_id, last_seen in online
+    ]
+    await run_db(room_presence_collection.bulk_write, operations, ordered=False)
+
+async def online_participants(room_ids: List[str]) -> Dict[str, List[str]]:
+    """Users online in each room on any worker: this worker's registry plus what the others last shared"""
+    online = {room_id: set(presence_registry.online(room_id)) for room_id in room_ids}
+    if room_ids:
+        cutoff = datetime.utcnow() - timedelta(seconds=PRESENCE_TTL_SECONDS)
+        shared = await run_db(lambda: list(room_presence_collection.find(
+            {"room_id": {"$in": room_ids}, "last_seen": {"$gte": cutoff}}, {"_id": 0, "room_id": 1, "user_id": 1}
+        )))
+        for record in shared:
+            online[record["room_id"]].add(record["user_id"])
+    return {room_id: sorted(users) for room_id, users in online.items()}
+
+async def reconcile_presence() -> int:
+    """Share this worker's presence, then pull participants no worker has seen within the TTL in one batched write.
+    
+    Staleness is judged from room_presence for every room, not from any
+    worker's memory, so users who left while a worker restarted, participants
+    from before presence was tracked and joiners who never heartbeat are all
+    removed. The host owns the room and keeps their place in it.
+    """
+    await share_presence()
+    rooms = await run_db(lambda: list(multiplayer_rooms_collection.find(
+        {"participants": {"$ne": []}}, {"_id": 0, "room_id": 1, "host_user_id": 1, "participants": 1}
+    )))
+    if not rooms:
+        return 0
+    
+    cutoff = datetime.utcnow() - timedelta(seconds=PRESENCE_TTL_SECONDS)
+    recent = await run_db(lambda: list(room_presence_collection.find(
+        {"room_id": {"$in": [room["room_id"] for room in rooms]}, "last_seen": {"$gte": cutoff}}, {"_id": 0, "room_id": 1, "user_id": 1}
+    )))
+    seen = {(record["room_id"], record["user_id"]) for record in recent}
+    stale = {}
+    for room in rooms:
+        users = {
+            user_id for user_id in room.get("participants", [])
+            if user_id != room.get("host_user_id") and (room["room_id"], user_id) not in seen
+        }
+        if users:
+            stale[room["room_id"]] = users
+    if not stale:
+        return 0
+    
+    now = datetime.utcnow()
+    operations = [
+        UpdateOne(
+            {"room_id": room_id},
+            {"$pull": {"participants": {"$in": sorted(users)}}, "$set": {"updated_at": now}}
+        )
+        for room_id, users in stale.items()
+    ]
+    await run_db(multiplayer_rooms_collection.bulk_write, operations, ordered=False)
+    await run_db(room_presence_collection.delete_many, {"$or": [
+        {"room_id": room_id, "user_id": {"$in": sorted(users)}, "last_seen": {"$lt": cutoff}} for room_id, users in stale.items()
+    ]})
+    return sum(len(users) for users in stale.values())
+
+async def presence_reconcile_loop():
+    # Sharing at least twice per TTL means a user who moves to another worker is
+    # published there before the worker they left can evict them
+    interval = min(PRESENCE_RECONCILE_SECONDS, PRESENCE_TTL_SECONDS / 2)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await reconcile_presence()
+        except Exception as e:
+            print(f"Presence reconcile error: {e}")
+
+# Room message buffers
+ROOM_BUFFER_REFRESH_PAGE = 20
+
+def estimate_message_bytes(message: dict) -> int:
+    """Rough in-memory size of a message dict; the cap doesn't need exact accounting"""
+    return 400 + sum(len(value) for value in message.values() if isinstance(value, str))
+
+class RoomBuffer:
+    __slots__ = ("messages", "ids", "complete", "version", "bytes", "refreshed_at", "last_access")
+    
+    def __init__(self, messages: List[dict], complete: bool, version: int = 0):
+        self.messages = deque(messages)
+        self.ids = {message["message_id"] for message in messages}
+        self.complete = complete
+        self.version = version
+        self.bytes = sum(estimate_message_bytes(message) for message in messages)
+        self.refreshed_at = self.last_access = time.monotonic()
+
+class RoomMessageBuffers:
+    """The newest messages of each polled room, kept in memory so polls skip MongoDB.
+    
+    A room's buffer holds up to capacity messages, oldest first; complete marks a
+    room whose whole history fits. Messages this process stores are appended as
+    they are written, and writes from other workers are picked up by a refresh
+    at most every refresh_seconds. Edits and deletions bump the room's
+    messages_version, and a refresh that finds a newer version reloads the
+    buffer, since those changes don't show up as new messages. Rooms are evicted least recently polled first
+    once the buffers pass max_bytes, and after idle_seconds without a poll.
+    """
+    
+    def __init__(self, capacity: int, max_bytes: int, idle_seconds: float, refresh_seconds: float):
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.idle_seconds = idle_seconds
+        self.refresh_seconds = refresh_seconds
+        self.bytes = 0
+        self._rooms: "OrderedDict[str, RoomBuffer]" = OrderedDict()
+        self.stats = {"hits": 0, "fallbacks": 0, "loads": 0, "refreshes": 0, "evictions": 0}
+    
+    def get(self, room_id: str) -> Optional[RoomBuffer]:
+        self._evict_idle()
+        buffer = self._rooms.get(room_id)
+        if buffer is not None:
+            self._rooms.move_to_end(room_id)
+            buffer.last_access = time.monotonic()
+        return buffer
+    
+    def load(self, room_id: str, newest: List[dict], version: int = 0) -> RoomBuffer:
+        """Buffer a room from its newest messages (newest first, up to capacity + 1 to detect more)"""
+        self.drop(room_id)
+        buffer = RoomBuffer(list(reversed(newest[:self.capacity])), complete=len(newest) <= self.capacity, version=version)
+        self._rooms[room_id] = buffer
+        self.bytes += buffer.bytes
+        self.stats["loads"] += 1
+        self._enforce_cap(room_id)
+        return buffer
+    
+    def add(self, room_id: str, messages: List[dict]):
+        """Merge newly stored messages into a room's buffer, if the room is buffered"""
+        buffer = self._rooms.get(room_id)
+        if buffer is None:
+            return
+        new = [message for message in messages if message["message_id"] not in buffer.ids]
+        if not new:
+            return
+        if buffer.messages and min(message["timestamp"] for message in new) < buffer.messages[-1]["timestamp"]:
+            buffer.messages = deque(sorted([*buffer.messages, *new], key=lambda message: message["timestamp"]))
+        else:
+            buffer.messages.extend(sorted(new, key=lambda message: message["timestamp"]))
+        for message in new:
+            buffer.ids.add(message["message_id"])
+            size = estimate_message_bytes(message)
+            buffer.bytes += size
+            self.bytes += size
+        while len(buffer.messages) > self.capacity:
+            dropped = buffer.messages.popleft()
+            buffer.ids.discard(dropped["message_id"])
+            size = estimate_message_bytes(dropped)
+            buffer.bytes -= size
+            self.bytes -= size
+            buffer.complete = False
+        self._enforce_cap(room_id)
+    
+    def needs_refresh(self, buffer: RoomBuffer) -> bool:
+        return time.monotonic() - buffer.refreshed_at >= self.refresh_seconds
+    
+    def page(self, buffer: RoomBuffer, limit: Optional[int], before: Optional[datetime]) -> Optional[tuple]:
+        """(messages oldest first, has_more) from memory, or None if the page reaches past the buffer"""
+        messages = [message for message in buffer.messages if before is None or message["timestamp"] < before]
+        if limit is not None and len(messages) > limit:
+            self.stats["hits"] += 1
+            return messages[-limit:], True
+        if buffer.complete:
+            self.stats["hits"] += 1
+            return messages, False
+        self.stats["fallbacks"] += 1
+        return None
+    
+    def drop(self, room_id: str):
+        buffer = self._rooms.pop(room_id, None)
+        if buffer is not None:
+            self.bytes -= buffer.bytes
+    
+    def _evict_idle(self):
+        cutoff = time.monotonic() - self.idle_seconds
+        while self._rooms:
+            room_id, buffer = next(iter(self._rooms.items()))
+            if buffer.last_access >= cutoff:
+                break
+            self.drop(room_id)
+            self.stats["evictions"] += 1
+    
+    def _enforce_cap(self, keep: str):
+        for room_id in list(self._rooms):
+            if self.bytes <= self.max_bytes:
+                break
+            if room_id != keep:
+                self.drop(room_id)
+                self.stats["evictions"] += 1
+    
+    def clear(self):
+        self._rooms.clear()
+        self.bytes = 0
+    
+    def snapshot(self) -> dict:
+        return {"rooms": len(self._rooms), "messages": sum(len(buffer.messages) for buffer in self._rooms.values()),
+                "bytes": self.bytes, **self.stats}
+
+room_buffers = RoomMessageBuffers(ROOM_BUFFER_MESSAGES, ROOM_BUFFER_MAX_BYTES, ROOM_BUFFER_IDLE_SECONDS, ROOM_BUFFER_REFRESH_SECONDS)
+
+def buffer_room_message(message: dict):
+    """Call after storing a message so polls of its room see it without a refresh"""
+    if message.get("room_id"):
+        room_buffers.add(message["room_id"], [message])
+
+def bump_room_messages_version(room_id: str):
+    """Call after editing or deleting a room message so every worker reloads its buffer of the room"""
+    room_buffers.drop(room_id)
+    multiplayer_rooms_collection.update_one({"room_id": room_id}, {"$inc": {"messages_version": 1}})
+
+def room_messages_version(room_id: str) -> int:
+    room = multiplayer_rooms_collection.find_one({"room_id": room_id}, {"_id": 0, "messages_version": 1})
+    return (room or {}).get("messages_version", 0)
+
+async def load_room_buffer(room_id: str) -> RoomBuffer:
+    buffer = room_buffers.get(room_id)
+    if buffer is None:
+        # Version first: an edit landing between the two reads is caught by the next refresh
+        version = await run_db(room_messages_version, room_id)
+        newest = await run_db(message_store.latest_room_messages, room_id, room_buffers.capacity + 1)
+        return room_buffers.load(room_id, newest, version)
+    if room_buffers.needs_refresh(buffer):
+        # Another worker may have written to the room; a short newest page that
+        # overlaps the buffer is enough, anything else means reloading it
+        buffer.refreshed_at = time.monotonic()
+        room_buffers.stats["refreshes"] += 1
+        version = await run_db(room_messages_version, room_id)
+        recent = await run_db(message_store.latest_room_messages, room_id, ROOM_BUFFER_REFRESH_PAGE)
+        if version != buffer.version or (
+            len(recent) == ROOM_BUFFER_REFRESH_PAGE and not any(message["message_id"] in buffer.ids for message in recent)
+        ):
+            newest = await run_db(message_store.latest_room_messages, room_id, room_buffers.capacity + 1)
+            return room_buffers.load(room_id, newest, version)
+        room_buffers.add(room_id, recent)
+    return buffer
+
+# Provider circuit breakers
+class ProviderCircuit:
+    """Stops calling a provider after repeated failures until a cooldown passes"""
+    
+    def __init__(self, failure_threshold: int, cooldown: float):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+    
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half_open"
+        return "open"
+    
+    def allow(self) -> bool:
+        # Half-open lets calls through; the next result closes or re-opens the circuit
+        return self.state != "open"
+    
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+    
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+provider_circuits: Dict[str, ProviderCircuit] = {}
+
+def get_provider_circuit(provider: str) -> ProviderCircuit:
+    if provider not in provider_circuits:
+        provider_circuits[provider] = ProviderCircuit(PROVIDER_CIRCUIT_FAILURES, PROVIDER_CIRCUIT_COOLDOWN_SECONDS)
+    return provider_circuits[provider]
+
+# Health monitoring
+class HealthMonitor:
+    """Dependency state sampled in the background so probes never block on I/O"""
+    
+    def __init__(self):
+        self.mongo_ok = False
+        self.mongo_checked_at: Optional[float] = None
+        self.mongo_error: Optional[str] = None
+        self.loop_lag = 0.0
+
+health_monitor = HealthMonitor()
+
+async def mongo_ping_loop():
+    while True:
+        # A hung ping isn't abandoned (that would pile up threads); readiness
+        # treats a result older than three intervals as a failure instead
+        try:
+            await run_db(client.admin.command, "ping")
+            health_monitor.mongo_ok = True
+            health_monitor.mongo_error = None
+        except Exception as e:
+            health_monitor.mongo_ok = False
+            health_monitor.mongo_error = str(e) or type(e).__name__
+        health_monitor.mongo_checked_at = time.monotonic()
+        await asyncio.sleep(HEALTH_PING_SECONDS)
+
+async def event_loop_lag_loop(interval: float = 0.5):
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        # Anything beyond the requested sleep is time the loop spent blocked
+        health_monitor.loop_lag = max(0.0, loop.time() - started - interval)
+
+def readiness_checks() -> Dict[str, dict]:
+    """Evaluate readiness from cached state only"""
+    now = time.monotonic()
+    checked_at = health_monitor.mongo_checked_at
+    mongo_fresh = checked_at is not None and now - checked_at <= HEALTH_PING_SECONDS * 3
+    mongo = {
+        "ok": health_monitor.mongo_ok and mongo_fresh,
+        "checked_seconds_ago": round(now - checked_at, 1) if checked_at is not None else None,
+        "error": health_monitor.mongo_error
+    }
+    
+    provider_states = {}
+    for provider in AVAILABLE_MODELS:
+        if get_api_key(provider) is None:
+            provider_states[provider] = "no_key"
+        else:
+            provider_states[provider] = get_provider_circuit(provider).state
+    usable = any(state in ("closed", "half_open") for state in provider_states.values())
+    providers = {"ok": usable or not READINESS_REQUIRE_PROVIDER, "states": provider_states}
+    
+    event_loop = {
+        "ok": health_monitor.loop_lag <= HEALTH_MAX_LOOP_LAG_SECONDS,
+        "lag_ms": round(health_monitor.loop_lag * 1000, 1)
+    }
+    return {"mongo": mongo, "providers": providers, "event_loop": event_loop}
+
+# Tracing
+_REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._:-]{1,128}$")
+
+current_span: contextvars.ContextVar = contextvars.ContextVar("current_span", default=None)
+current_request_id: contextvars.ContextVar = contextvars.ContextVar("current_request_id", default=None)
+
+class Span:
+    """One timed operation; every span of a request shares its trace_id and request_id"""
+    
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "request_id", "attributes", "error", "started_at", "_started")
+    
+    def __init__(self, name: str, trace_id: str, request_id: Optional[str], parent_id: Optional[str] = None,
+                 attributes: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.request_id = request_id
+        self.attributes = attributes or {}
+        self.error: Optional[str] = None
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+    
+    def child(self, name: str, **attributes) -> "Span":
+        return Span(name, self.trace_id, self.request_id, self.span_id, attributes)
+    
+    def finish(self, duration: Optional[float] = None):
+        if duration is None:
+            duration = time.perf_counter() - self._started
+        span_exporter.export({
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "request_id": self.request_id,
+            "name": self.name,
+            "start": datetime.utcfromtimestamp(self.started_at).isoformat() + "Z",
+            "duration_ms": round(duration * 1000, 3),
+            "error": self.error,
+            "attributes": self.attributes
+        })
+
+class SpanExporter:
+    """Writes finished spans as JSON lines to stdout or a file, for offline analysis"""
+    
+    def __init__(self, target: str):
+        self.target = target
+        self._stream = None
+        self._lock = threading.Lock()
+    
+    def export(self, record: dict):
+        if self.target in ("", "none"):
+            return
+        line = json.dumps(record, default=str) + "\n"
+        # Mongo spans finish on run_db threads
+        with self._lock:
+            if self._stream is None:
+                self._stream = sys.stdout if self.target == "stdout" else open(self.target, "a", buffering=1)
+            self._stream.write(line)
+    
+    def close(self):
+        with self._lock:
+            if self._stream is not None and self._stream is not sys.stdout:
+                self._stream.close()
+            self._stream = None
+
+span_exporter = SpanExporter(TRACE_EXPORTER)
+
+def start_trace(name: str, request_id: str, sampled: bool, trace_id: Optional[str] = None, **attributes) -> Optional[Span]:
+    """Root span for a request or job, or None when it isn't sampled (its children are then skipped)"""
+    if not sampled:
+        return None
+    return Span(name, trace_id or uuid.uuid4().hex, request_id, attributes=attributes)
+
+def trace_sampled(flag: Optional[str] = None) -> bool:
+    if flag in ("0", "1"):
+        return flag == "1"
+    return TRACE_SAMPLE_RATE > 0 and random.random() < TRACE_SAMPLE_RATE
+
+def describe_span_error(e: BaseException) -> str:
+    if isinstance(e, HTTPException):
+        return f"{e.status_code}: {e.detail}"
+    return str(e) or type(e).__name__
+
+@contextmanager
+def trace_root(root: Optional[Span], request_id: str):
+    """Make root and request_id current for the enclosed block, finishing root afterwards"""
+    request_token = current_request_id.set(request_id)
+    span_token = current_span.set(root)
+    try:
+        yield root
+    except BaseException as e:
+        if root is not None:
+            root.error = describe_span_error(e)
+        raise
+    finally:
+        current_span.reset(span_token)
+        current_request_id.reset(request_token)
+        if root is not None:
+            root.finish()
+
+@contextmanager
+def trace_span(name: str, **attributes):
+    """Time the enclosed block as a child of the current span; a no-op outside sampled traces"""
+    parent = current_span.get()
+    if parent is None:
+        yield None
+        return
+    span = parent.child(name, **attributes)
+    token = current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.error = describe_span_error(e)
+        raise
+    finally:
+        current_span.reset(token)
+        span.finish()
+
+class MongoTraceListener(monitoring.CommandListener):
+    """Records each MongoDB command as a span under the span that issued it.
+    
+    PyMongo calls started() on the thread running the operation, and both
+    run_db and the threadpool copy the caller's context, so current_span there
+    is the issuing span.
+    """
+    
+    def __init__(self):
+        self._pending: Dict[int, Span] = {}
+    
+    def started(self, event):
+        parent = current_span.get()
+        if parent is None:
+            return
+        target = event.command.get(event.command_name)
+        self._pending[event.request_id] = parent.child(
+            f"mongo.{event.command_name}",
+            **{"db.operation": event.command_name, "db.collection": target if isinstance(target, str) else None}
+        )
+    
+    def succeeded(self, event):
+        span = self._pending.pop(event.request_id, None)
+        if span is not None:
+            span.finish(event.duration_micros / 1_000_000)
+    
+    def failed(self, event):
+        span = self._pending.pop(event.request_id, None)
+        if span is not None:
+            span.error = str(event.failure.get("errmsg") or event.failure)
+            span.finish(event.duration_micros / 1_000_000)
+
+mongo_trace_listener = MongoTraceListener()
+
+class TracingMiddleware:
+    """Gives every HTTP request an ID and, when sampled, a root span.
+    
+    The ID comes from X-Request-ID when the caller sends a usable one and is
+    echoed back on the response. X-Trace-Sampled: 1/0 forces sampling on or off
+    for one request; otherwise TRACE_SAMPLE_RATE decides.
+    """
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        headers = {name: value.decode("latin-1") for name, value in scope["headers"]}
+        request_id = headers.get(b"x-request-id", "")
+        if not _REQUEST_ID_PATTERN.match(request_id):
+            request_id = uuid.uuid4().hex
+        root = start_trace(f"{scope['method']} {scope['path']}", request_id, trace_sampled(headers.get(b"x-trace-sampled")),
+                           **{"http.method": scope["method"], "http.path": scope["path"]})
+        
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", []), (b"x-request-id", request_id.encode("latin-1"))]
+                if root is not None:
+                    root.attributes["http.status_code"] = message["status"]
+            await send(message)
+        
+        with trace_root(root, request_id):
+            await self.app(scope, receive, send_with_request_id)
+
+app.add_middleware(TracingMiddleware)
+
+# Request deadlines
+# Budgets in seconds for routes that differ from REQUEST_DEADLINE_SECONDS; None for no deadline
+ROUTE_DEADLINES = {
+    "POST /api/chat": CHAT_DEADLINE_SECONDS,
+    "GET /api/chat/jobs/{job_id}": CHAT_JOB_MAX_WAIT_SECONDS + 10,  # long-polls
+    "GET /api/chat/jobs/{job_id}/events": None,  # streams until the job ends
+    "GET /api/export/conversations": None,
+    "POST /api/import/conversations": None,
+}
+_ROUTE_DEADLINE_PATTERNS = [
+    (route.split(" ", 1)[0], compile_path(route.split(" ", 1)[1])[0], seconds) for route, seconds in ROUTE_DEADLINES.items()
+]
+
+request_deadline: contextvars.ContextVar = contextvars.ContextVar("request_deadline", default=None)
+
+def request_budget(method: str, path: str, requested: str) -> Optional[float]:
+    """Seconds a request may take: X-Request-Timeout when usable, else its route's default"""
+    try:
+        seconds = float(requested)
+    except ValueError:
+        seconds = 0
+    if seconds > 0:
+        return min(seconds, REQUEST_DEADLINE_MAX_SECONDS)
+    for route_method, pattern, seconds in _ROUTE_DEADLINE_PATTERNS:
+        if method == route_method and pattern.match(path):
+            return seconds
+    return REQUEST_DEADLINE_SECONDS or None
+
+def deadline_remaining() -> Optional[float]:
+    deadline = request_deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+def deadline_exceeded() -> HTTPException:
+    return HTTPException(status_code=504, detail="Request deadline exceeded")
+
+def is_deadline_error(e: Exception) -> bool:
+    # PyMongo raises these once the pymongo.timeout() budget set by DeadlineMiddleware runs out
+    return isinstance(e, PyMongoError) and e.timeout and request_deadline.get() is not None
+
+class DeadlineMiddleware:
+    """Gives every HTTP request a time budget shared by the DB and LLM calls made for it.
+    
+    The budget comes from X-Request-Timeout (seconds, capped at
+    REQUEST_DEADLINE_MAX_SECONDS) or the route's default. send_llm_message and
+    run_db read the deadline from request_deadline, and pymongo.timeout()
+    applies it to every PyMongo operation, sending the remainder as maxTimeMS.
+    Calls made once the budget is spent fail with 504.
+    """
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        headers = dict(scope["headers"])
+        budget = request_budget(scope["method"], scope["path"], headers.get(b"x-request-timeout", b"").decode("latin-1"))
+        if budget is None:
+            await self.app(scope, receive, send)
+            return
+        token = request_deadline.set(time.monotonic() + budget)
+        try:
+            with mongo_timeout(budget):
+                await self.app(scope, receive, send)
+        finally:
+            request_deadline.reset(token)
+
+app.add_middleware(DeadlineMiddleware)
+
+@app.exception_handler(PyMongoError)
+async def mongo_error_handler(request: Request, exc: PyMongoError):
+    if is_deadline_error(exc):
+        return JSONResponse(status_code=504, content={"detail": "Request deadline exceeded"})
+    raise exc
+
+# Slow query log
+# Filter fields per command; fields in _SHAPE_LITERAL_KEYS keep their values, everything else becomes "?"
+_SHAPE_FIELDS = {
+    "find": ("filter", "sort", "projection"),
+    "aggregate": ("pipeline",),
+    "count": ("query",),
+    "distinct": ("key", "query"),
+    "findAndModify": ("query", "sort"),
+    "update": ("updates",),
+    "delete": ("deletes",),
+}
+_SHAPE_LITERAL_KEYS = {"sort", "$sort", "projection", "$project", "key", "u"}
+_UNEXPLAINED_COMMANDS = {"insert", "getMore", "createIndexes", "bulkWrite"}
+_IGNORED_COMMANDS = {"explain", "ping", "hello", "isMaster", "ismaster", "endSessions", "saslStart", "saslContinue", "buildInfo"}
+_EXPLAIN_STRIPPED_FIELDS = {"lsid", "txnNumber", "writeConcern", "readConcern"}
+
+def query_shape(value: Any) -> Any:
+    """Replace the values in a filter with "?" so queries differing only in values group together"""
+    if isinstance(value, dict):
+        return {key: item if key in _SHAPE_LITERAL_KEYS else query_shape(item) for key, item in value.items()}
+    if isinstance(value, list):
+        nested = [query_shape(item) for item in value if isinstance(item, (dict, list))]
+        return nested or "?"
+    return "?"
+
+def command_shape(command_name: str, command: dict) -> dict:
+    shape = {}
+    for field in _SHAPE_FIELDS.get(command_name, ()):
+        if field not in command:
+            continue
+        value = command[field]
+        if field in ("updates", "deletes"):
+            # Write batches repeat one statement shape; the first stands for all
+            value = {"q": value[0].get("q", {})} if value else {}
+        shape[field] = value if field in _SHAPE_LITERAL_KEYS else query_shape(value)
+    return shape
+
+def summarize_plan(plan: dict) -> dict:
+    """Stage chain and indexes of a winning plan, e.g. FETCH <- IXSCAN on user_id_1"""
+    stages, indexes = [], []
+    pending = [plan]
+    while pending:
+        node = pending.pop(0)
+        stages.append(node.get("stage"))
+        if node.get("indexName"):
+            indexes.append(node["indexName"])
+        pending.extend(node.get("inputStages", []))
+        if "inputStage" in node:
+            pending.append(node["inputStage"])
+        if "queryPlan" in node:
+            pending.append(node["queryPlan"])
+    return {"stages": stages, "indexes": indexes, "collection_scan": "COLLSCAN" in stages}
+
+def find_query_planner(explain: Any) -> Optional[dict]:
+    """Locate queryPlanner in explain output (nested under $cursor for aggregations)"""
+    if isinstance(explain, dict):
+        if "queryPlanner" in explain:
+            return explain["queryPlanner"]
+        children = explain.values()
+    elif isinstance(explain, list):
+        children = explain
+    else:
+        return None
+    for child in children:
+        planner = find_query_planner(child)
+        if planner is not None:
+            return planner
+    return None
+
+class SlowQueryLog(monitoring.CommandListener):
+    """Logs MongoDB commands slower than SLOW_QUERY_MS, grouped by query shape.
+    
+    The first slow occurrence of each shape is explained once on a background
+    thread (never on the driver thread that reported it), so the top offenders
+    come with their winning plan. Counters are per process, like /api/metrics.
+    """
+    
+    def __init__(self, threshold_ms: float, max_shapes: int):
+        self.threshold_ms = threshold_ms
+        self.max_shapes = max_shapes
+        self.dropped = 0
+        self._shapes: Dict[str, dict] = {}
+        self._pending: Dict[int, tuple] = {}
+        self._lock = threading.Lock()
+        self._explainer: Optional[ThreadPoolExecutor] = None
+    
+    def started(self, event):
+        if self.threshold_ms <= 0 or event.command_name in _IGNORED_COMMANDS:
+            return
+        self._pending[event.request_id] = (event.command, current_request_id.get())
+    
+    def succeeded(self, event):
+        self._finish(event, failed=False)
+    
+    def failed(self, event):
+        self._finish(event, failed=True)
+    
+    def _finish(self, event, failed: bool):
+        pending = self._pending.pop(event.request_id, None)
+        duration_ms = event.duration_micros / 1000
+        if pending is None or duration_ms < self.threshold_ms:
+            return
+        command, request_id = pending
+        command_name = event.command_name
+        collection = command.get(command_name)
+        collection = collection if isinstance(collection, str) else command.get("collection")
+        shape = command_shape(command_name, command)
+        key = f"{event.database_name}.{collection}.{command_name} {json.dumps(shape, sort_keys=True, default=str)}"
+        print(f"Slow query {duration_ms:.1f}ms{' (failed)' if failed else ''} request={request_id} {key}")
+        
+        now = datetime.utcnow()
+        with self._lock:
+            entry = self._shapes.get(key)
+            if entry is None:
+                if len(self._shapes) >= self.max_shapes:
+                    self.dropped += 1
+                    return
+                entry = self._shapes[key] = {
+                    "shape": shape, "collection": collection, "command": command_name, "database": event.database_name,
+                    "count": 0, "failed": 0, "total_ms": 0.0, "max_ms": 0.0, "first_seen": now, "explain": None
+                }
+                explain_now = SLOW_QUERY_EXPLAIN and command_name not in _UNEXPLAINED_COMMANDS
+            else:
+                explain_now = False
+            entry["count"] += 1
+            entry["failed"] += int(failed)
+            entry["total_ms"] += duration_ms
+            entry["max_ms"] = max(entry["max_ms"], duration_ms)
+            entry["last_seen"] = now
+            entry["last_request_id"] = request_id
+        if explain_now:
+            if self._explainer is None:
+                self._explainer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="slow-query-explain")
+            self._explainer.submit(self._capture_explain, key, event.database_name, command_name, command)
+    
+    def _capture_explain(self, key: str, database: str, command_name: str, command: dict):
+        explained = {
+            field: value for field, value in command.items()
+            if not field.startswith("$") and field not in _EXPLAIN_STRIPPED_FIELDS
+        }
+        for field in ("updates", "deletes"):
+            # explain takes a single write statement
+            if field in explained:
+                explained[field] = explained[field][:1]
+        try:
+            output = client[database].command({"explain": explained, "verbosity": "queryPlanner"})
+            planner = find_query_planner(output) or {}
+            winning_plan = planner.get("winningPlan", {})
+            result = {"plan": summarize_plan(winning_plan), "winning_plan": winning_plan}
+        except Exception as e:
+            result = {"error": str(e) or type(e).__name__}
+        with self._lock:
+            if key in self._shapes:
+                self._shapes[key]["explain"] = result
+    
+    def top(self, limit: int = 20, sort: str = "total_ms") -> List[dict]:
+        with self._lock:
+            entries = [dict(entry, mean_ms=entry["total_ms"] / entry["count"]) for entry in self._shapes.values()]
+        entries.sort(key=lambda entry: entry[sort], reverse=True)
+        return [
+            {**entry, "total_ms": round(entry["total_ms"], 1), "mean_ms": round(entry["mean_ms"], 1), "max_ms": round(entry["max_ms"], 1)}
+            for entry in entries[:limit]
+        ]
+    
+    def reset(self):
+        with self._lock:
+            self._shapes.clear()
+            self.dropped = 0
+
+slow_query_log = SlowQueryLog(SLOW_QUERY_MS, SLOW_QUERY_MAX_SHAPES)
+
+# Usage metering
+USAGE_DIMENSIONS = ("user", "character", "model")
+
+def estimate_tokens(text: str) -> int:
+    """Approximate token count; the LLM integration doesn't report usage, and ~4 characters per token holds for English"""
+    return max(1, round(len(text) / 4)) if text else 0
+
+def estimate_cost(provider: str, model: str, prompt_tokens: int, completion_tokens: int) -> Optional[float]:
+    prices = MODEL_PRICING.get(provider, {}).get(model)
+    if not prices:
+        return None
+    return round((prompt_tokens * prices[0] + completion_tokens * prices[1]) / 1_000_000, 8)
+
+class UsageMeter:
+    """Per-day token and cost totals accumulated in memory and flushed as batched upserts.
+    
+    Recording only touches memory, so metering adds no writes to the chat request;
+    usage_flush_loop() folds the pending deltas into usage_rollups in one bulk write.
+    Rollups with user_id None total every user; character and model totals are
+    also kept per user so each user can see their own breakdown.
+    """
+    
+    def __init__(self):
+        self._pending: Dict[tuple, Dict[str, float]] = {}
+    
+    def record(self, user_id: str, character_id: str, provider: str, model: str, prompt_tokens: int,
+               completion_tokens: int, cost_usd: Optional[float], when: datetime):
+        day = when.strftime("%Y-%m-%d")
+        rollup_keys = [(dimension, key, day, None) for dimension, key in zip(USAGE_DIMENSIONS, (user_id, character_id, f"{provider}/{model}"))]
+        rollup_keys += [("character", character_id, day, user_id), ("model", f"{provider}/{model}", day, user_id)]
+        for rollup_key in rollup_keys:
+            totals = self._pending.setdefault(rollup_key, {"messages": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0})
+            totals["messages"] += 1
+            totals["prompt_tokens"] += prompt_tokens
+            totals["completion_tokens"] += completion_tokens
+            totals["cost_usd"] += cost_usd or 0.0
+    
+    def drain(self) -> Dict[tuple, Dict[str, float]]:
+        pending, self._pending = self._pending, {}
+        return pending
+    
+    def restore(self, pending: Dict[tuple, Dict[str, float]]):
+        """Put back deltas whose flush failed so the next flush retries them"""
+        for rollup_key, totals in pending.items():
+            current = self._pending.setdefault(rollup_key, {field: 0 for field in totals})
+            for field, value in totals.items():
+                current[field] += value
+
+usage_meter = UsageMeter()
+
+def ensure_usage_indexes():
+    # Rollups used to be unique without user_id; that index would reject the per-user ones
+    if "dimension_1_key_1_day_1" in usage_rollups_collection.index_information():
+        usage_rollups_collection.drop_index("dimension_1_key_1_day_1")
+    usage_rollups_collection.create_index([("dimension", 1), ("key", 1), ("day", 1), ("user_id", 1)], unique=True)
+    usage_rollups_collection.create_index([("dimension", 1), ("user_id", 1), ("day", 1)])
+
+async def flush_usage() -> int:
+    pending = usage_meter.drain()
+    if not pending:
+        return 0
+    now = datetime.utcnow()
+    operations = [
+        UpdateOne(
+            {"dimension": dimension, "key": key, "day": day, "user_id": user_id},
+            {"$inc": totals, "$set": {"updated_at": now}},
+            upsert=True
+        )
+        for (dimension, key, day, user_id), totals in pending.items()
+    ]
+    try:
+        await run_db(usage_rollups_collection.bulk_write, operations, ordered=False)
+    except Exception:
+        usage_meter.restore(pending)
+        raise
+    return len(operations)
+
+async def usage_flush_loop():
+    while True:
+        await asyncio.sleep(USAGE_FLUSH_SECONDS)
+        try:
+            await flush_usage()
+        except Exception as e:
+            print(f"Usage flush error: {e}")
+
+# LLM integration
+_llm_integration = None
+
+def load_llm_integration():
+    """Import the LLM integration on first use; it pulls in every provider SDK"""
+    global _llm_integration
+    if _llm_integration is None:
+        from emergentintegrations.llm.chat import LlmChat, UserMessage
+        _llm_integration = (LlmChat, UserMessage)
+    return _llm_integration
+
+def model_timeout(provider: str, model: str) -> float:
+    return MODEL_TIMEOUTS.get(provider, {}).get(model, LLM_TIMEOUT_SECONDS)
+
+async def send_llm_message(api_key: str, session_id: str, system_prompt: str, ai_provider: str, ai_model: str, text: str) -> str:
+    """Send one message to the provider, skipping providers whose circuit is open.
+    
+    The call is given the model's timeout, or what is left of the request's
+    deadline if that is shorter; either running out answers 504. Only the
+    model's own timeout counts as a provider failure.
+    """
+    LlmChat, UserMessage = await asyncio.to_thread(load_llm_integration)
+    chat_instance = LlmChat(
+        api_key=api_key,
+        session_id=session_id,
+        system_message=system_prompt
+    ).with_model(ai_provider, ai_model)
+    
+    circuit = get_provider_circuit(ai_provider)
+    if not circuit.allow():
+        raise HTTPException(status_code=503, detail=f"AI provider {ai_provider} is temporarily unavailable")
+    timeout = model_timeout(ai_provider, ai_model)
+    remaining = deadline_remaining()
+    limited_by_deadline = remaining is not None and remaining < timeout
+    if limited_by_deadline:
+        if remaining <= 0:
+            raise deadline_exceeded()
+        timeout = remaining
+    try:
+        with trace_span("llm.send_message", **{"llm.provider": ai_provider, "llm.model": ai_model}):
+            ai_response = await asyncio.wait_for(chat_instance.send_message(UserMessage(text=text)), timeout)
+    except asyncio.TimeoutError:
+        if limited_by_deadline:
+            raise deadline_exceeded()
+        circuit.record_failure()
+        raise HTTPException(status_code=504, detail=f"AI provider {ai_provider} did not answer within {timeout:g}s")
+    except Exception:
+        circuit.record_failure()
+        raise
+    circuit.record_success()
+    return ai_response
+
 async def verify_session(session_id: str) -> Optional[dict]:
     """Verify session with Emergent Auth API"""
+    # Imported here: httpx is only needed at login and costs ~150ms of cold start
+    import httpx
     try:
         async with httpx.AsyncClient() as client:
             response = await client.get(
@@ -279,12 +2695,13 @@ async def create_default_persona(user_id: str, username: str) -> str:
         personality_traits="Friendly, curious, and engaging",
         avatar=None,
         preferences={},
-        is_default=True,
         created_at=datetime.utcnow(),
         updated_at=datetime.utcnow()
     )
     
-    personas_collection.insert_one(default_persona.dict())
+    # is_default is derived from the user's default_persona_id pointer, not stored
+    personas_collection.insert_one(default_persona.dict(exclude={"is_default"}))
+    set_default_persona_pointer(user_id, persona_id)
     return persona_id
 
 async def get_current_user(x_session_id: str = Header(None)) -> Optional[dict]:
@@ -292,19 +2709,118 @@ async def get_current_user(x_session_id: str = Header(None)) -> Optional[dict]:
     if not x_session_id:
         return None
     
-    # Check local session
-    session = sessions_collection.find_one({"session_id": x_session_id})
-    if session and session["expires_at"] > datetime.utcnow():
-        user = users_collection.find_one({"user_id": session["user_id"]}, {"_id": 0})
-        return user
-    
-    return None
+    with trace_span("auth.get_current_user"):
+        # Check local session
+        session = session_store.get(x_session_id)
+        now = datetime.utcnow()
+        if session and session["expires_at"] > now:
+            # Sliding expiry, written at most once per renew interval
+            last_renewed = session.get("renewed_at") or session.get("created_at") or now
+            if (now - last_renewed).total_seconds() >= SESSION_RENEW_INTERVAL_SECONDS:
+                session_store.renew(x_session_id, now + timedelta(seconds=SESSION_TTL_SECONDS), now)
+            user = users_collection.find_one({"user_id": session["user_id"]}, {"_id": 0})
+            return user
+        
+        return None
+
+def require_admin(current_user: Optional[dict]):
+    """Operator endpoints are limited to the user IDs listed in ADMIN_USER_IDS"""
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    if current_user["user_id"] not in ADMIN_USER_IDS:
+        raise HTTPException(status_code=403, detail="Admin access required")
+
+async def ensure_indexes():
+    try:
+        await run_db(message_store.ensure_indexes)
+        await run_db(ensure_archive_indexes)
+        await run_db(ensure_sync_indexes)
+        await run_db(ensure_chat_job_indexes)
+        await run_db(ensure_room_turn_indexes)
+        await run_db(ensure_idempotency_indexes)
+        await run_db(ensure_usage_indexes)
+        await run_db(ensure_presence_indexes)
+    except Exception as e:
+        print(f"Index setup error: {e}")
+
+async def start_background_tasks():
+    global chat_job_wakeup
+    chat_job_wakeup = asyncio.Event()
+    app.state.background_tasks = [
+        asyncio.create_task(ensure_indexes()),
+        asyncio.create_task(presence_reconcile_loop()),
+        asyncio.create_task(session_sweep_loop()),
+        asyncio.create_task(mongo_ping_loop()),
+        asyncio.create_task(event_loop_lag_loop()),
+        asyncio.create_task(usage_flush_loop()),
+    ]
+    if ARCHIVE_IDLE_DAYS > 0:
+        app.state.background_tasks.append(asyncio.create_task(archive_loop()))
+    app.state.background_tasks.extend(asyncio.create_task(chat_job_worker(index)) for index in range(CHAT_JOB_WORKERS))
+
+async def stop_background_tasks():
+    for task in app.state.background_tasks:
+        task.cancel()
+    # Let cancelled chat job workers hand their jobs back before the client closes
+    await asyncio.gather(*app.state.background_tasks, return_exceptions=True)
+    try:
+        await reconcile_presence()
+    except Exception as e:
+        print(f"Presence reconcile error: {e}")
+    try:
+        await flush_usage()
+    except Exception as e:
+        print(f"Usage flush error: {e}")
 
 # Health check
 @app.get("/api/health")
 async def health_check():
     return {"status": "healthy", "message": "Character VR RP API is running"}
 
+@app.get("/api/health/live")
+async def liveness_probe():
+    """Liveness: the process is up and its event loop is answering"""
+    return {"status": "alive"}
+
+@app.get("/api/health/ready")
+async def readiness_probe():
+    """Readiness: dependencies look healthy enough to receive traffic"""
+    checks = readiness_checks()
+    ready = all(check["ok"] for check in checks.values())
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"status": "ready" if ready else "degraded", "checks": checks}
+    )
+
+# Metrics
+@app.get("/api/metrics")
+async def get_metrics():
+    """Process-local counters for this worker"""
+    return {
+        "single_flight": single_flight.snapshot(),
+        "chat_latency": chat_latency.snapshot(),
+        "chat_cancellations": chat_cancellations.snapshot(),
+        "room_buffers": room_buffers.snapshot()
+    }
+
+@app.get("/api/admin/slow-queries")
+async def get_slow_queries(limit: int = 20, sort: str = "total_ms", current_user: dict = Depends(get_current_user)):
+    """Slowest MongoDB query shapes seen by this worker, with the plan of their first occurrence"""
+    require_admin(current_user)
+    if sort not in ("total_ms", "max_ms", "mean_ms", "count"):
+        raise HTTPException(status_code=400, detail="sort must be one of: total_ms, max_ms, mean_ms, count")
+    return {
+        "threshold_ms": slow_query_log.threshold_ms,
+        "dropped_shapes": slow_query_log.dropped,
+        "queries": slow_query_log.top(max(1, min(limit, 200)), sort)
+    }
+
+@app.delete("/api/admin/slow-queries")
+async def reset_slow_queries(current_user: dict = Depends(get_current_user)):
+    require_admin(current_user)
+    slow_query_log.reset()
+    return {"message": "Slow query log cleared"}
+
 # Authentication endpoints
 @app.post("/api/auth/callback")
 async def auth_callback(request: AuthCallbackRequest):
@@ -348,19 +2864,21 @@ async def auth_callback(request: AuthCallbackRequest):
             if persona_count == 0:
                 await create_default_persona(user_id, existing_user.get("username", "User"))
         
-        # Create session
+        # Create or replace session
         session = Session(
             session_id=request.session_id,
             user_id=user_id,
             session_token=session_token,
-            expires_at=datetime.utcnow() + timedelta(days=7),
+            expires_at=datetime.utcnow() + timedelta(seconds=SESSION_TTL_SECONDS),
             created_at=datetime.utcnow()
         )
-        sessions_collection.insert_one(session.dict())
+        session_store.put(session.dict())
         
         return {"message": "Authentication successful", "user_id": user_id}
         
     except Exception as e:
+        if is_deadline_error(e):
+            raise deadline_exceeded()
         raise HTTPException(status_code=500, detail=f"Authentication error: {str(e)}")
 
 @app.post("/api/auth/phone")
@@ -430,13 +2948,6 @@ async def create_persona(persona_data: CreatePersonaRequest, current_user: dict
     
     persona_id = str(uuid.uuid4())
     
-    # If this is set as default, remove default from other personas
-    if persona_data.is_default:
-        personas_collection.update_many(
-            {"user_id": current_user["user_id"]},
-            {"$set": {"is_default": False}}
-        )
-    
     persona = Persona(
         persona_id=persona_id,
         user_id=current_user["user_id"],
@@ -445,12 +2956,16 @@ async def create_persona(persona_data: CreatePersonaRequest, current_user: dict
         personality_traits=persona_data.personality_traits,
         avatar=persona_data.avatar,
         preferences=persona_data.preferences,
-        is_default=persona_data.is_default,
         created_at=datetime.utcnow(),
         updated_at=datetime.utcnow()
     )
     
-    personas_collection.insert_one(persona.dict())
+    personas_collection.insert_one(persona.dict(exclude={"is_default"}))
+    if persona_data.is_default:
+        set_default_persona_pointer(current_user["user_id"], persona_id)
+    else:
+        # A user's first persona becomes the default on next resolution
+        touch_personas(current_user["user_id"])
     return {"persona_id": persona_id, "message": "Persona created successfully"}
 
 @app.get("/api/personas")
@@ -459,8 +2974,21 @@ async def get_user_personas(current_user: dict = Depends(get_current_user)):
     if not current_user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
-    personas = list(personas_collection.find({"user_id": current_user["user_id"]}, {"_id": 0}).sort("created_at", -1))
-    return {"personas": personas}
+    personas, default_persona = await asyncio.gather(
+        run_db(lambda: list(personas_collection.find({"user_id": current_user["user_id"]}, {"_id": 0}).sort("created_at", -1))),
+        load_default_persona(current_user)
+    )
+    return {"personas": mark_default_persona(personas, default_persona)}
+
+@app.get("/api/personas/default")
+async def get_default_persona(current_user: dict = Depends(get_current_user)):
+    """Get the default persona for the current user"""
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    # Falls back to the first persona and makes it default when none is set
+    persona = await load_default_persona(current_user)
+    return persona or {}
 
 @app.get("/api/personas/{persona_id}")
 async def get_persona(persona_id: str, current_user: dict = Depends(get_current_user)):
@@ -468,15 +2996,15 @@ async def get_persona(persona_id: str, current_user: dict = Depends(get_current_
     if not current_user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
-    persona = personas_collection.find_one({
-        "persona_id": persona_id,
-        "user_id": current_user["user_id"]
-    }, {"_id": 0})
+    persona, default_persona = await asyncio.gather(
+        load_persona(persona_id, current_user["user_id"]),
+        load_default_persona(current_user)
+    )
     
     if not persona:
         raise HTTPException(status_code=404, detail="Persona not found")
     
-    return persona
+    return mark_default_persona([persona], default_persona)[0]
 
 @app.put("/api/personas/{persona_id}")
 async def update_persona(persona_id: str, persona_data: UpdatePersonaRequest, current_user: dict = Depends(get_current_user)):
@@ -506,21 +3034,21 @@ async def update_persona(persona_id: str, persona_data: UpdatePersonaRequest, cu
     if persona_data.preferences is not None:
         update_data["preferences"] = persona_data.preferences
     
-    # Handle default persona logic
-    if persona_data.is_default is not None:
-        if persona_data.is_default:
-            # Remove default from other personas
-            personas_collection.update_many(
-                {"user_id": current_user["user_id"], "persona_id": {"$ne": persona_id}},
-                {"$set": {"is_default": False}}
-            )
-        update_data["is_default"] = persona_data.is_default
-    
     personas_collection.update_one(
         {"persona_id": persona_id},
         {"$set": update_data}
     )
     
+    # Handle default persona logic by moving the user's pointer
+    if persona_data.is_default:
+        set_default_persona_pointer(current_user["user_id"], persona_id)
+    elif persona_data.is_default is False:
+        users_collection.update_one(
+            {"user_id": current_user["user_id"], "default_persona_id": persona_id},
+            {"$unset": {"default_persona_id": ""}}
+        )
+    touch_personas(current_user["user_id"])
+    
     return {"message": "Persona updated successfully"}
 
 @app.delete("/api/personas/{persona_id}")
@@ -543,43 +3071,19 @@ async def delete_persona(persona_id: str, current_user: dict = Depends(get_curre
         raise HTTPException(status_code=400, detail="Cannot delete the last persona")
     
     # If deleting default persona, make another one default
-    if persona["is_default"]:
+    default_persona = resolve_default_persona(current_user)
+    if default_persona and default_persona["persona_id"] == persona_id:
         other_persona = personas_collection.find_one({
             "user_id": current_user["user_id"],
             "persona_id": {"$ne": persona_id}
         })
         if other_persona:
-            personas_collection.update_one(
-                {"persona_id": other_persona["persona_id"]},
-                {"$set": {"is_default": True}}
-            )
+            set_default_persona_pointer(current_user["user_id"], other_persona["persona_id"])
     
     personas_collection.delete_one({"persona_id": persona_id})
+    touch_personas(current_user["user_id"])
     return {"message": "Persona deleted successfully"}
 
-@app.get("/api/personas/default")
-async def get_default_persona(current_user: dict = Depends(get_current_user)):
-    """Get the default persona for the current user"""
-    if not current_user:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    persona = personas_collection.find_one({
-        "user_id": current_user["user_id"],
-        "is_default": True
-    }, {"_id": 0})
-    
-    if not persona:
-        # If no default persona exists, return the first one and make it default
-        persona = personas_collection.find_one({"user_id": current_user["user_id"]}, {"_id": 0})
-        if persona:
-            personas_collection.update_one(
-                {"persona_id": persona["persona_id"]},
-                {"$set": {"is_default": True}}
-            )
-            persona["is_default"] = True
-    
-    return persona or {}
-
 @app.post("/api/personas/{persona_id}/set-default")
 async def set_default_persona(persona_id: str, current_user: dict = Depends(get_current_user)):
     """Set a persona as the default"""
@@ -594,17 +3098,7 @@ async def set_default_persona(persona_id: str, current_user: dict = Depends(get_
     if not persona:
         raise HTTPException(status_code=404, detail="Persona not found")
     
-    # Remove default from all personas
-    personas_collection.update_many(
-        {"user_id": current_user["user_id"]},
-        {"$set": {"is_default": False}}
-    )
-    
-    # Set this persona as default
-    personas_collection.update_one(
-        {"persona_id": persona_id},
-        {"$set": {"is_default": True}}
-    )
+    set_default_persona_pointer(current_user["user_id"], persona_id)
     
     return {"message": "Default persona updated successfully"}
 
@@ -640,12 +3134,12 @@ async def get_characters(skip: int = 0, limit: int = 20, multiplayer_only: bool
     if multiplayer_only:
         filter_query["is_multiplayer"] = True
     
-    characters = list(characters_collection.find(filter_query, {"_id": 0}).skip(skip).limit(limit))
+    characters = await run_db(lambda: list(characters_collection.find(filter_query, {"_id": 0}).skip(skip).limit(limit)))
     return {"characters": characters}
 
 @app.get("/api/characters/{character_id}")
 async def get_character(character_id: str):
-    character = characters_collection.find_one({"character_id": character_id}, {"_id": 0})
+    character = await load_character(character_id)
     if not character:
         raise HTTPException(status_code=404, detail="Character not found")
     return character
@@ -672,18 +3166,24 @@ async def create_room(room_data: CreateRoomRequest, current_user: dict = Depends
     )
     
     multiplayer_rooms_collection.insert_one(room.dict())
+    presence_registry.heartbeat(room_id, current_user["user_id"])
     return {"room_id": room_id, "message": "Room created successfully"}
 
 @app.get("/api/rooms")
 async def get_rooms(skip: int = 0, limit: int = 20):
-    rooms = list(multiplayer_rooms_collection.find({"is_active": True, "is_private": False}, {"_id": 0}).skip(skip).limit(limit))
+    rooms = await run_db(lambda: list(multiplayer_rooms_collection.find({"is_active": True, "is_private": False}, {"_id": 0}).skip(skip).limit(limit)))
+    online = await online_participants([room["room_id"] for room in rooms])
+    for room in rooms:
+        room["online_count"] = len(online[room["room_id"]])
     return {"rooms": rooms}
 
 @app.get("/api/rooms/{room_id}")
 async def get_room(room_id: str):
-    room = multiplayer_rooms_collection.find_one({"room_id": room_id}, {"_id": 0})
+    room = await load_room(room_id)
     if not room:
         raise HTTPException(status_code=404, detail="Room not found")
+    room["online_participants"] = (await online_participants([room_id]))[room_id]
+    room["online_count"] = len(room["online_participants"])
     return room
 
 @app.post("/api/rooms/{room_id}/join")
@@ -691,40 +3191,77 @@ async def join_room(room_id: str, password: Optional[str] = None, current_user:
     if not current_user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
-    room = multiplayer_rooms_collection.find_one({"room_id": room_id})
-    if not room:
-        raise HTTPException(status_code=404, detail="Room not found")
+    user_id = current_user["user_id"]
+    # Published before the join lands so a reconcile running in between can't sweep the new participant
+    await run_db(record_presence, room_id, user_id)
     
-    if room["is_private"] and room["password"] != password:
-        raise HTTPException(status_code=403, detail="Invalid password")
+    # Password and capacity are checked by the update filter itself so concurrent
+    # joins can never push the room past max_participants
+    room = await run_db(
+        multiplayer_rooms_collection.find_one_and_update,
+        {
+            "room_id": room_id,
+            "$and": [
+                {"$or": [{"is_private": False}, {"password": password}]},
+                {"$or": [
+                    {"participants": user_id},
+                    {"$expr": {"$lt": [{"$size": "$participants"}, "$max_participants"]}}
+                ]}
+            ]
+        },
+        {"$addToSet": {"participants": user_id}, "$set": {"updated_at": datetime.utcnow()}},
+        projection={"_id": 0, "password": 0},
+        return_document=ReturnDocument.AFTER
+    )
     
-    if len(room["participants"]) >= room["max_participants"]:
+    if not room:
+        await run_db(room_presence_collection.delete_one, {"room_id": room_id, "user_id": user_id})
+        # Only the failure path pays for a second read, to explain the rejection
+        existing = await run_db(multiplayer_rooms_collection.find_one, {"room_id": room_id}, {"is_private": 1, "password": 1})
+        if not existing:
+            raise HTTPException(status_code=404, detail="Room not found")
+        if existing["is_private"] and existing.get("password") != password:
+            raise HTTPException(status_code=403, detail="Invalid password")
         raise HTTPException(status_code=403, detail="Room is full")
     
-    if current_user["user_id"] not in room["participants"]:
-        multiplayer_rooms_collection.update_one(
-            {"room_id": room_id},
-            {"$push": {"participants": current_user["user_id"]}, "$set": {"updated_at": datetime.utcnow()}}
-        )
-    
-    return {"message": "Joined room successfully"}
+    presence_registry.heartbeat(room_id, user_id)
+    return {"message": "Joined room successfully", "room": room}
 
 @app.post("/api/rooms/{room_id}/leave")
 async def leave_room(room_id: str, current_user: dict = Depends(get_current_user)):
     if not current_user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
-    room = multiplayer_rooms_collection.find_one({"room_id": room_id})
+    room = await run_db(
+        multiplayer_rooms_collection.find_one_and_update,
+        {"room_id": room_id},
+        {"$pull": {"participants": current_user["user_id"]}, "$set": {"updated_at": datetime.utcnow()}},
+        projection={"_id": 0, "password": 0},
+        return_document=ReturnDocument.AFTER
+    )
     if not room:
         raise HTTPException(status_code=404, detail="Room not found")
     
-    if current_user["user_id"] in room["participants"]:
-        multiplayer_rooms_collection.update_one(
-            {"room_id": room_id},
-            {"$pull": {"participants": current_user["user_id"]}, "$set": {"updated_at": datetime.utcnow()}}
-        )
+    presence_registry.leave(room_id, current_user["user_id"])
+    await run_db(room_presence_collection.delete_one, {"room_id": room_id, "user_id": current_user["user_id"]})
+    return {"message": "Left room successfully", "room": room}
+
+@app.post("/api/rooms/{room_id}/heartbeat")
+async def room_heartbeat(room_id: str, current_user: dict = Depends(get_current_user)):
+    """Mark the current user as online in a room; no database write"""
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    user_id = current_user["user_id"]
+    if not presence_registry.is_tracked(room_id, user_id):
+        # First heartbeat this worker has seen for the user: confirm membership once
+        room = await run_db(multiplayer_rooms_collection.find_one, {"room_id": room_id, "participants": user_id}, {"_id": 1})
+        if not room:
+            raise HTTPException(status_code=403, detail="Not a room participant")
     
-    return {"message": "Left room successfully"}
+    presence_registry.heartbeat(room_id, user_id)
+    online = await online_participants([room_id])
+    return {"room_id": room_id, "online_count": len(online[room_id]), "expires_in": PRESENCE_TTL_SECONDS}
 
 # Conversation management
 @app.post("/api/conversations")
@@ -752,79 +3289,265 @@ async def create_conversation(conversation_data: CreateConversationRequest, curr
 
 @app.get("/api/conversations/{user_id}")
 async def get_user_conversations(user_id: str):
-    conversations = list(conversations_collection.find({"user_id": user_id}, {"_id": 0}))
+    conversations = await run_db(lambda: list(conversations_collection.find({"user_id": user_id}, {"_id": 0})))
     return {"conversations": conversations}
 
 @app.get("/api/conversations/{conversation_id}/messages")
-async def get_conversation_messages(conversation_id: str):
-    messages = list(messages_collection.find({"conversation_id": conversation_id}, {"_id": 0}).sort("timestamp", 1))
-    return {"messages": messages}
+async def get_conversation_messages(conversation_id: str, limit: Optional[int] = None, before: Optional[datetime] = None):
+    """Conversation history, or with limit its newest page (before pages further back)"""
+    if limit is None:
+        messages = await run_db(load_conversation_messages, conversation_id)
+        return {"messages": messages}
+    limit = max(1, min(limit, 500))
+    if before is not None and before.tzinfo is not None:
+        # Stored timestamps are naive UTC
+        before = before.astimezone(timezone.utc).replace(tzinfo=None)
+    older = await run_db(latest_conversation_page, conversation_id, limit + 1, before)
+    return {"messages": list(reversed(older[:limit])), "has_more": len(older) > limit}
+
+@app.get("/api/conversations/{conversation_id}/messages/sync")
+async def sync_conversation_messages_endpoint(conversation_id: str, token: Optional[str] = None):
+    """Messages created, edited or deleted since the client's sync token; omit the token for a full load"""
+    return await run_db(sync_conversation_messages, conversation_id, token)
+
+async def load_own_conversation(conversation_id: str, current_user: Optional[dict]) -> dict:
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    conversation = await run_db(
+        conversations_collection.find_one, {"conversation_id": conversation_id, "user_id": current_user["user_id"]}, {"_id": 0}
+    )
+    if not conversation:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    if conversation.get("archived_at"):
+        await run_db(rehydrate_conversation, conversation_id)
+    return conversation
+
+@app.put("/api/conversations/{conversation_id}/messages/{message_id}")
+async def update_conversation_message(conversation_id: str, message_id: str, update: UpdateMessageRequest,
+                                      current_user: dict = Depends(get_current_user)):
+    """Edit the text of one of the user's own messages"""
+    await load_own_conversation(conversation_id, current_user)
+    existing = await run_db(message_store.find_by_ids, conversation_id, [message_id])
+    if not existing or existing[0]["conversation_id"] != conversation_id:
+        raise HTTPException(status_code=404, detail="Message not found")
+    if existing[0]["sender"] != "user" or existing[0]["sender_id"] != current_user["user_id"]:
+        raise HTTPException(status_code=403, detail="Only your own messages can be edited")
+    
+    message = await run_db(message_store.update_message, conversation_id, message_id,
+                           {"content": update.content, "edited_at": datetime.utcnow()})
+    if not message:
+        raise HTTPException(status_code=404, detail="Message not found")
+    if message.get("room_id"):
+        await run_db(bump_room_messages_version, message["room_id"])
+    return {"message": message}
+
+@app.delete("/api/conversations/{conversation_id}/messages/{message_id}")
+async def delete_conversation_message(conversation_id: str, message_id: str, current_user: dict = Depends(get_current_user)):
+    await load_own_conversation(conversation_id, current_user)
+    existing = await run_db(message_store.find_by_ids, conversation_id, [message_id])
+    if not existing or existing[0]["conversation_id"] != conversation_id:
+        raise HTTPException(status_code=404, detail="Message not found")
+    
+    deleted_at = datetime.utcnow()
+    if not await run_db(message_store.delete_message, conversation_id, message_id):
+        raise HTTPException(status_code=404, detail="Message not found")
+    await run_db(record_message_tombstone, existing[0], deleted_at)
+    if existing[0].get("room_id"):
+        await run_db(bump_room_messages_version, existing[0]["room_id"])
+    return {"message": "Message deleted successfully"}
+
+@app.get("/api/conversations/{conversation_id}/bootstrap")
+async def get_conversation_bootstrap(conversation_id: str, limit: int = 50, current_user: dict = Depends(get_current_user)):
+    """Load everything the chat view needs on open in a single round trip"""
+    limit = max(1, min(limit, 200))
+    
+    async def load_conversation_and_character():
+        conversation = await run_db(conversations_collection.find_one, {"conversation_id": conversation_id}, {"_id": 0})
+        if not conversation:
+            return None, None
+        character = await load_character(conversation["character_id"])
+        return conversation, character
+    
+    async def load_user_default_persona():
+        if not current_user:
+            return None
+        return await load_default_persona(current_user)
+    
+    # Newest page first (one extra to detect more), flipped back to chronological order below
+    (conversation, character), persona, latest = await asyncio.gather(
+        load_conversation_and_character(),
+        load_user_default_persona(),
+        run_db(message_store.latest_conversation_messages, conversation_id, limit + 1)
+    )
+    
+    if not conversation:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    if conversation.get("archived_at"):
+        history = await run_db(load_conversation_messages, conversation_id)
+        latest = history[::-1][:limit + 1]
+        conversation.pop("archived_at")
+        conversation.pop("archive", None)
+    # Opening the chat view is the cue that a message is coming; warm up for it
+    schedule_prewarm(conversation_id, current_user, conversation, character)
+    
+    has_more = len(latest) > limit
+    messages = list(reversed(latest[:limit]))
+    
+    return {
+        "conversation": conversation,
+        "character": character,
+        "default_persona": persona,
+        "messages": messages,
+        "has_more_messages": has_more,
+        "providers": list_ai_providers()
+    }
+
+@app.get("/api/archive/stats")
+async def get_archive_stats():
+    """Report how much storage cold-storage archival is saving"""
+    return await run_db(archive_storage_stats)
+
+@app.post("/api/conversations/{conversation_id}/prewarm", status_code=202)
+async def prewarm_conversation_endpoint(conversation_id: str, current_user: dict = Depends(get_current_user)):
+    """Warm caches for a conversation the client is about to chat in"""
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    schedule_prewarm(conversation_id, current_user)
+    return {"conversation_id": conversation_id, "status": "prewarming"}
 
 @app.get("/api/rooms/{room_id}/messages")
-async def get_room_messages(room_id: str):
-    messages = list(messages_collection.find({"room_id": room_id}, {"_id": 0}).sort("timestamp", 1))
-    return {"messages": messages}
+async def get_room_messages(room_id: str, limit: Optional[int] = None, before: Optional[datetime] = None):
+    """Room history, or with limit its newest page (before pages further back); recent messages come from memory"""
+    if limit is not None:
+        limit = max(1, min(limit, 500))
+    if before is not None and before.tzinfo is not None:
+        # Stored timestamps are naive UTC
+        before = before.astimezone(timezone.utc).replace(tzinfo=None)
+    buffer = await load_room_buffer(room_id)
+    page = room_buffers.page(buffer, limit, before)
+    if page is None:
+        # Reaches back past what is buffered
+        if limit is None:
+            return {"messages": await run_db(message_store.room_messages, room_id)}
+        older = await run_db(message_store.latest_room_messages, room_id, limit + 1, before)
+        page = (list(reversed(older[:limit])), len(older) > limit)
+    messages, has_more = page
+    if limit is None:
+        return {"messages": messages}
+    return {"messages": messages, "has_more": has_more}
 
 # AI Chat endpoint
 @app.post("/api/chat")
-async def chat(chat_request: ChatRequest, current_user: dict = Depends(get_current_user)):
+async def chat(chat_request: ChatRequest, request: Request, response: Response, current_user: dict = Depends(get_current_user),
+               idempotency_key: Optional[str] = Header(None)):
     if not current_user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
+    if idempotency_key:
+        # Runs to completion even if the client leaves; its retry picks up the stored result
+        return await run_idempotent_chat(idempotency_key, chat_request, current_user, response)
+    return await answer_chat(chat_request, current_user, request if CHAT_CANCEL_ON_DISCONNECT else None)
+
+async def answer_chat(chat_request: ChatRequest, current_user: dict, request: Optional[Request] = None) -> dict:
+    """Answer one chat message; given the request, a turn of its own is cancelled when that client disconnects"""
+    if chat_request.room_id and ROOM_TURN_WINDOW_SECONDS > 0:
+        room = await load_room(chat_request.room_id)
+        if room and len(room.get("participants", [])) > 1:
+            # The reply is shared with the other senders, so it isn't cancelled
+            return await run_room_turn(chat_request, current_user, room)
+    if request is not None:
+        return await cancel_on_disconnect(request, run_chat_turn(chat_request, current_user))
+    return await run_chat_turn(chat_request, current_user)
+
+async def wait_for_disconnect(request: Request):
+    # The body has already been read, so the next ASGI message is the disconnect
+    while (await request.receive())["type"] != "http.disconnect":
+        pass
+
+async def cancel_on_disconnect(request: Request, turn) -> dict:
+    """Await the turn coroutine, cancelling it if the client disconnects first"""
+    task = asyncio.ensure_future(turn)
+    watcher = asyncio.ensure_future(wait_for_disconnect(request))
     try:
-        # Get conversation or room details
-        if chat_request.room_id:
-            room = multiplayer_rooms_collection.find_one({"room_id": chat_request.room_id})
-            if not room:
-                raise HTTPException(status_code=404, detail="Room not found")
-            character = characters_collection.find_one({"character_id": room["character_id"]})
-            context_id = chat_request.room_id
-        else:
-            conversation = conversations_collection.find_one({"conversation_id": chat_request.conversation_id})
-            if not conversation:
-                raise HTTPException(status_code=404, detail="Conversation not found")
-            character = characters_collection.find_one({"character_id": conversation["character_id"]})
-            context_id = chat_request.conversation_id
-        
-        if not character:
-            raise HTTPException(status_code=404, detail="Character not found")
-        
-        # Get persona if specified
-        persona = None
-        if chat_request.persona_id:
-            persona = personas_collection.find_one({
-                "persona_id": chat_request.persona_id,
-                "user_id": current_user["user_id"]
-            }, {"_id": 0})
-        else:
-            # Use default persona if no specific persona provided
-            persona = personas_collection.find_one({
-                "user_id": current_user["user_id"],
-                "is_default": True
-            }, {"_id": 0})
+        done, _ = await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    finally:
+        watcher.cancel()
+    if task in done:
+        return task.result()
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    raise HTTPException(status_code=499, detail="Client closed request")
+
+async def record_cancelled_turn(context_id: str, user_message: Message, ai_provider: str, ai_model: str):
+    chat_cancellations.record_cancelled(ai_provider, ai_model)
+    # Unbounded: the turn is being cancelled, and this must land even if the request's budget is spent
+    await run_db_unbounded(message_store.update_message, context_id, user_message.message_id, {"reply_status": "cancelled"})
+    if user_message.room_id:
+        await run_db_unbounded(bump_room_messages_version, user_message.room_id)
+
+def build_user_message(chat_request: ChatRequest, user_id: str) -> Message:
+    return Message(
+        message_id=str(uuid.uuid4()),
+        conversation_id=chat_request.conversation_id,
+        room_id=chat_request.room_id,
+        sender="user",
+        sender_id=user_id,
+        content=chat_request.message,
+        timestamp=datetime.utcnow()
+    )
+
+async def run_chat_turn(chat_request: ChatRequest, current_user: dict, user_message: Optional[Message] = None,
+                        ai_message_id: Optional[str] = None) -> dict:
+    """Generate and store one chat turn; a user_message passed in has already been saved"""
+    started = time.perf_counter()
+    latency_label = chat_latency_label(chat_request.room_id or chat_request.conversation_id)
+    try:
+        with trace_span("chat.load_context"):
+            # Get conversation or room details
+            if chat_request.room_id:
+                room = await load_room(chat_request.room_id)
+                if not room:
+                    raise HTTPException(status_code=404, detail="Room not found")
+                character = await load_character(room["character_id"])
+                context_id = chat_request.room_id
+            else:
+                conversation, character = await load_conversation_context(chat_request.conversation_id)
+                if not conversation:
+                    raise HTTPException(status_code=404, detail="Conversation not found")
+                context_id = chat_request.conversation_id
+                if conversation.get("archived_at"):
+                    # Back to hot storage so memory recall and history see the earlier turns
+                    await run_db(rehydrate_conversation, chat_request.conversation_id)
+            
+            if not character:
+                raise HTTPException(status_code=404, detail="Character not found")
+            
+            # Get persona if specified
+            persona = None
+            if chat_request.persona_id:
+                persona = await load_persona(chat_request.persona_id, current_user["user_id"])
+            else:
+                # Use default persona if no specific persona provided
+                persona = await load_default_persona(current_user)
         
         # Use request AI settings
         ai_provider = chat_request.ai_provider or "openai"
         ai_model = chat_request.ai_model or "gpt-4.1"
         
         # Save user message first
-        user_message_id = str(uuid.uuid4())
-        user_message = Message(
-            message_id=user_message_id,
-            conversation_id=chat_request.conversation_id,
-            room_id=chat_request.room_id,
-            sender="user",
-            sender_id=current_user["user_id"],
-            content=chat_request.message,
-            timestamp=datetime.utcnow()
-        )
-        messages_collection.insert_one(user_message.dict())
+        if user_message is None:
+            user_message = build_user_message(chat_request, current_user["user_id"])
+            await run_db(message_store.insert, user_message.dict())
+            buffer_room_message(user_message.dict())
         
         # Get API key
         api_key = get_api_key(ai_provider)
         if not api_key:
             # Return a mock response when no API key is available
-            ai_message_id = str(uuid.uuid4())
+            ai_message_id = ai_message_id or str(uuid.uuid4())
             mock_response = f"Hello! I'm {character['name']}. I'd love to chat with you, but the AI service isn't configured yet. Please add your API keys to enable full AI functionality!"
             
             ai_message = Message(
@@ -838,7 +3561,10 @@ async def chat(chat_request: ChatRequest, current_user: dict = Depends(get_curre
                 ai_provider=ai_provider,
                 ai_model=ai_model
             )
-            messages_collection.insert_one(ai_message.dict())
+            await run_db(message_store.insert, ai_message.dict())
+            buffer_room_message(ai_message.dict())
+            await asyncio.to_thread(remember_messages, context_id, [user_message.dict()])
+            chat_latency.record(latency_label, time.perf_counter() - started)
             
             return {
                 "user_message": user_message.dict(),
@@ -855,21 +3581,25 @@ async def chat(chat_request: ChatRequest, current_user: dict = Depends(get_curre
         if not chat_request.room_id:
             mode = conversation.get("mode", "casual")
         
-        system_prompt = create_character_system_prompt(character, mode, persona)
-        
-        # Create AI chat instance
-        chat_instance = LlmChat(
-            api_key=api_key,
-            session_id=context_id,
-            system_message=system_prompt
-        ).with_model(ai_provider, ai_model)
+        with trace_span("chat.prompt_assembly"):
+            # Recall relevant turns that have fallen out of the provider's context
+            memories = await asyncio.to_thread(recall_memories, context_id, chat_request.message)
+            
+            system_prompt = create_character_system_prompt(character, mode, persona, memories)
         
         # Send message to AI
-        user_msg = UserMessage(text=chat_request.message)
-        ai_response = await chat_instance.send_message(user_msg)
+        try:
+            ai_response = await send_llm_message(api_key, context_id, system_prompt, ai_provider, ai_model, chat_request.message)
+        except asyncio.CancelledError:
+            # The client disconnected; no reply is stored for a turn nobody is waiting on
+            await record_cancelled_turn(context_id, user_message, ai_provider, ai_model)
+            raise
         
-        # Save AI response
-        ai_message_id = str(uuid.uuid4())
+        # Save AI response with its token usage
+        prompt_tokens = estimate_tokens(system_prompt) + estimate_tokens(chat_request.message)
+        completion_tokens = estimate_tokens(ai_response)
+        chat_cancellations.observe(ai_provider, ai_model, completion_tokens)
+        ai_message_id = ai_message_id or str(uuid.uuid4())
         ai_message = Message(
             message_id=ai_message_id,
             conversation_id=chat_request.conversation_id,
@@ -879,9 +3609,17 @@ async def chat(chat_request: ChatRequest, current_user: dict = Depends(get_curre
             content=ai_response,
             timestamp=datetime.utcnow(),
             ai_provider=ai_provider,
-            ai_model=ai_model
+            ai_model=ai_model,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            cost_usd=estimate_cost(ai_provider, ai_model, prompt_tokens, completion_tokens)
         )
-        messages_collection.insert_one(ai_message.dict())
+        await run_db(message_store.insert, ai_message.dict())
+        buffer_room_message(ai_message.dict())
+        usage_meter.record(current_user["user_id"], character["character_id"], ai_provider, ai_model,
+                           prompt_tokens, completion_tokens, ai_message.cost_usd, ai_message.timestamp)
+        await asyncio.to_thread(remember_messages, context_id, [user_message.dict(), ai_message.dict()])
+        chat_latency.record(latency_label, time.perf_counter() - started)
         
         return {
             "user_message": user_message.dict(),
@@ -891,25 +3629,557 @@ async def chat(chat_request: ChatRequest, current_user: dict = Depends(get_curre
             "persona_used": persona
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
+        if is_deadline_error(e):
+            raise deadline_exceeded()
         raise HTTPException(status_code=500, detail=f"Chat error: {str(e)}")
 
+# Idempotency keys
+idempotency_events: Dict[str, asyncio.Event] = {}
+
+def ensure_idempotency_indexes():
+    idempotency_keys_collection.create_index("key", unique=True)
+    idempotency_keys_collection.create_index("expires_at", expireAfterSeconds=0)
+
+def claim_idempotency_key(key: str, request_hash: str) -> tuple:
+    """Start executing under key, or find who already did; returns (record, owned)"""
+    now = datetime.utcnow()
+    try:
+        idempotency_keys_collection.insert_one({
+            "key": key,
+            "request_hash": request_hash,
+            "status": "running",
+            "lease_until": now + timedelta(seconds=IDEMPOTENCY_LEASE_SECONDS),
+            "created_at": now,
+            "expires_at": now + timedelta(seconds=IDEMPOTENCY_TTL_SECONDS)
+        })
+        return None, True
+    except DuplicateKeyError:
+        pass
+    # A failed attempt, or one whose process died mid-call, is re-run by whoever retries first
+    record = idempotency_keys_collection.find_one_and_update(
+        {"key": key, "request_hash": request_hash,
+         "$or": [{"status": "failed"}, {"status": "running", "lease_until": {"$lt": now}}]},
+        {"$set": {"status": "running", "lease_until": now + timedelta(seconds=IDEMPOTENCY_LEASE_SECONDS), "error": None}},
+        projection={"_id": 0}
+    )
+    if record:
+        return record, True
+    return idempotency_keys_collection.find_one({"key": key}, {"_id": 0}), False
+
+def finish_idempotency_key(key: str, outcome: str, result: Optional[dict] = None, error: Optional[dict] = None):
+    idempotency_keys_collection.update_one(
+        {"key": key},
+        {"$set": {"status": outcome, "result": result, "error": error, "finished_at": datetime.utcnow()}}
+    )
+
+def notify_idempotency_key(key: str):
+    event = idempotency_events.get(key)
+    if event is not None:
+        event.set()
+
+async def wait_for_idempotency_key(key: str, timeout: float) -> Optional[dict]:
+    """Return the key's record once its execution finishes or timeout passes"""
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            record = await run_db(idempotency_keys_collection.find_one, {"key": key}, {"_id": 0})
+            remaining = deadline - time.monotonic()
+            if not record or record["status"] != "running" or remaining <= 0:
+                return record
+            event = idempotency_events.setdefault(key, asyncio.Event())
+            try:
+                await asyncio.wait_for(event.wait(), min(remaining, IDEMPOTENCY_POLL_SECONDS))
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        idempotency_events.pop(key, None)
+
+async def run_idempotent_chat(idempotency_key: str, chat_request: ChatRequest, current_user: dict, response: Response) -> dict:
+    """Answer a chat request at most once per Idempotency-Key.
+    
+    The first request with a key runs the turn and stores its result for
+    IDEMPOTENCY_TTL_SECONDS. Repeats get the stored result, or wait for it
+    while the first is still running, so a client retrying after a timeout
+    doesn't pay for a second provider call or store duplicate messages.
+    Failures are not stored as final; the next retry runs the turn again.
+    """
+    if len(idempotency_key) > 255:
+        raise HTTPException(status_code=400, detail="Idempotency-Key must be at most 255 characters")
+    key = f"{current_user['user_id']}:{idempotency_key}"
+    request_hash = hashlib.sha256(json.dumps(chat_request.dict(), sort_keys=True).encode()).hexdigest()
+    
+    while True:
+        record, owned = await run_db(claim_idempotency_key, key, request_hash)
+        if owned:
+            break
+        if record and record["request_hash"] != request_hash:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request")
+        if record and record["status"] == "running":
+            record = await wait_for_idempotency_key(key, IDEMPOTENCY_WAIT_SECONDS)
+            if record and record["status"] == "running":
+                raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+        if record and record["status"] == "done":
+            response.headers["Idempotent-Replayed"] = "true"
+            return record["result"]
+        if record and record["status"] == "failed":
+            raise HTTPException(status_code=record["error"]["status_code"], detail=record["error"]["detail"])
+        # The record expired or was taken over in between; claim again
+    
+    try:
+        result = await answer_chat(chat_request, current_user)
+    except (Exception, asyncio.CancelledError) as e:
+        if isinstance(e, HTTPException):
+            error = {"status_code": e.status_code, "detail": e.detail}
+        elif isinstance(e, asyncio.CancelledError):
+            error = {"status_code": 409, "detail": "The request with this Idempotency-Key was cancelled; retry it"}
+        elif is_deadline_error(e):
+            error = {"status_code": 504, "detail": "Request deadline exceeded"}
+        else:
+            error = {"status_code": 500, "detail": f"Chat error: {str(e)}"}
+        await run_db_unbounded(finish_idempotency_key, key, "failed", error=error)
+        notify_idempotency_key(key)
+        raise
+    await run_db_unbounded(finish_idempotency_key, key, "done", result=result)
+    notify_idempotency_key(key)
+    return result
+
+# Room turns
+ROOM_TURN_TERMINAL = ("done", "failed")
+ROOM_TURN_INSTRUCTIONS = (
+    "\n\nSeveral participants have spoken since your last reply. Their messages are given as \"Name: message\" lines. "
+    "Reply once, in character, responding to each of them."
+)
+
+room_turn_events: Dict[str, asyncio.Event] = {}
+
+def ensure_room_turn_indexes():
+    room_turns_collection.create_index("turn_id", unique=True)
+    # At most one turn per room collecting messages at a time
+    room_turns_collection.create_index("room_id", unique=True, partialFilterExpression={"status": "collecting"})
+    room_turns_collection.create_index("expires_at", expireAfterSeconds=0)
+
+def join_room_turn(room_id: str, entry: dict) -> tuple:
+    """Add a message to the room's collecting turn, opening one if there is none; returns (turn, opened)"""
+    while True:
+        now = datetime.utcnow()
+        stale = now - timedelta(seconds=ROOM_TURN_TIMEOUT_SECONDS)
+        turn = room_turns_collection.find_one_and_update(
+            {"room_id": room_id, "status": "collecting", "closes_at": {"$gt": stale}},
+            {"$push": {"messages": entry}},
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+        if turn:
+            return turn, False
+        turn = {
+            "turn_id": str(uuid.uuid4()),
+            "room_id": room_id,
+            "status": "collecting",
+            "messages": [entry],
+            "opened_at": now,
+            "closes_at": now + timedelta(seconds=ROOM_TURN_WINDOW_SECONDS),
+            "expires_at": now + timedelta(seconds=ROOM_TURN_TIMEOUT_SECONDS * 2)
+        }
+        try:
+            room_turns_collection.insert_one(dict(turn))
+            return turn, True
+        except DuplicateKeyError:
+            # Another request opened one first (join it next pass), or the room is held by a
+            # turn whose opener died before closing it
+            room_turns_collection.update_many(
+                {"room_id": room_id, "status": "collecting", "closes_at": {"$lte": stale}},
+                {"$set": {"status": "failed", "error": {"status_code": 504, "detail": "Room turn abandoned"}}}
+            )
+
+def close_room_turn(turn_id: str) -> Optional[dict]:
+    """Stop a turn accepting messages, returning everything that made it in"""
+    return room_turns_collection.find_one_and_update(
+        {"turn_id": turn_id, "status": "collecting"},
+        {"$set": {"status": "generating"}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+
+def finish_room_turn(turn_id: str, outcome: str, result: Optional[dict] = None, error: Optional[dict] = None):
+    room_turns_collection.update_one(
+        {"turn_id": turn_id},
+        {"$set": {"status": outcome, "result": result, "error": error, "finished_at": datetime.utcnow()}}
+    )
+
+def notify_room_turn(turn_id: str):
+    event = room_turn_events.get(turn_id)
+    if event is not None:
+        event.set()
+
+async def wait_for_room_turn(turn_id: str, timeout: float) -> Optional[dict]:
+    """Return the turn once it finishes or timeout passes, woken early when it was answered in this process"""
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            turn = await run_db(room_turns_collection.find_one, {"turn_id": turn_id}, {"_id": 0})
+            remaining = deadline - time.monotonic()
+            if not turn or turn["status"] in ROOM_TURN_TERMINAL or remaining <= 0:
+                return turn
+            event = room_turn_events.setdefault(turn_id, asyncio.Event())
+            try:
+                await asyncio.wait_for(event.wait(), min(remaining, ROOM_TURN_POLL_SECONDS))
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        room_turn_events.pop(turn_id, None)
+
+async def generate_room_reply(room: dict, character: dict, turn: dict, chat_request: ChatRequest, current_user: dict) -> dict:
+    """One character reply to every message collected in a room turn"""
+    room_id = room["room_id"]
+    entries = turn["messages"]
+    ai_provider = chat_request.ai_provider or "openai"
+    ai_model = chat_request.ai_model or "gpt-4.1"
+    if len(entries) == 1:
+        prompt_text = entries[0]["content"]
+    else:
+        prompt_text = "\n".join(f"{entry['name']}: {entry['content']}" for entry in entries)
+    
+    prompt_tokens = completion_tokens = None
+    cost_usd = None
+    api_key = get_api_key(ai_provider)
+    if not api_key:
+        ai_response = f"Hello! I'm {character['name']}. I'd love to chat with you, but the AI service isn't configured yet. Please add your API keys to enable full AI functionality!"
+    else:
+        with trace_span("chat.prompt_assembly"):
+            memories = await asyncio.to_thread(recall_memories, room_id, prompt_text)
+            system_prompt = create_character_system_prompt(character, "casual", None, memories)
+            if len(entries) > 1:
+                system_prompt += ROOM_TURN_INSTRUCTIONS
+        ai_response = await send_llm_message(api_key, room_id, system_prompt, ai_provider, ai_model, prompt_text)
+        prompt_tokens = estimate_tokens(system_prompt) + estimate_tokens(prompt_text)
+        completion_tokens = estimate_tokens(ai_response)
+        cost_usd = estimate_cost(ai_provider, ai_model, prompt_tokens, completion_tokens)
+    
+    ai_message = Message(
+        message_id=str(uuid.uuid4()),
+        conversation_id=chat_request.conversation_id,
+        room_id=room_id,
+        sender="character",
+        sender_id=character["character_id"],
+        content=ai_response,
+        timestamp=datetime.utcnow(),
+        ai_provider=ai_provider,
+        ai_model=ai_model,
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        cost_usd=cost_usd
+    )
+    await run_db(message_store.insert, ai_message.dict())
+    buffer_room_message(ai_message.dict())
+    if prompt_tokens is not None:
+        # The call is metered to the participant whose message opened the turn
+        usage_meter.record(current_user["user_id"], character["character_id"], ai_provider, ai_model,
+                           prompt_tokens, completion_tokens, cost_usd, ai_message.timestamp)
+    await asyncio.to_thread(remember_messages, room_id, [*entries, ai_message.dict()])
+    return {"ai_response": ai_message.dict(), "ai_provider": ai_provider, "ai_model": ai_model}
+
+async def run_room_turn(chat_request: ChatRequest, current_user: dict, room: dict) -> dict:
+    """Store a room message and answer it with the single character reply shared by its turn.
+    
+    Messages arriving within ROOM_TURN_WINDOW_SECONDS of the first one join the
+    same turn, whichever worker receives them. The request that opened the turn
+    waits out the window, makes the LLM call and stores the reply; the others
+    wait for it and return the same reply alongside their own message.
+    """
+    character = await load_character(room["character_id"])
+    if not character:
+        raise HTTPException(status_code=404, detail="Character not found")
+    if chat_request.persona_id:
+        persona = await load_persona(chat_request.persona_id, current_user["user_id"])
+    else:
+        persona = await load_default_persona(current_user)
+    
+    user_message = build_user_message(chat_request, current_user["user_id"])
+    await run_db(message_store.insert, user_message.dict())
+    buffer_room_message(user_message.dict())
+    
+    entry = {
+        "message_id": user_message.message_id,
+        "user_id": current_user["user_id"],
+        "name": (persona or {}).get("name") or current_user.get("username") or "Participant",
+        "content": user_message.content
+    }
+    turn, opened = await run_db(join_room_turn, room["room_id"], entry)
+    turn_id = turn["turn_id"]
+    if opened:
+        await asyncio.sleep(ROOM_TURN_WINDOW_SECONDS)
+        closed = await run_db(close_room_turn, turn_id)
+        if closed is None:
+            # The turn left "collecting" without us, e.g. the stale sweep failed it;
+            # answer with whatever it became rather than the snapshot from joining
+            turn = await run_db(room_turns_collection.find_one, {"turn_id": turn_id}, {"_id": 0})
+            if not turn:
+                raise HTTPException(status_code=504, detail="Room turn abandoned")
+            opened = False
+        else:
+            turn = closed
+    if opened:
+        try:
+            result = await generate_room_reply(room, character, turn, chat_request, current_user)
+        except Exception as e:
+            error = {"status_code": e.status_code, "detail": e.detail} if isinstance(e, HTTPException) else {"status_code": 500, "detail": f"Chat error: {str(e)}"}
+            await run_db_unbounded(finish_room_turn, turn_id, "failed", error=error)
+            notify_room_turn(turn_id)
+            raise HTTPException(status_code=error["status_code"], detail=error["detail"])
+        await run_db_unbounded(finish_room_turn, turn_id, "done", result=result)
+        notify_room_turn(turn_id)
+    else:
+        if turn["status"] not in ROOM_TURN_TERMINAL:
+            turn = await wait_for_room_turn(turn_id, ROOM_TURN_TIMEOUT_SECONDS)
+        if not turn or turn["status"] not in ROOM_TURN_TERMINAL:
+            raise HTTPException(status_code=504, detail="Room turn timed out")
+        if turn["status"] == "failed":
+            raise HTTPException(status_code=turn["error"]["status_code"], detail=turn["error"]["detail"])
+        result = turn["result"]
+    
+    return {
+        "user_message": user_message.dict(),
+        **result,
+        "persona_used": persona,
+        "turn_messages": len(turn["messages"])
+    }
+
+# Chat jobs
+CHAT_JOB_TERMINAL = ("succeeded", "failed")
+
+chat_job_events: Dict[str, asyncio.Event] = {}
+chat_job_wakeup: Optional[asyncio.Event] = None  # created on the serving loop by start_background_tasks
+
+def ensure_chat_job_indexes():
+    chat_jobs_collection.create_index("job_id", unique=True)
+    chat_jobs_collection.create_index([("status", 1), ("run_after", 1), ("created_at", 1)])
+    chat_jobs_collection.create_index("expires_at", expireAfterSeconds=0)
+
+def claim_chat_job(worker_id: str) -> Optional[dict]:
+    """Take the oldest runnable job, including running ones whose worker stopped renewing its lease"""
+    now = datetime.utcnow()
+    return chat_jobs_collection.find_one_and_update(
+        {"$or": [
+            {"status": "queued", "run_after": {"$lte": now}},
+            {"status": "running", "lease_until": {"$lt": now}}
+        ]},
+        {
+            "$set": {"status": "running", "worker_id": worker_id, "started_at": now, "updated_at": now,
+                     "lease_until": now + timedelta(seconds=CHAT_JOB_LEASE_SECONDS)},
+            "$inc": {"attempts": 1}
+        },
+        sort=[("created_at", 1)],
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+
+def finish_chat_job(job_id: str, worker_id: str, outcome: str, result: Optional[dict] = None, error: Optional[dict] = None):
+    now = datetime.utcnow()
+    chat_jobs_collection.update_one(
+        {"job_id": job_id, "worker_id": worker_id},
+        {
+            "$set": {"status": outcome, "result": result, "error": error, "finished_at": now, "updated_at": now,
+                     "expires_at": now + timedelta(seconds=CHAT_JOB_TTL_SECONDS)},
+            "$unset": {"lease_until": ""}
+        }
+    )
+
+def retry_chat_job(job: dict, worker_id: str, error: dict):
+    now = datetime.utcnow()
+    chat_jobs_collection.update_one(
+        {"job_id": job["job_id"], "worker_id": worker_id},
+        {
+            "$set": {"status": "queued", "error": error, "updated_at": now,
+                     "run_after": now + timedelta(seconds=2 ** job["attempts"])},
+            "$unset": {"lease_until": "", "worker_id": ""}
+        }
+    )
+
+def release_chat_job(job_id: str, worker_id: str):
+    """Hand a job back to the queue without spending an attempt"""
+    chat_jobs_collection.update_one(
+        {"job_id": job_id, "worker_id": worker_id, "status": "running"},
+        {"$set": {"status": "queued", "run_after": datetime.utcnow()}, "$unset": {"lease_until": "", "worker_id": ""}, "$inc": {"attempts": -1}}
+    )
+
+def notify_chat_job(job_id: str):
+    event = chat_job_events.pop(job_id, None)
+    if event is not None:
+        event.set()
+
+async def renew_chat_job_lease(job_id: str, worker_id: str):
+    while True:
+        await asyncio.sleep(CHAT_JOB_LEASE_SECONDS / 3)
+        await run_db(
+            chat_jobs_collection.update_one,
+            {"job_id": job_id, "worker_id": worker_id, "status": "running"},
+            {"$set": {"lease_until": datetime.utcnow() + timedelta(seconds=CHAT_JOB_LEASE_SECONDS)}}
+        )
+
+async def execute_chat_job(job: dict) -> dict:
+    # Jobs carry the submitting request's ID and, when it was sampled, join its trace
+    request_id = job.get("request_id") or job["job_id"]
+    root = start_trace("chat_job.execute", request_id, bool(job.get("trace_id")) or trace_sampled(), trace_id=job.get("trace_id"),
+                       **{"job.id": job["job_id"], "job.attempt": job["attempts"]})
+    with trace_root(root, request_id):
+        user = await run_db(users_collection.find_one, {"user_id": job["user_id"]}, {"_id": 0})
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found")
+        chat_request = ChatRequest(**job["request"])
+        user_message = Message(**job["user_message"])
+        
+        # A previous attempt may have stored the reply and died before marking the job done
+        context_id = chat_request.room_id or chat_request.conversation_id
+        stored = await run_db(message_store.find_by_ids, context_id, [job["ai_message_id"]])
+        if stored:
+            return {"user_message": user_message.dict(), "ai_response": stored[0], "ai_provider": stored[0].get("ai_provider"),
+                    "ai_model": stored[0].get("ai_model"), "persona_used": None}
+        return await run_chat_turn(chat_request, user, user_message, job["ai_message_id"])
+
+async def chat_job_worker(index: int):
+    """One slot of the bounded pool that runs queued chat turns"""
+    worker_id = f"{os.getpid()}-{index}-{uuid.uuid4().hex[:8]}"
+    while True:
+        try:
+            job = await run_db(claim_chat_job, worker_id)
+        except Exception as e:
+            print(f"Chat job claim error: {e}")
+            job = None
+        if not job:
+            chat_job_wakeup.clear()
+            try:
+                await asyncio.wait_for(chat_job_wakeup.wait(), CHAT_JOB_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        
+        renewer = asyncio.create_task(renew_chat_job_lease(job["job_id"], worker_id))
+        try:
+            if job["attempts"] > CHAT_JOB_MAX_ATTEMPTS:
+                await run_db(finish_chat_job, job["job_id"], worker_id, "failed",
+                             error={"status_code": 500, "detail": f"Gave up after {CHAT_JOB_MAX_ATTEMPTS} attempts"})
+            else:
+                result = await execute_chat_job(job)
+                await run_db(finish_chat_job, job["job_id"], worker_id, "succeeded", result=result)
+        except asyncio.CancelledError:
+            # Shutting down: requeue now rather than waiting for the lease to lapse
+            release_chat_job(job["job_id"], worker_id)
+            raise
+        except HTTPException as e:
+            error = {"status_code": e.status_code, "detail": e.detail}
+            if e.status_code >= 500 and job["attempts"] < CHAT_JOB_MAX_ATTEMPTS:
+                await run_db(retry_chat_job, job, worker_id, error)
+            else:
+                await run_db(finish_chat_job, job["job_id"], worker_id, "failed", error=error)
+        except Exception as e:
+            print(f"Chat job {job['job_id']} error: {e}")
+        finally:
+            renewer.cancel()
+        notify_chat_job(job["job_id"])
+
+def public_chat_job(job: dict) -> dict:
+    return {key: job.get(key) for key in ("job_id", "status", "attempts", "created_at", "finished_at", "result", "error")}
+
+async def wait_for_chat_job(job_id: str, user_id: str, timeout: float) -> Optional[dict]:
+    """Return the job once it finishes or timeout passes, woken early by workers in this process"""
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            job = await run_db(chat_jobs_collection.find_one, {"job_id": job_id, "user_id": user_id}, {"_id": 0})
+            remaining = deadline - time.monotonic()
+            if not job or job["status"] in CHAT_JOB_TERMINAL or remaining <= 0:
+                return job
+            # Jobs finished by another process are only seen by re-reading
+            event = chat_job_events.setdefault(job_id, asyncio.Event())
+            try:
+                await asyncio.wait_for(event.wait(), min(remaining, CHAT_JOB_POLL_SECONDS))
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        chat_job_events.pop(job_id, None)
+
+@app.post("/api/chat/jobs", status_code=202)
+async def submit_chat_job(chat_request: ChatRequest, current_user: dict = Depends(get_current_user)):
+    """Queue a chat turn and return its job id without waiting for the AI reply"""
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    if chat_request.room_id:
+        if not await load_room(chat_request.room_id):
+            raise HTTPException(status_code=404, detail="Room not found")
+    elif not await run_db(conversations_collection.find_one, {"conversation_id": chat_request.conversation_id}, {"_id": 1}):
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    
+    # The user's message is stored now so it shows up in history straight away
+    user_message = build_user_message(chat_request, current_user["user_id"])
+    await run_db(message_store.insert, user_message.dict())
+    buffer_room_message(user_message.dict())
+    
+    now = datetime.utcnow()
+    span = current_span.get()
+    job = {
+        "job_id": str(uuid.uuid4()),
+        "user_id": current_user["user_id"],
+        "status": "queued",
+        "request_id": current_request_id.get(),
+        "trace_id": span.trace_id if span is not None else None,
+        "request": chat_request.dict(),
+        "user_message": user_message.dict(),
+        "ai_message_id": str(uuid.uuid4()),
+        "attempts": 0,
+        "run_after": now,
+        "created_at": now,
+        "updated_at": now
+    }
+    await run_db(chat_jobs_collection.insert_one, job)
+    if chat_job_wakeup is not None:
+        chat_job_wakeup.set()
+    return {"job_id": job["job_id"], "status": "queued", "user_message": user_message.dict()}
+
+@app.get("/api/chat/jobs/{job_id}")
+async def get_chat_job(job_id: str, wait: float = 0, current_user: dict = Depends(get_current_user)):
+    """Poll a chat job; wait holds the request open up to that many seconds for it to finish"""
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    job = await wait_for_chat_job(job_id, current_user["user_id"], max(0.0, min(wait, CHAT_JOB_MAX_WAIT_SECONDS)))
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return public_chat_job(job)
+
+@app.get("/api/chat/jobs/{job_id}/events")
+async def stream_chat_job(job_id: str, current_user: dict = Depends(get_current_user)):
+    """Push a chat job's status changes and result as server-sent events"""
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    job = await run_db(chat_jobs_collection.find_one, {"job_id": job_id, "user_id": current_user["user_id"]}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    def sse(event: str, data: dict) -> bytes:
+        return f"event: {event}\ndata: ".encode("utf-8") + encode_ndjson(data) + b"\n"
+    
+    async def events():
+        current = job
+        last_status = None
+        while True:
+            if current["status"] != last_status:
+                last_status = current["status"]
+                yield sse("status", {"job_id": job_id, "status": last_status})
+            if last_status in CHAT_JOB_TERMINAL:
+                yield sse("result", public_chat_job(current))
+                return
+            current = await wait_for_chat_job(job_id, current_user["user_id"], CHAT_JOB_POLL_SECONDS) or current
+    
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
 # AI providers endpoint
 @app.get("/api/ai-providers")
 async def get_ai_providers():
-    providers = []
-    
-    for provider, config in AVAILABLE_MODELS.items():
-        api_key = get_api_key(provider)
-        providers.append({
-            "id": provider,
-            "name": provider.title(),
-            "available": api_key is not None,
-            "models": config["models"],
-            "default_model": config["default"]
-        })
-    
-    return {"providers": providers}
+    return {"providers": list_ai_providers()}
 
 # Update conversation AI settings
 @app.put("/api/conversations/{conversation_id}/ai-settings")
@@ -928,9 +4198,386 @@ async def update_conversation_ai_settings(conversation_id: str, ai_provider: str
         {"conversation_id": conversation_id},
         {"$set": {"ai_provider": ai_provider, "ai_model": ai_model, "updated_at": datetime.utcnow()}}
     )
+    conversation_context_cache.invalidate(conversation_id)
     
     return {"message": "AI settings updated successfully"}
 
-if __name__ == "__main__":
+# Usage rollups
+@app.get("/api/usage")
+async def get_usage(group_by: str = "model", key: Optional[str] = None, since: Optional[str] = None,
+                    until: Optional[str] = None, limit: int = 100, current_user: dict = Depends(get_current_user)):
+    """Token and cost totals per user, character or model over a range of days (YYYY-MM-DD, inclusive).
+    
+    Admins see totals across all users; everyone else sees only their own usage.
+    """
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    if group_by not in USAGE_DIMENSIONS:
+        raise HTTPException(status_code=400, detail=f"group_by must be one of: {', '.join(USAGE_DIMENSIONS)}")
+    
+    query: Dict[str, Any] = {"dimension": group_by, "user_id": None}
+    if current_user["user_id"] not in ADMIN_USER_IDS:
+        if group_by == "user":
+            key = current_user["user_id"]
+        else:
+            query["user_id"] = current_user["user_id"]
+    if key:
+        query["key"] = key
+    if since or until:
+        query["day"] = {}
+        if since:
+            query["day"]["$gte"] = since
+        if until:
+            query["day"]["$lte"] = until
+    
+    pipeline = [
+        {"$match": query},
+        {"$group": {
+            "_id": "$key",
+            "messages": {"$sum": "$messages"},
+            "prompt_tokens": {"$sum": "$prompt_tokens"},
+            "completion_tokens": {"$sum": "$completion_tokens"},
+            "cost_usd": {"$sum": "$cost_usd"}
+        }},
+        {"$sort": {"cost_usd": -1}},
+        {"$limit": max(1, min(limit, 1000))}
+    ]
+    rows = await run_db(lambda: list(usage_rollups_collection.aggregate(pipeline)))
+    rollups = [{"key": row.pop("_id"), **row, "cost_usd": round(row["cost_usd"], 6)} for row in rows]
+    return {"group_by": group_by, "since": since, "until": until, "rollups": rollups}
+
+# Conversation export/import
+_DATETIME_FIELDS = ("timestamp", "created_at", "updated_at")
+
+def encode_ndjson(record: dict) -> bytes:
+    return (json.dumps(record, default=lambda value: value.isoformat() if isinstance(value, datetime) else str(value)) + "\n").encode("utf-8")
+
+def export_conversation_lines(user_id: str):
+    """Yield NDJSON lines for a user's conversations, each followed by its messages, straight from cursors"""
+    conversations = conversations_collection.find({"user_id": user_id}, {"_id": 0}).sort("created_at", 1)
+    for conversation in conversations:
+        archived = conversation.pop("archived_at", None)
+        for field in ("archive", "archive_lock_until"):
+            conversation.pop(field, None)
+        yield encode_ndjson({"type": "conversation", **conversation})
+        if archived:
+            # Read without rehydrating so an export doesn't warm every old conversation
+            messages = merge_messages(load_archived_messages(conversation["conversation_id"]),
+                                      message_store.conversation_messages(conversation["conversation_id"]))
+        else:
+            messages = message_store.iter_conversation_messages(conversation["conversation_id"], EXPORT_CURSOR_BATCH_SIZE)
+        for message in messages:
+            yield encode_ndjson({"type": "message", **message})
+
+def chunk_lines(lines, chunk_bytes: int = EXPORT_CHUNK_BYTES):
+    """Group small lines into larger chunks so the response isn't one write per line"""
+    buffer = []
+    size = 0
+    for line in lines:
+        buffer.append(line)
+        size += len(line)
+        if size >= chunk_bytes:
+            yield b"".join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield b"".join(buffer)
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(wbits=31)  # 31 selects the gzip container
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+def is_valid_imported_message(record: dict) -> bool:
+    """Whether a message record has the fields readers of stored messages rely on"""
+    return (
+        isinstance(record.get("message_id"), str) and bool(record["message_id"])
+        and isinstance(record.get("timestamp"), datetime)
+        and record.get("sender") in ("user", "character")
+        and isinstance(record.get("content"), str)
+    )
+
+class ConversationImporter:
+    """Turns exported NDJSON records into batched, unordered inserts for one user.
+    
+    Conversations and messages get fresh ids so an export can be imported into
+    the same account it came from; a message is kept only if its conversation
+    appeared earlier in the stream, which is the order the exporter writes.
+    Room ids are dropped, since rooms are shared with other users, and messages
+    missing a required field are rejected.
+    """
+    
+    def __init__(self, user_id: str, batch_size: int = IMPORT_BATCH_SIZE):
+        self.user_id = user_id
+        self.batch_size = batch_size
+        self.conversation_ids: Dict[str, str] = {}
+        self.conversations: List[dict] = []
+        self.messages: List[dict] = []
+        self.stats = {"conversations": 0, "messages": 0, "skipped": 0, "rejected": 0, "errors": 0}
+    
+    def add(self, record: dict) -> bool:
+        """Queue a record, returning True when a batch is ready to flush"""
+        if not isinstance(record, dict):
+            self.stats["skipped"] += 1
+            return False
+        record_type = record.pop("type", None)
+        # An imported record must not place anything in someone else's room
+        record.pop("room_id", None)
+        record.pop("_id", None)
+        for field in _DATETIME_FIELDS:
+            if isinstance(record.get(field), str):
+                record[field] = datetime.fromisoformat(record[field])
+            if isinstance(record.get(field), datetime) and record[field].tzinfo is not None:
+                # Stored timestamps are naive UTC
+                record[field] = record[field].astimezone(timezone.utc).replace(tzinfo=None)
+        
+        if record_type == "conversation" and record.get("conversation_id"):
+            new_id = str(uuid.uuid4())
+            self.conversation_ids[record["conversation_id"]] = new_id
+            record.update({"conversation_id": new_id, "user_id": self.user_id})
+            self.conversations.append(record)
+        elif record_type == "message" and record.get("conversation_id") in self.conversation_ids:
+            if not is_valid_imported_message(record):
+                self.stats["rejected"] += 1
+                return False
+            record.update({
+                "message_id": str(uuid.uuid4()),
+                "conversation_id": self.conversation_ids[record["conversation_id"]]
+            })
+            if record.get("sender") == "user":
+                record["sender_id"] = self.user_id
+            self.messages.append(record)
+        else:
+            self.stats["skipped"] += 1
+            return False
+        return len(self.conversations) + len(self.messages) >= self.batch_size
+    
+    def _insert(self, insert_many, documents: List[dict]) -> int:
+        if not documents:
+            return 0
+        try:
+            return insert_many(documents)
+        except BulkWriteError as e:
+            self.stats["errors"] += len(e.details.get("writeErrors", []))
+            return e.details.get("nInserted", 0)
+    
+    def flush(self):
+        # Conversations first so no batch leaves messages without their parent
+        conversations, self.conversations = self.conversations, []
+        messages, self.messages = self.messages, []
+        self.stats["conversations"] += self._insert(
+            lambda documents: len(conversations_collection.insert_many(documents, ordered=False).inserted_ids), conversations
+        )
+        self.stats["messages"] += self._insert(message_store.insert_many, messages)
+
+async def iter_ndjson_records(request: Request, compressed: bool):
+    """Parse NDJSON records from the request body as it arrives"""
+    decompressor = zlib.decompressobj(wbits=47) if compressed else None  # 47 accepts gzip or zlib
+    pending = b""
+    async for chunk in request.stream():
+        if decompressor is not None:
+            chunk = decompressor.decompress(chunk)
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+    if decompressor is not None:
+        pending += decompressor.flush()
+    if pending.strip():
+        yield json.loads(pending)
+
+@app.get("/api/export/conversations")
+async def export_conversations(compress: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+    """Stream all of the current user's conversations and messages as NDJSON"""
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    if compress not in (None, "gzip"):
+        raise HTTPException(status_code=400, detail=f"Unsupported compression: {compress}")
+    
+    # A sync generator: Starlette iterates it in a worker thread, so the cursors never block the loop
+    chunks = chunk_lines(export_conversation_lines(current_user["user_id"]))
+    if compress == "gzip":
+        return StreamingResponse(gzip_chunks(chunks), media_type="application/gzip",
+                                 headers={"Content-Disposition": 'attachment; filename="conversations.ndjson.gz"'})
+    return StreamingResponse(chunks, media_type="application/x-ndjson",
+                             headers={"Content-Disposition": 'attachment; filename="conversations.ndjson"'})
+
+@app.post("/api/import/conversations")
+async def import_conversations(request: Request, compress: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+    """Bulk import an NDJSON export (gzip allowed) into the current user's account"""
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    compressed = compress == "gzip" or request.headers.get("content-encoding") == "gzip"
+    importer = ConversationImporter(current_user["user_id"])
+    try:
+        async for record in iter_ndjson_records(request, compressed):
+            if importer.add(record):
+                await run_db(importer.flush)
+    except (ValueError, zlib.error) as e:
+        await run_db(importer.flush)
+        raise HTTPException(status_code=400, detail=f"Invalid import data after {importer.stats['messages']} messages: {str(e)}")
+    await run_db(importer.flush)
+    
+    return {"message": "Import completed", **importer.stats}
+
+# Batch API
+def coerce_query_value(value: Any, annotation: Any) -> Any:
+    """Convert a raw query value to the type an endpoint parameter declares"""
+    if get_origin(annotation) is Union:
+        non_null = [arg for arg in get_args(annotation) if arg is not type(None)]
+        if value is None:
+            return None
+        annotation = non_null[0] if non_null else str
+    if annotation is bool and isinstance(value, str):
+        return value.lower() in ("1", "true", "yes", "on")
+    if annotation in (int, float, str, bool):
+        return annotation(value)
+    if annotation is datetime and isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return value
+
+def match_batch_route(method: str, path: str):
+    """Find the GET route a batch sub-request targets, with its path parameters"""
+    for route in app.routes:
+        if not isinstance(route, APIRoute) or method not in route.methods or route.path == "/api/batch":
+            continue
+        match = route.path_regex.match(path)
+        if match:
+            return route, match.groupdict()
+    return None, None
+
+async def execute_batch_item(item: BatchSubRequest, current_user: Optional[dict]) -> dict:
+    """Run one batch sub-request against its endpoint function in-process"""
+    result = {"id": item.id, "path": item.path}
+    method = item.method.upper()
+    if method != "GET":
+        return {**result, "status": 405, "body": {"detail": "Only GET requests can be batched"}}
+    
+    url = urlsplit(item.path)
+    route, path_params = match_batch_route(method, url.path)
+    if not route:
+        return {**result, "status": 404, "body": {"detail": "Not Found"}}
+    
+    query = {**dict(parse_qsl(url.query)), **item.params}
+    kwargs = {}
+    try:
+        for name, parameter in inspect.signature(route.endpoint).parameters.items():
+            if isinstance(parameter.default, DependsParam):
+                if parameter.default.dependency is not get_current_user:
+                    return {**result, "status": 400, "body": {"detail": "Endpoint cannot be batched"}}
+                kwargs[name] = current_user
+            elif name in path_params:
+                kwargs[name] = coerce_query_value(path_params[name], parameter.annotation)
+            elif name in query:
+                kwargs[name] = coerce_query_value(query[name], parameter.annotation)
+            elif parameter.default is inspect.Parameter.empty:
+                return {**result, "status": 422, "body": {"detail": f"Missing parameter: {name}"}}
+    except (TypeError, ValueError) as e:
+        return {**result, "status": 422, "body": {"detail": f"Invalid parameter: {str(e)}"}}
+    
+    try:
+        body = await route.endpoint(**kwargs)
+        if isinstance(body, StreamingResponse):
+            return {**result, "status": 400, "body": {"detail": "Streaming endpoints cannot be batched"}}
+        if isinstance(body, Response):
+            # Endpoints that build their own response choose its status, e.g. a degraded readiness probe
+            content = body.body.decode(body.charset)
+            if body.media_type == "application/json" and content:
+                content = json.loads(content)
+            return {**result, "status": body.status_code, "body": content}
+        return {**result, "status": 200, "body": body}
+    except HTTPException as e:
+        return {**result, "status": e.status_code, "body": {"detail": e.detail}}
+    except Exception as e:
+        return {**result, "status": 500, "body": {"detail": f"Batch item error: {str(e)}"}}
+
+@app.post("/api/batch")
+async def batch(batch_request: BatchRequest, current_user: dict = Depends(get_current_user)):
+    """Execute several read requests concurrently with a single auth resolution"""
+    if len(batch_request.requests) > BATCH_MAX_REQUESTS:
+        raise HTTPException(status_code=400, detail=f"Too many batched requests (max {BATCH_MAX_REQUESTS})")
+    
+    responses = await asyncio.gather(*(execute_batch_item(item, current_user) for item in batch_request.requests))
+    return {"responses": responses}
+
+# Multi-worker support
+def reset_process_state():
+    """Give a freshly forked worker its own DB client slot, caches and registries"""
+    global client, default_persona_cache, presence_registry, _memory_indexes, _memory_indexes_lock
+    global health_monitor, provider_circuits, single_flight, chat_job_events
+    global conversation_context_cache, recent_chat_contexts, _prewarm_tasks, chat_latency, usage_meter
+    global span_exporter, mongo_trace_listener, slow_query_log, room_buffers, room_turn_events, idempotency_events
+    global chat_cancellations
+    # PyMongo clients are not fork-safe; the child reconnects in its lifespan hook
+    client = None
+    default_persona_cache = TTLCache(PERSONA_CACHE_TTL_SECONDS)
+    presence_registry = PresenceRegistry(PRESENCE_TTL_SECONDS)
+    _memory_indexes = OrderedDict()
+    _memory_indexes_lock = threading.Lock()
+    health_monitor = HealthMonitor()
+    provider_circuits = {}
+    single_flight = SingleFlight()
+    chat_job_events = {}
+    conversation_context_cache = TTLCache(PREWARM_TTL_SECONDS)
+    recent_chat_contexts = TTLCache(PREWARM_TTL_SECONDS)
+    _prewarm_tasks = set()
+    chat_latency = LatencyRecorder()
+    usage_meter = UsageMeter()
+    span_exporter = SpanExporter(TRACE_EXPORTER)
+    mongo_trace_listener = MongoTraceListener()
+    slow_query_log = SlowQueryLog(SLOW_QUERY_MS, SLOW_QUERY_MAX_SHAPES)
+    room_buffers = RoomMessageBuffers(ROOM_BUFFER_MESSAGES, ROOM_BUFFER_MAX_BYTES, ROOM_BUFFER_IDLE_SECONDS, ROOM_BUFFER_REFRESH_SECONDS)
+    room_turn_events = {}
+    idempotency_events = {}
+    chat_cancellations = CancellationStats()
+
+# Covers servers that import the app once and then fork (e.g. gunicorn --preload)
+os.register_at_fork(after_in_child=reset_process_state)
+
+def main(argv: Optional[List[str]] = None):
+    import argparse
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file
+    
+    parser = argparse.ArgumentParser(description="Run the Character VR RP API")
+    parser.add_argument("--host", default=os.environ.get("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", "8001")))
+    parser.add_argument("--workers", default=os.environ.get("WEB_CONCURRENCY", "1"),
+                        help="number of worker processes, or 'auto' for one per CPU core")
+    parser.add_argument("--migrate-messages", action="store_true",
+                        help="move messages into the bucketed layout and exit (run workers with MESSAGE_STORAGE_LAYOUT=migrating meanwhile)")
+    parser.add_argument("--migrate-pause", type=float, default=0.0,
+                        help="seconds to sleep between conversations while migrating, to limit load")
+    args = parser.parse_args(argv)
+    
+    if args.migrate_messages:
+        def progress(stats):
+            if stats["conversations"] % 100 == 0:
+                print(f"Migrated {stats['messages']} messages in {stats['conversations']} conversations", flush=True)
+        
+        init_db()
+        stats = migrate_messages_to_buckets(
+            DocumentMessageStore(messages_collection),
+            BucketedMessageStore(message_buckets_collection, MESSAGE_BUCKET_SIZE),
+            pause=args.migrate_pause,
+            progress=progress
+        )
+        print(f"Migration complete: {stats['messages']} messages in {stats['conversations']} conversations")
+        close_db()
+        return
+    
+    workers = (os.cpu_count() or 1) if args.workers == "auto" else int(args.workers)
+    if workers > 1 and SESSION_STORE_BACKEND == "memory":
+        parser.error("SESSION_STORE_BACKEND=memory keeps sessions per process; use mongo with more than one worker")
+    
+    # Passing the import string makes every worker import the app itself, so DB
+    # clients and caches are created inside each worker rather than inherited
+    uvicorn.run("server:app", host=args.host, port=args.port, workers=workers)
+
+IMPORT_SECONDS = time.perf_counter() - _IMPORT_STARTED
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
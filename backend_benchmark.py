@@ -0,0 +1,473 @@
+#!/usr/bin/env python3
+"""
+Backend Benchmarks - In-process performance checks for backend subsystems
+Run a single benchmark with: python backend_benchmark.py <name>
+"""
+
+import sys
+import os
+import time
+import socket
+import subprocess
+import urllib.request
+import http.client
+import multiprocessing
+import json
+import resource
+import uuid
+import zlib
+from datetime import datetime, timedelta
+import tempfile
+import shutil
+import statistics
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
+sys.path.append('/app/backend')
+
+
+def percentile(samples, pct):
+    """Return the pct-th percentile of a list of samples"""
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def report(name, samples_ms):
+    print(f"   {name}: p50={percentile(samples_ms, 50):.2f}ms  p95={percentile(samples_ms, 95):.2f}ms  "
+          f"mean={statistics.mean(samples_ms):.2f}ms  n={len(samples_ms)}")
+
+
+def bench_memory(memories=100_000, queries=200):
+    """Top-k retrieval latency for a conversation holding 100k memories"""
+    import numpy as np
+    import server
+
+    print(f"🧠 Long-term memory retrieval ({memories:,} memories, {queries} queries)")
+    rng = np.random.default_rng(42)
+    vocabulary = [f"word{i}" for i in range(5000)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        index = server.ConversationMemoryIndex(directory, "benchmark")
+
+        # Random unit vectors stand in for stored turns; only retrieval is timed
+        start = time.perf_counter()
+        batch = 10_000
+        for offset in range(0, memories, batch):
+            vectors = rng.standard_normal((batch, server.MEMORY_EMBEDDING_DIM)).astype(np.float32)
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+            index.add_many([f"m{offset + i}" for i in range(batch)], vectors)
+        print(f"   Indexed in {time.perf_counter() - start:.1f}s "
+              f"({os.path.getsize(index.vectors_path) / 1e6:.0f} MB on disk)")
+
+        embed_samples, search_samples = [], []
+        for _ in range(queries):
+            text = " ".join(rng.choice(vocabulary, 12))
+            start = time.perf_counter()
+            query = server.embed_text(text)
+            embed_samples.append((time.perf_counter() - start) * 1000)
+            start = time.perf_counter()
+            index.search(query, k=server.MEMORY_TOP_K, min_score=0.0)
+            search_samples.append((time.perf_counter() - start) * 1000)
+        report("embed query", embed_samples)
+        report("top-k search", search_samples)
+
+        # Reopening maps the existing files instead of loading them
+        start = time.perf_counter()
+        reopened = server.ConversationMemoryIndex(directory, "benchmark")
+        print(f"   Reopen: {(time.perf_counter() - start) * 1000:.1f}ms for {len(reopened):,} memories")
+
+
+def bench_coldstart(top=10):
+    """Import-time profile of server.py and time until /api/health answers"""
+    backend_dir = os.path.dirname(server_path())
+    print("🚀 Cold start")
+
+    profile = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import server; print(server.IMPORT_SECONDS)"],
+        cwd=backend_dir, capture_output=True, text=True, check=True
+    )
+    print(f"   server.py import: {float(profile.stdout.strip().splitlines()[-1]) * 1000:.0f}ms")
+
+    # Lines look like "import time:   self [us] | cumulative | package", nested two
+    # spaces per level; depth 1 is what server.py imports directly
+    entries = []
+    imported = set()
+    for line in profile.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, package = line[len("import time:"):].split("|")
+        imported.add(package.strip())
+        depth = (len(package) - len(package.lstrip()) - 1) // 2
+        if depth == 1:
+            entries.append((int(cumulative), package.strip()))
+    print("   Slowest imports made by server.py:")
+    for cumulative, package in sorted(entries, reverse=True)[:top]:
+        print(f"      {cumulative / 1000:8.1f}ms  {package}")
+    loaded_llm = any(package.startswith("emergentintegrations") for package in imported)
+    print(f"   LLM integration imported at startup: {'yes' if loaded_llm else 'no'}")
+
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    start = time.perf_counter()
+    worker = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=backend_dir
+    )
+    try:
+        while True:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/api/health", timeout=1) as response:
+                    if response.status == 200:
+                        break
+            except OSError:
+                if worker.poll() is not None:
+                    print("   Worker exited before becoming ready")
+                    return
+                time.sleep(0.01)
+        print(f"   Process start to first /api/health 200: {(time.perf_counter() - start) * 1000:.0f}ms")
+    finally:
+        worker.terminate()
+        worker.wait()
+
+
+def max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def bench_export(messages=1_000_000, per_conversation=1000):
+    """Streaming NDJSON export and bulk import of a million-message account (needs MONGO_URL)"""
+    import server
+
+    server.init_db()
+    try:
+        server.client.admin.command("ping")
+    except Exception as e:
+        print(f"📦 Export/import: skipped, MongoDB unreachable ({e})")
+        return
+
+    run_id = uuid.uuid4().hex[:8]
+    source_user, target_user = f"bench_export_{run_id}", f"bench_import_{run_id}"
+    conversations = messages // per_conversation
+    print(f"📦 Export/import ({messages:,} messages in {conversations:,} conversations)")
+
+    try:
+        start = time.perf_counter()
+        base = datetime.utcnow()
+        for c in range(conversations):
+            conversation_id = f"{run_id}_c{c}"
+            server.conversations_collection.insert_one({
+                "conversation_id": conversation_id, "user_id": source_user, "character_id": "bench",
+                "title": f"Benchmark {c}", "mode": "casual", "created_at": base, "updated_at": base
+            })
+            server.messages_collection.insert_many([
+                {"message_id": f"{conversation_id}_m{i}", "conversation_id": conversation_id,
+                 "sender": "user" if i % 2 == 0 else "character", "sender_id": source_user,
+                 "content": f"Benchmark message {i} with a little roleplay text to look realistic.",
+                 "timestamp": base + timedelta(seconds=i)}
+                for i in range(per_conversation)
+            ], ordered=False)
+        print(f"   Seeded in {time.perf_counter() - start:.1f}s")
+
+        with tempfile.NamedTemporaryFile(suffix=".ndjson.gz") as export_file:
+            rss_before = max_rss_mb()
+            start = time.perf_counter()
+            raw_bytes = 0
+
+            def counted(chunks):
+                nonlocal raw_bytes
+                for chunk in chunks:
+                    raw_bytes += len(chunk)
+                    yield chunk
+
+            chunks = server.chunk_lines(server.export_conversation_lines(source_user))
+            for compressed in server.gzip_chunks(counted(chunks)):
+                export_file.write(compressed)
+            export_file.flush()
+            elapsed = time.perf_counter() - start
+            size = os.path.getsize(export_file.name)
+            print(f"   Export: {elapsed:.1f}s ({messages / elapsed:,.0f} msg/s), {raw_bytes / 1e6:.1f} MB NDJSON -> "
+                  f"{size / 1e6:.1f} MB gzip, max RSS +{max_rss_mb() - rss_before:.0f} MB")
+
+            export_file.seek(0)
+            importer = server.ConversationImporter(target_user)
+            decompressor = zlib.decompressobj(wbits=47)
+            pending = b""
+            start = time.perf_counter()
+            for chunk in iter(lambda: export_file.read(server.EXPORT_CHUNK_BYTES), b""):
+                pending += decompressor.decompress(chunk)
+                *lines, pending = pending.split(b"\n")
+                for line in lines:
+                    if importer.add(json.loads(line)):
+                        importer.flush()
+            importer.flush()
+            elapsed = time.perf_counter() - start
+            print(f"   Import: {elapsed:.1f}s ({importer.stats['messages'] / elapsed:,.0f} msg/s), "
+                  f"{importer.stats['messages']:,} messages, {importer.stats['errors']} errors")
+    finally:
+        for user_id in (source_user, target_user):
+            conversation_ids = server.conversations_collection.distinct("conversation_id", {"user_id": user_id})
+            server.messages_collection.delete_many({"conversation_id": {"$in": conversation_ids}})
+            server.conversations_collection.delete_many({"user_id": user_id})
+        server.close_db()
+
+
+def bench_buckets(conversations=200, per_conversation=2000, reads=200, page=50):
+    """Index size and history read latency, one document per message vs bucketed (needs MONGO_URL)"""
+    import random
+    import server
+
+    server.init_db()
+    try:
+        server.client.admin.command("ping")
+    except Exception as e:
+        print(f"🪣 Message buckets: skipped, MongoDB unreachable ({e})")
+        return
+
+    run_id = uuid.uuid4().hex[:8]
+    print(f"🪣 Message buckets ({conversations * per_conversation:,} messages in {conversations} conversations, "
+          f"{server.MESSAGE_BUCKET_SIZE} per bucket)")
+    documents = server.DocumentMessageStore(server.db[f"bench_messages_{run_id}"])
+    buckets = server.BucketedMessageStore(server.db[f"bench_buckets_{run_id}"], server.MESSAGE_BUCKET_SIZE)
+    stores = {"documents": documents, "buckets": buckets}
+
+    try:
+        base = datetime.utcnow()
+        for store in stores.values():
+            store.ensure_indexes()
+        for c in range(conversations):
+            conversation_id = f"{run_id}_c{c}"
+            messages = [
+                {"message_id": f"{conversation_id}_m{i}", "conversation_id": conversation_id, "room_id": None,
+                 "sender": "user" if i % 2 == 0 else "character", "sender_id": "bench",
+                 "content": f"Benchmark message {i} with a little roleplay text to look realistic.",
+                 "timestamp": base + timedelta(seconds=i)}
+                for i in range(per_conversation)
+            ]
+            for store in stores.values():
+                store.insert_many([dict(message) for message in messages])
+
+        rng = random.Random(42)
+        targets = [f"{run_id}_c{rng.randrange(conversations)}" for _ in range(reads)]
+        for name, store in stores.items():
+            stats = server.db.command("collStats", store.collection.name)
+            print(f"   {name}: {stats['count']:,} docs, data {stats['size'] / 1e6:.1f} MB, "
+                  f"indexes {stats['totalIndexSize'] / 1e6:.1f} MB")
+            full, latest = [], []
+            for conversation_id in targets:
+                start = time.perf_counter()
+                store.conversation_messages(conversation_id)
+                full.append((time.perf_counter() - start) * 1000)
+                start = time.perf_counter()
+                store.latest_conversation_messages(conversation_id, page + 1)
+                latest.append((time.perf_counter() - start) * 1000)
+            report(f"{name} full history", full)
+            report(f"{name} latest {page}", latest)
+
+        # Migration throughput on a copy of the per-message collection
+        migrated = server.BucketedMessageStore(server.db[f"bench_migrated_{run_id}"], server.MESSAGE_BUCKET_SIZE)
+        start = time.perf_counter()
+        stats = server.migrate_messages_to_buckets(documents, migrated)
+        elapsed = time.perf_counter() - start
+        print(f"   Migration: {stats['messages']:,} messages in {elapsed:.1f}s ({stats['messages'] / elapsed:,.0f} msg/s)")
+    finally:
+        for suffix in ("messages", "buckets", "migrated"):
+            server.db.drop_collection(f"bench_{suffix}_{run_id}")
+        server.close_db()
+
+
+def bench_room_turns(participants=10, rounds=5, spread=2.0, windows=(0.0, 0.5, 1.0), llm_seconds=1.5):
+    """Latency and LLM cost of a 10-participant room, one reply per message vs batched turns (needs MONGO_URL)"""
+    import asyncio
+    import random
+    import server
+
+    server.init_db()
+    try:
+        server.client.admin.command("ping")
+    except Exception as e:
+        print(f"👥 Room turns: skipped, MongoDB unreachable ({e})")
+        return
+
+    run_id = uuid.uuid4().hex[:8]
+    provider, model = "openai", server.AVAILABLE_MODELS["openai"]["default"]
+    print(f"👥 Room turns ({participants} participants, {rounds} rounds with arrivals spread over {spread:.1f}s, "
+          f"simulated {llm_seconds:.1f}s LLM calls, {model} prices)")
+    calls = []
+
+    class SimulatedChat:
+        """Stands in for LlmChat: fixed latency, replies sized like a real character turn"""
+        def __init__(self, api_key, session_id, system_message):
+            self.system_message = system_message
+
+        def with_model(self, provider, model):
+            return self
+
+        async def send_message(self, message):
+            calls.append(message.text)
+            await asyncio.sleep(llm_seconds)
+            return "A reply in character that speaks to everyone who just spoke. " * 8
+
+    class SimulatedMessage:
+        def __init__(self, text):
+            self.text = text
+
+    users = [{"user_id": f"{run_id}_u{i}", "username": f"Bench{i}", "email": f"bench{i}@example.com"} for i in range(participants)]
+    room_id, character_id = f"{run_id}_room", f"{run_id}_character"
+    original_key, original_llm, original_memory_dir = server.get_api_key, server.load_llm_integration, server.MEMORY_DIR
+    server.get_api_key = lambda provider: "benchmark"
+    server.load_llm_integration = lambda: (SimulatedChat, SimulatedMessage)
+    server.MEMORY_DIR = tempfile.mkdtemp()
+    try:
+        server.characters_collection.insert_one({
+            "character_id": character_id, "name": "Narrator", "description": "Runs the scene",
+            "personality": "Attentive", "system_prompt": "You narrate a shared scene."
+        })
+        server.multiplayer_rooms_collection.insert_one({
+            "room_id": room_id, "character_id": character_id, "name": "Benchmark room",
+            "participants": [user["user_id"] for user in users]
+        })
+        server.message_store.ensure_indexes()
+        server.ensure_room_turn_indexes()
+
+        async def send(user, delay):
+            await asyncio.sleep(delay)
+            start = time.perf_counter()
+            request = server.ChatRequest(conversation_id=room_id, room_id=room_id, message=f"{user['username']} acts in the scene.",
+                                         ai_provider=provider, ai_model=model)
+            await server.answer_chat(request, user)
+            return (time.perf_counter() - start) * 1000
+
+        async def run_round(rng):
+            return await asyncio.wait_for(asyncio.gather(*(send(user, rng.uniform(0, spread)) for user in users)), 120)
+
+        for window in windows:
+            server.ROOM_TURN_WINDOW_SECONDS = window
+            server.single_flight = server.SingleFlight()
+            calls.clear()
+            rng = random.Random(42)
+            latencies = []
+            for _ in range(rounds):
+                latencies += asyncio.run(run_round(rng))
+                # Let the room go quiet between rounds
+                time.sleep(window)
+            messages = server.message_store.room_messages(room_id)
+            replies = [message for message in messages if message["sender"] == "character"]
+            prompt_tokens = sum(message["prompt_tokens"] or 0 for message in replies)
+            completion_tokens = sum(message["completion_tokens"] or 0 for message in replies)
+            cost = sum(message["cost_usd"] or 0 for message in replies)
+            label = "one reply per message" if window == 0 else f"window {window:.1f}s"
+            print(f"   {label}: {len(calls)} LLM calls for {participants * rounds} messages, "
+                  f"{prompt_tokens + completion_tokens:,} tokens, ${cost:.4f}")
+            report(f"{label} latency", latencies)
+            server.messages_collection.delete_many({"room_id": room_id})
+            server.message_buckets_collection.delete_many({"room_id": room_id})
+    finally:
+        server.get_api_key, server.load_llm_integration = original_key, original_llm
+        shutil.rmtree(server.MEMORY_DIR, ignore_errors=True)
+        server.MEMORY_DIR = original_memory_dir
+        server.characters_collection.delete_many({"character_id": character_id})
+        server.multiplayer_rooms_collection.delete_many({"room_id": room_id})
+        server.room_turns_collection.delete_many({"room_id": room_id})
+        server.close_db()
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def wait_for_health(port, worker, timeout=30):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/api/health", timeout=1) as response:
+                if response.status == 200:
+                    return True
+        except OSError:
+            if worker.poll() is not None:
+                return False
+            time.sleep(0.05)
+    return False
+
+
+def _load_client(port, path, duration, results):
+    """Issue keep-alive GETs for duration seconds and report how many completed"""
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    completed = 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        connection.request("GET", path)
+        response = connection.getresponse()
+        response.read()
+        if response.status == 200:
+            completed += 1
+    connection.close()
+    results.put(completed)
+
+
+def bench_workers(max_workers=None, duration=5.0, path="/api/ai-providers"):
+    """Throughput of the multi-worker launch mode from 1 to N worker processes"""
+    max_workers = max_workers or os.cpu_count() or 1
+    backend_dir = os.path.dirname(server_path())
+    # Leave headroom so load generators don't starve the workers they measure
+    clients = max(4, max_workers * 4)
+    print(f"⚙️  Multi-worker scaling (1..{max_workers} workers, {clients} clients, {duration:.0f}s per run, GET {path})")
+
+    baseline = None
+    worker_counts = sorted({1, *[2 ** i for i in range(1, max_workers.bit_length())], max_workers})
+    for workers in worker_counts:
+        port = free_port()
+        server_process = subprocess.Popen(
+            [sys.executable, "server.py", "--host", "127.0.0.1", "--port", str(port), "--workers", str(workers)],
+            cwd=backend_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        try:
+            if not wait_for_health(port, server_process):
+                print(f"   {workers} workers: server did not become ready")
+                continue
+            # The first ready worker answers /api/health while the rest are still importing
+            time.sleep(1 + workers * 0.5)
+            results = multiprocessing.Queue()
+            load = [multiprocessing.Process(target=_load_client, args=(port, path, duration, results)) for _ in range(clients)]
+            for process in load:
+                process.start()
+            total = sum(results.get() for _ in load)
+            for process in load:
+                process.join()
+        finally:
+            server_process.terminate()
+            server_process.wait()
+
+        throughput = total / duration
+        baseline = baseline or throughput
+        speedup = throughput / baseline
+        print(f"   {workers:3d} workers: {throughput:9.0f} req/s  speedup {speedup:4.2f}x  efficiency {speedup / workers:4.0%}")
+
+
+def server_path():
+    for directory in sys.path:
+        candidate = os.path.join(directory, "server.py")
+        if os.path.exists(candidate):
+            return candidate
+    raise FileNotFoundError("server.py not found on sys.path")
+
+
+BENCHMARKS = {
+    "memory": bench_memory,
+    "coldstart": bench_coldstart,
+    "workers": bench_workers,
+    "export": bench_export,
+    "buckets": bench_buckets,
+    "rooms": bench_room_turns,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"Unknown benchmark: {name} (choose from {', '.join(BENCHMARKS)})")
+            exit(1)
+        BENCHMARKS[name]()
+        print()
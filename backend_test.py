@@ -49,6 +49,30 @@ class BackendTester:
             self.log_test("Health Check", False, f"Health check error: {str(e)}")
             return False
     
+    def test_health_probes(self):
+        """Test liveness and readiness probes"""
+        try:
+            live = requests.get(f"{BASE_URL}/health/live")
+            if live.status_code != 200:
+                self.log_test("Health Probes", False, f"Liveness probe failed with status {live.status_code}")
+                return False
+            
+            ready = requests.get(f"{BASE_URL}/health/ready")
+            if ready.status_code not in (200, 503):
+                self.log_test("Health Probes", False, f"Readiness probe unexpected status {ready.status_code}: {ready.text}")
+                return False
+            checks = ready.json().get("checks", {})
+            if set(checks) != {"mongo", "providers", "event_loop"}:
+                self.log_test("Health Probes", False, f"Readiness checks missing: {list(checks)}")
+                return False
+            failing = [name for name, check in checks.items() if not check.get("ok")]
+            self.log_test("Health Probes", True, f"Readiness is {ready.json().get('status')}" +
+                        (f" (failing: {', '.join(failing)})" if failing else ""))
+            return True
+        except Exception as e:
+            self.log_test("Health Probes", False, f"Health probe error: {str(e)}")
+            return False
+    
     def test_create_user(self):
         """Test user creation"""
         try:
@@ -420,6 +444,71 @@ class BackendTester:
             self.log_test("Get Conversation Messages", False, f"Get messages error: {str(e)}")
             return False
     
+    def test_conversation_bootstrap(self):
+        """Test the single round-trip conversation bootstrap endpoint"""
+        if "conversation_id" not in self.test_data:
+            self.log_test("Conversation Bootstrap", False, "No conversation_id available for bootstrap")
+            return False
+        
+        try:
+            conversation_id = self.test_data["conversation_id"]
+            response = requests.get(f"{BASE_URL}/conversations/{conversation_id}/bootstrap", params={"limit": 20})
+            
+            if response.status_code == 200:
+                data = response.json()
+                missing = [key for key in ("conversation", "character", "messages", "providers") if key not in data]
+                if missing:
+                    self.log_test("Conversation Bootstrap", False, f"Bootstrap response missing keys: {missing}")
+                    return False
+                if data["conversation"].get("conversation_id") != conversation_id:
+                    self.log_test("Conversation Bootstrap", False, "Bootstrap returned the wrong conversation")
+                    return False
+                if len(data["messages"]) > 20:
+                    self.log_test("Conversation Bootstrap", False, f"Bootstrap ignored page limit: {len(data['messages'])} messages")
+                    return False
+                self.log_test("Conversation Bootstrap", True, f"Bootstrap returned {len(data['messages'])} messages and {len(data['providers'])} providers")
+                return True
+            else:
+                self.log_test("Conversation Bootstrap", False, f"Bootstrap failed with status {response.status_code}: {response.text}")
+                return False
+        except Exception as e:
+            self.log_test("Conversation Bootstrap", False, f"Bootstrap error: {str(e)}")
+            return False
+    
+    def test_batch_requests(self):
+        """Test batching several reads into one request"""
+        try:
+            batch_data = {
+                "requests": [
+                    {"id": "characters", "path": "/api/characters?limit=5"},
+                    {"id": "rooms", "path": "/api/rooms"},
+                    {"id": "providers", "path": "/api/ai-providers"},
+                    {"id": "personas", "path": "/api/personas"}
+                ]
+            }
+            
+            response = requests.post(f"{BASE_URL}/batch", json=batch_data, headers=HEADERS)
+            
+            if response.status_code == 200:
+                results = {item["id"]: item for item in response.json().get("responses", [])}
+                if set(results) != {"characters", "rooms", "providers", "personas"}:
+                    self.log_test("Batch Requests", False, f"Batch response ids mismatch: {list(results)}")
+                    return False
+                if results["providers"]["status"] != 200 or results["characters"]["status"] != 200:
+                    self.log_test("Batch Requests", False, "Public reads failed inside batch")
+                    return False
+                if results["personas"]["status"] != 401:
+                    self.log_test("Batch Requests", False, f"Unauthenticated persona read returned {results['personas']['status']}")
+                    return False
+                self.log_test("Batch Requests", True, "Batch returned per-item status and bodies")
+                return True
+            else:
+                self.log_test("Batch Requests", False, f"Batch failed with status {response.status_code}: {response.text}")
+                return False
+        except Exception as e:
+            self.log_test("Batch Requests", False, f"Batch error: {str(e)}")
+            return False
+    
     def test_full_ai_chat_flow(self):
         """Test complete AI chat flow with authentication simulation"""
         try:
@@ -498,6 +587,7 @@ class BackendTester:
             }
             
             db.sessions.insert_one(test_session)
+            self.test_data["session_id"] = session_id
             
             # Now test the AI chat with authentication
             chat_data = {
@@ -567,6 +657,267 @@ class BackendTester:
             self.log_test("Full AI Chat Flow", False, f"Full AI chat flow error: {str(e)}")
             return False
     
+    def test_chat_jobs(self):
+        """Test queued chat turns: submit returns a job id, polling returns the stored reply"""
+        try:
+            if "session_id" not in self.test_data or "conversation_id" not in self.test_data:
+                self.log_test("Chat Jobs", False, "Full AI chat flow must run first")
+                return False
+            
+            auth_headers = HEADERS.copy()
+            auth_headers["X-Session-ID"] = self.test_data["session_id"]
+            response = requests.post(f"{BASE_URL}/chat/jobs",
+                                   json={"conversation_id": self.test_data["conversation_id"], "message": "Tell me a short riddle."},
+                                   headers=auth_headers,
+                                   timeout=10)
+            if response.status_code != 202:
+                self.log_test("Chat Jobs", False, f"Submit failed with status {response.status_code}: {response.text}")
+                return False
+            job_id = response.json()["job_id"]
+            
+            job = {}
+            for _ in range(6):
+                job = requests.get(f"{BASE_URL}/chat/jobs/{job_id}", params={"wait": 10}, headers=auth_headers, timeout=20).json()
+                if job.get("status") in ("succeeded", "failed"):
+                    break
+            
+            if job.get("status") == "succeeded" and job["result"]["ai_response"]["content"]:
+                self.log_test("Chat Jobs", True, f"Job {job_id} succeeded after {job['attempts']} attempt(s)")
+                return True
+            self.log_test("Chat Jobs", False, f"Job did not succeed: {job}")
+            return False
+        except Exception as e:
+            self.log_test("Chat Jobs", False, f"Chat jobs error: {str(e)}")
+            return False
+    
+    def test_chat_idempotency(self):
+        """Test Idempotency-Key: a retry replays the stored turn, a different body under the same key is rejected"""
+        try:
+            if "session_id" not in self.test_data or "conversation_id" not in self.test_data:
+                self.log_test("Chat Idempotency", False, "Full AI chat flow must run first")
+                return False
+            
+            conversation_id = self.test_data["conversation_id"]
+            auth_headers = HEADERS.copy()
+            auth_headers["X-Session-ID"] = self.test_data["session_id"]
+            auth_headers["Idempotency-Key"] = str(uuid.uuid4())
+            chat_data = {"conversation_id": conversation_id, "message": "Which constellation do you watch most often?"}
+            
+            first = requests.post(f"{BASE_URL}/chat", json=chat_data, headers=auth_headers, timeout=30)
+            if first.status_code != 200:
+                self.log_test("Chat Idempotency", False, f"First submission failed with status {first.status_code}: {first.text}")
+                return False
+            stored = len(requests.get(f"{BASE_URL}/conversations/{conversation_id}/messages").json()["messages"])
+            
+            retry = requests.post(f"{BASE_URL}/chat", json=chat_data, headers=auth_headers, timeout=30)
+            if retry.status_code != 200 or retry.headers.get("Idempotent-Replayed") != "true":
+                self.log_test("Chat Idempotency", False, f"Retry was not replayed: status {retry.status_code}, headers {dict(retry.headers)}")
+                return False
+            message_ids = lambda data: (data["user_message"]["message_id"], data["ai_response"]["message_id"])
+            if message_ids(retry.json()) != message_ids(first.json()):
+                self.log_test("Chat Idempotency", False, "Retry returned different message ids")
+                return False
+            after_retry = len(requests.get(f"{BASE_URL}/conversations/{conversation_id}/messages").json()["messages"])
+            if after_retry != stored:
+                self.log_test("Chat Idempotency", False, f"Retry stored new messages: {stored} -> {after_retry}")
+                return False
+            
+            conflict = requests.post(f"{BASE_URL}/chat", json={**chat_data, "message": "Something else entirely"},
+                                   headers=auth_headers, timeout=30)
+            if conflict.status_code != 422:
+                self.log_test("Chat Idempotency", False, f"Reused key with a different body returned {conflict.status_code}, expected 422")
+                return False
+            
+            self.log_test("Chat Idempotency", True, "Retry replayed the stored turn and a mismatched body was rejected")
+            return True
+        except Exception as e:
+            self.log_test("Chat Idempotency", False, f"Chat idempotency error: {str(e)}")
+            return False
+    
+    def test_message_sync(self):
+        """Test delta sync: after a token, only the edited message and a tombstone for the deleted one come back"""
+        try:
+            if "session_id" not in self.test_data or "conversation_id" not in self.test_data:
+                self.log_test("Message Sync", False, "Full AI chat flow must run first")
+                return False
+            
+            conversation_id = self.test_data["conversation_id"]
+            auth_headers = HEADERS.copy()
+            auth_headers["X-Session-ID"] = self.test_data["session_id"]
+            messages = requests.get(f"{BASE_URL}/conversations/{conversation_id}/messages").json()["messages"]
+            user_messages = [message for message in messages if message["sender"] == "user"]
+            if not user_messages or len(messages) < 2:
+                self.log_test("Message Sync", False, f"Conversation needs a user message and one other, has {len(messages)}")
+                return False
+            edited_id = user_messages[0]["message_id"]
+            deleted_id = next(message["message_id"] for message in reversed(messages) if message["message_id"] != edited_id)
+            
+            # Tokens trail the server clock by SYNC_OVERLAP_SECONDS (5 by default); wait that out
+            # so messages written by earlier tests don't come back as changes
+            time.sleep(6)
+            token = requests.get(f"{BASE_URL}/conversations/{conversation_id}/messages/sync").json()["sync_token"]
+            
+            edit = requests.put(f"{BASE_URL}/conversations/{conversation_id}/messages/{edited_id}",
+                              json={"content": "Edited for the sync test"}, headers=auth_headers)
+            if edit.status_code != 200:
+                self.log_test("Message Sync", False, f"Edit failed with status {edit.status_code}: {edit.text}")
+                return False
+            delete = requests.delete(f"{BASE_URL}/conversations/{conversation_id}/messages/{deleted_id}", headers=auth_headers)
+            if delete.status_code != 200:
+                self.log_test("Message Sync", False, f"Delete failed with status {delete.status_code}: {delete.text}")
+                return False
+            
+            response = requests.get(f"{BASE_URL}/conversations/{conversation_id}/messages/sync", params={"token": token})
+            if response.status_code != 200:
+                self.log_test("Message Sync", False, f"Sync failed with status {response.status_code}: {response.text}")
+                return False
+            data = response.json()
+            changed = [message["message_id"] for message in data["messages"]]
+            deleted = [tombstone["message_id"] for tombstone in data["deleted"]]
+            if data["reset"] is not False or changed != [edited_id] or deleted != [deleted_id]:
+                self.log_test("Message Sync", False, f"Unexpected delta: reset={data['reset']}, messages={changed}, deleted={deleted}")
+                return False
+            
+            self.log_test("Message Sync", True, "Delta held only the edited message and the deleted message's tombstone")
+            return True
+        except Exception as e:
+            self.log_test("Message Sync", False, f"Message sync error: {str(e)}")
+            return False
+    
+    def test_chat_disconnect_cancellation(self):
+        """Test that a chat turn whose client gives up is cancelled and stores no reply"""
+        try:
+            if "session_id" not in self.test_data or "conversation_id" not in self.test_data:
+                self.log_test("Chat Disconnect Cancellation", False, "Full AI chat flow must run first")
+                return False
+            
+            conversation_id = self.test_data["conversation_id"]
+            auth_headers = HEADERS.copy()
+            auth_headers["X-Session-ID"] = self.test_data["session_id"]
+            content = f"Tell me a very long story about the stars ({uuid.uuid4().hex[:8]})"
+            try:
+                # Give up long before the model can answer
+                requests.post(f"{BASE_URL}/chat", json={"conversation_id": conversation_id, "message": content},
+                            headers=auth_headers, timeout=0.5)
+                self.log_test("Chat Disconnect Cancellation", False, "Chat answered before the client gave up")
+                return False
+            except requests.exceptions.Timeout:
+                pass
+            
+            time.sleep(3)
+            messages = requests.get(f"{BASE_URL}/conversations/{conversation_id}/messages").json()["messages"]
+            sent = [index for index, message in enumerate(messages) if message["content"] == content]
+            if not sent:
+                self.log_test("Chat Disconnect Cancellation", False, "The abandoned message was not stored")
+                return False
+            message = messages[sent[0]]
+            if message.get("reply_status") != "cancelled" or sent[0] != len(messages) - 1:
+                self.log_test("Chat Disconnect Cancellation", False,
+                            f"Turn was not cancelled: reply_status={message.get('reply_status')}, {len(messages) - 1 - sent[0]} message(s) after it")
+                return False
+            
+            self.log_test("Chat Disconnect Cancellation", True, "Abandoned turn was marked cancelled and no reply was stored")
+            return True
+        except Exception as e:
+            self.log_test("Chat Disconnect Cancellation", False, f"Chat disconnect cancellation error: {str(e)}")
+            return False
+    
+    def test_request_deadline(self):
+        """Test that a chat request whose X-Request-Timeout budget runs out fails with 504"""
+        try:
+            if "session_id" not in self.test_data or "conversation_id" not in self.test_data:
+                self.log_test("Request Deadline", False, "Full AI chat flow must run first")
+                return False
+            
+            auth_headers = HEADERS.copy()
+            auth_headers["X-Session-ID"] = self.test_data["session_id"]
+            auth_headers["X-Request-Timeout"] = "0.001"
+            response = requests.post(f"{BASE_URL}/chat",
+                                   json={"conversation_id": self.test_data["conversation_id"], "message": "Are you still there?"},
+                                   headers=auth_headers,
+                                   timeout=30)
+            if response.status_code != 504:
+                self.log_test("Request Deadline", False, f"Expected 504, got {response.status_code}: {response.text}")
+                return False
+            
+            self.log_test("Request Deadline", True, f"Spent budget answered with 504: {response.json().get('detail')}")
+            return True
+        except Exception as e:
+            self.log_test("Request Deadline", False, f"Request deadline error: {str(e)}")
+            return False
+    
+    def test_room_join_storm(self, joiners=2000, max_participants=10):
+        """Stress test: thousands of simultaneous joins must never overfill a room"""
+        try:
+            import sys
+            sys.path.append('/app/backend')
+            
+            from pymongo import MongoClient
+            import os
+            from dotenv import load_dotenv
+            from concurrent.futures import ThreadPoolExecutor
+            
+            load_dotenv('/app/backend/.env')
+            MONGO_URL = os.environ.get('MONGO_URL', 'mongodb://localhost:27017/character_vr_rp')
+            client = MongoClient(MONGO_URL)
+            db = client.get_default_database()
+            
+            run_id = uuid.uuid4().hex[:8]
+            host_id = f"storm_host_{run_id}"
+            room_id = f"storm_room_{run_id}"
+            user_ids = [f"storm_user_{run_id}_{i}" for i in range(joiners)]
+            session_ids = [f"storm_session_{run_id}_{i}" for i in range(joiners)]
+            
+            db.users.insert_many([
+                {"user_id": user_id, "username": user_id, "email": f"{user_id}@example.com", "created_at": datetime.utcnow()}
+                for user_id in user_ids
+            ])
+            db.sessions.insert_many([
+                {"session_id": session_id, "user_id": user_id, "session_token": "test_token",
+                 "expires_at": datetime.utcnow() + timedelta(hours=1), "created_at": datetime.utcnow()}
+                for session_id, user_id in zip(session_ids, user_ids)
+            ])
+            db.multiplayer_rooms.insert_one({
+                "room_id": room_id, "name": "Join Storm", "description": "Concurrency stress test",
+                "host_user_id": host_id, "character_id": "storm_character",
+                "max_participants": max_participants, "participants": [host_id],
+                "is_active": True, "is_private": False, "password": None,
+                "created_at": datetime.utcnow(), "updated_at": datetime.utcnow()
+            })
+            
+            def join(session_id):
+                headers = HEADERS.copy()
+                headers["X-Session-ID"] = session_id
+                return requests.post(f"{BASE_URL}/rooms/{room_id}/join", headers=headers, timeout=60).status_code
+            
+            print(f"   Firing {joiners} concurrent joins at a room capped at {max_participants}...")
+            start = time.time()
+            with ThreadPoolExecutor(max_workers=200) as executor:
+                statuses = list(executor.map(join, session_ids))
+            elapsed = time.time() - start
+            
+            room = db.multiplayer_rooms.find_one({"room_id": room_id})
+            participants = room["participants"]
+            accepted = statuses.count(200)
+            rejected = statuses.count(403)
+            
+            db.users.delete_many({"user_id": {"$in": user_ids}})
+            db.sessions.delete_many({"session_id": {"$in": session_ids}})
+            db.multiplayer_rooms.delete_one({"room_id": room_id})
+            
+            details = f"{accepted} accepted, {rejected} rejected, {len(participants)} participants in {elapsed:.1f}s"
+            if len(participants) > max_participants:
+                self.log_test("Room Join Storm", False, "Room capacity exceeded", details)
+                return False
+            if accepted != max_participants - 1 or len(set(participants)) != len(participants):
+                self.log_test("Room Join Storm", False, "Unexpected join results", details)
+                return False
+            self.log_test("Room Join Storm", True, "Room capacity held under concurrent joins", details)
+            return True
+        except Exception as e:
+            self.log_test("Room Join Storm", False, f"Join storm error: {str(e)}")
+            return False
+    
     def test_different_chat_modes(self):
         """Test different chat modes (casual, RP, RPG)"""
         if "user_id" not in self.test_data or "character_id" not in self.test_data:
@@ -1050,11 +1401,17 @@ class BackendTester:
         # Test sequence
         tests = [
             ("Health Check", self.test_health_check),
+            ("Health Probes", self.test_health_probes),
             ("Create User", self.test_create_user),
             ("Get User", self.test_get_user),
             ("Auth Callback (Invalid Session)", self.test_auth_callback),
             ("AI Integration Direct", self.test_ai_integration_direct),  # New focused AI test
             ("Full AI Chat Flow", self.test_full_ai_chat_flow),  # Complete AI chat test
+            ("Chat Jobs", self.test_chat_jobs),
+            ("Chat Idempotency", self.test_chat_idempotency),
+            ("Message Sync", self.test_message_sync),
+            ("Chat Disconnect Cancellation", self.test_chat_disconnect_cancellation),
+            ("Request Deadline", self.test_request_deadline),
             ("Persona AI Chat Integration", self.test_persona_ai_chat_integration),  # Persona + AI test
             ("Create Character (No Auth)", self.test_create_character),
             ("Get Characters", self.test_get_characters),
@@ -1062,9 +1419,12 @@ class BackendTester:
             ("Create Conversation (No Auth)", self.test_create_conversation),
             ("Get User Conversations", self.test_get_user_conversations),
             ("AI Providers", self.test_ai_providers),
+            ("Batch Requests", self.test_batch_requests),
             ("AI Chat (No Auth)", self.test_ai_chat),
             ("Get Conversation Messages", self.test_get_conversation_messages),
+            ("Conversation Bootstrap", self.test_conversation_bootstrap),
             ("Different Chat Modes", self.test_different_chat_modes),
+            ("Room Join Storm", self.test_room_join_storm),
             # Persona Management Tests
             ("Get User Personas (No Auth)", self.test_get_user_personas_no_auth),
             ("Create Persona", self.test_create_persona),
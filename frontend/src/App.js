@@ -8,6 +8,7 @@ import Home from './components/Home';
 import CharacterList from './components/CharacterList';
 import CharacterCreator from './components/CharacterCreator';
 import Chat from './components/Chat';
+import Room from './components/Room';
 import Settings from './components/Settings';
 import Login from './components/Login';
 import AuthCallback from './components/AuthCallback';
@@ -83,6 +84,11 @@ function AppContent() {
               <Chat />
             </ProtectedRoute>
           } />
+          <Route path="/room/:roomId" element={
+            <ProtectedRoute>
+              <Room />
+            </ProtectedRoute>
+          } />
           <Route path="/settings" element={
             <ProtectedRoute>
               <Settings />
@@ -31,61 +31,70 @@ const Chat = () => {
   const [selectedProvider, setSelectedProvider] = useState('openai');
   const [selectedModel, setSelectedModel] = useState('gpt-4.1');
   const [selectedPersona, setSelectedPersona] = useState(null);
+  const [hasMoreMessages, setHasMoreMessages] = useState(false);
+  const [loadingOlder, setLoadingOlder] = useState(false);
   const messagesEndRef = useRef(null);
 
   const backendUrl = process.env.REACT_APP_BACKEND_URL || 'http://localhost:8001';
 
   useEffect(() => {
-    fetchConversationData();
-    fetchMessages();
-    fetchAiProviders();
+    fetchBootstrapData();
   }, [conversationId]);
 
+  // Only a new latest message scrolls; prepending older history keeps the reader's place
+  const lastMessageId = messages.length ? messages[messages.length - 1].message_id : null;
   useEffect(() => {
     scrollToBottom();
-  }, [messages]);
+  }, [lastMessageId]);
 
   const scrollToBottom = () => {
     messagesEndRef.current?.scrollIntoView({ behavior: 'smooth' });
   };
 
-  const fetchConversationData = async () => {
+  const fetchBootstrapData = async () => {
     try {
-      const response = await axios.get(`${backendUrl}/api/conversations/${user.user_id}`);
-      const conv = response.data.conversations.find(c => c.conversation_id === conversationId);
-      
-      if (conv) {
-        setConversation(conv);
-        setSelectedMode(conv.mode || 'casual');
-        setSelectedProvider(conv.ai_provider || 'openai');
-        setSelectedModel(conv.ai_model || 'gpt-4.1');
-        
-        // Fetch character data
-        const characterResponse = await axios.get(`${backendUrl}/api/characters/${conv.character_id}`);
-        setCharacter(characterResponse.data);
+      const response = await axios.get(`${backendUrl}/api/conversations/${conversationId}/bootstrap`, {
+        headers: {
+          'X-Session-ID': localStorage.getItem('session_id') || ''
+        }
+      });
+      const { conversation: conv, character: char, default_persona, messages: history, has_more_messages, providers } = response.data;
+
+      setConversation(conv);
+      setSelectedMode(conv.mode || 'casual');
+      setSelectedProvider(conv.ai_provider || 'openai');
+      setSelectedModel(conv.ai_model || 'gpt-4.1');
+      setCharacter(char);
+      setMessages(history);
+      setHasMoreMessages(has_more_messages);
+      setAiProviders(providers);
+      if (default_persona) {
+        setSelectedPersona(prev => prev || default_persona);
       }
     } catch (error) {
       console.error('Error fetching conversation data:', error);
-    }
-  };
-
-  const fetchMessages = async () => {
-    try {
-      const response = await axios.get(`${backendUrl}/api/conversations/${conversationId}/messages`);
-      setMessages(response.data.messages);
-    } catch (error) {
-      console.error('Error fetching messages:', error);
     } finally {
       setLoading(false);
     }
   };
 
-  const fetchAiProviders = async () => {
+  const loadOlderMessages = async () => {
+    if (!messages.length || loadingOlder) return;
+
+    setLoadingOlder(true);
     try {
-      const response = await axios.get(`${backendUrl}/api/ai-providers`);
-      setAiProviders(response.data.providers);
+      const response = await axios.get(`${backendUrl}/api/conversations/${conversationId}/messages`, {
+        params: {
+          limit: 50,
+          before: messages[0].timestamp
+        }
+      });
+      setMessages(prev => [...response.data.messages, ...prev]);
+      setHasMoreMessages(response.data.has_more);
     } catch (error) {
-      console.error('Error fetching AI providers:', error);
+      console.error('Error loading older messages:', error);
+    } finally {
+      setLoadingOlder(false);
     }
   };
 
@@ -300,6 +309,18 @@ const Chat = () => {
       {/* Messages */}
       <div className="flex-1 overflow-y-auto p-4 chat-container">
         <div className="max-w-4xl mx-auto space-y-4">
+          {hasMoreMessages && (
+            <div className="text-center">
+              <button
+                onClick={loadOlderMessages}
+                disabled={loadingOlder}
+                className="text-sm text-primary-600 dark:text-primary-400 hover:text-primary-700 dark:hover:text-primary-300 disabled:opacity-50"
+              >
+                {loadingOlder ? 'Loading...' : 'Load older messages'}
+              </button>
+            </div>
+          )}
+
           {messages.length === 0 ? (
             <div className="text-center py-8">
               <MessageCircle className="w-12 h-12 text-gray-400 mx-auto mb-4" />
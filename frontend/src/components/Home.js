@@ -33,15 +33,22 @@ const Home = () => {
 
   const fetchData = async () => {
     try {
-      const [conversationsRes, charactersRes, roomsRes] = await Promise.all([
-        axios.get(`${backendUrl}/api/conversations/${user.user_id}`),
-        axios.get(`${backendUrl}/api/characters?limit=8`),
-        axios.get(`${backendUrl}/api/rooms?limit=6`)
-      ]);
+      const response = await axios.post(`${backendUrl}/api/batch`, {
+        requests: [
+          { id: 'conversations', path: `/api/conversations/${user.user_id}` },
+          { id: 'characters', path: '/api/characters?limit=8' },
+          { id: 'rooms', path: '/api/rooms?limit=6' }
+        ]
+      }, {
+        headers: {
+          'X-Session-ID': localStorage.getItem('session_id') || ''
+        }
+      });
+      const results = Object.fromEntries(response.data.responses.map(r => [r.id, r.status === 200 ? r.body : {}]));
 
-      setRecentConversations((conversationsRes.data?.conversations || []).slice(0, 5));
-      setCharacters(charactersRes.data?.characters || []);
-      setMultiplayerRooms(roomsRes.data?.rooms || []);
+      setRecentConversations((results.conversations?.conversations || []).slice(0, 5));
+      setCharacters(results.characters?.characters || []);
+      setMultiplayerRooms(results.rooms?.rooms || []);
     } catch (error) {
       console.error('Error fetching data:', error);
     } finally {
@@ -243,7 +250,7 @@ const Home = () => {
                     <div className="flex items-center space-x-2">
                       <Crown className="w-4 h-4 text-yellow-400" />
                       <span className="text-xs text-gray-400">
-                        Active
+                        {room?.online_count || 0} online
                       </span>
                     </div>
                     <button className="bg-purple-600 hover:bg-purple-700 text-white px-3 py-1 rounded text-sm font-medium transition-colors">
@@ -0,0 +1,124 @@
+import React, { useState, useEffect } from 'react';
+import { useParams, Link } from 'react-router-dom';
+import { ArrowLeft, Users } from 'lucide-react';
+import axios from 'axios';
+
+// Heartbeats go out well inside the server's presence TTL so one lost request doesn't drop the user
+const DEFAULT_PRESENCE_TTL_SECONDS = 60;
+
+const Room = () => {
+  const { roomId } = useParams();
+  const [room, setRoom] = useState(null);
+  const [loading, setLoading] = useState(true);
+
+  const backendUrl = process.env.REACT_APP_BACKEND_URL || 'http://localhost:8001';
+
+  useEffect(() => {
+    let timer = null;
+    let cancelled = false;
+
+    const fetchRoom = async () => {
+      try {
+        const response = await axios.get(`${backendUrl}/api/rooms/${roomId}`);
+        if (!cancelled) setRoom(response.data);
+      } catch (error) {
+        console.error('Error fetching room:', error);
+      } finally {
+        if (!cancelled) setLoading(false);
+      }
+    };
+
+    const heartbeat = async () => {
+      let ttl = DEFAULT_PRESENCE_TTL_SECONDS;
+      try {
+        const response = await axios.post(`${backendUrl}/api/rooms/${roomId}/heartbeat`, {}, {
+          headers: {
+            'X-Session-ID': localStorage.getItem('session_id') || ''
+          }
+        });
+        ttl = response.data.expires_in || ttl;
+      } catch (error) {
+        console.error('Error sending room heartbeat:', error);
+      }
+      await fetchRoom();
+      if (!cancelled) timer = setTimeout(heartbeat, (ttl / 3) * 1000);
+    };
+
+    heartbeat();
+    return () => {
+      cancelled = true;
+      clearTimeout(timer);
+    };
+  }, [roomId]);
+
+  if (loading) {
+    return (
+      <div className="min-h-screen flex items-center justify-center">
+        <div className="text-center">
+          <div className="animate-spin rounded-full h-12 w-12 border-b-2 border-primary-500 mx-auto mb-4"></div>
+          <p className="text-gray-600 dark:text-gray-400">Loading room...</p>
+        </div>
+      </div>
+    );
+  }
+
+  if (!room) {
+    return (
+      <div className="min-h-screen flex items-center justify-center">
+        <div className="text-center">
+          <h2 className="text-2xl font-bold text-gray-900 dark:text-white mb-2">
+            Room not found
+          </h2>
+          <Link
+            to="/"
+            className="text-primary-600 dark:text-primary-400 hover:text-primary-700 dark:hover:text-primary-300"
+          >
+            Return to Home
+          </Link>
+        </div>
+      </div>
+    );
+  }
+
+  return (
+    <div className="min-h-screen bg-gray-50 dark:bg-dark-900 flex flex-col">
+      <div className="bg-white dark:bg-dark-800 border-b border-gray-200 dark:border-gray-700 p-4">
+        <div className="flex items-center space-x-4">
+          <Link
+            to="/"
+            className="text-gray-500 hover:text-gray-700 dark:text-gray-400 dark:hover:text-gray-200"
+          >
+            <ArrowLeft className="w-6 h-6" />
+          </Link>
+          <div>
+            <h1 className="text-lg font-semibold text-gray-900 dark:text-white">
+              {room.name}
+            </h1>
+            <p className="text-sm text-gray-500 dark:text-gray-400 flex items-center">
+              <Users className="w-4 h-4 mr-1" />
+              {room.online_count} online • {room.participants.length}/{room.max_participants} participants
+            </p>
+          </div>
+        </div>
+      </div>
+
+      <div className="p-4">
+        {room.description && (
+          <p className="text-gray-600 dark:text-gray-400 mb-4">{room.description}</p>
+        )}
+        <ul className="space-y-2">
+          {room.participants.map(participant => (
+            <li key={participant} className="flex items-center space-x-2 text-gray-900 dark:text-white">
+              <span
+                className={`w-2 h-2 rounded-full ${room.online_participants.includes(participant) ? 'bg-green-500' : 'bg-gray-400'}`}
+              ></span>
+              <span>{participant}{participant === room.host_user_id ? ' (host)' : ''}</span>
+            </li>
+          ))}
+        </ul>
+      </div>
+    </div>
+  );
+};
+
+export default Room;